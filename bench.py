@@ -0,0 +1,289 @@
+"""
+Micro-bancs des chemins chauds du serveur zombie21, sans réseau ni boucle
+asyncio : génération de la ville, test route/immeuble, spawn sûr, collision
+avec les immeubles, balayage d'infection et sérialisation des diffusions.
+
+Chaque cas est paramétré (de 10 à 10 000 joueurs, de la ville par défaut à des
+villes bien plus grandes). Les résultats s'enregistrent comme référence, puis
+--compare signale les cas plus lents que la référence au-delà d'un seuil :
+un changement de performance se relit comme n'importe quel autre.
+
+    python bench.py --save bench_baseline.json
+    python bench.py --compare bench_baseline.json --threshold 0.25
+"""
+import argparse
+import gc
+import json
+import math
+import platform
+import random
+import statistics
+import sys
+import time
+
+import zombie21
+
+PLAYER_COUNTS = (10, 100, 1000, 10000)
+# Valeurs fixes, indépendantes de ZOMBIE_CITY_SIZE : ce sont les clés de la référence
+CITY_SIZES = (400, 1600, 6400)
+BENCH_CITY_SIZE = 400
+BENCH_SEED = 1
+SPAWN_CALLS = 1000
+
+##########################################################################
+#                                 Cas                                    #
+##########################################################################
+# Un cas reçoit ses paramètres et renvoie (prepare, run) : prepare remet l'état
+# à zéro hors chronométrage, run est la seule partie mesurée.
+
+def bench_city_layout(city_size):
+    def run():
+        zombie21.generate_city_layout(BENCH_SEED, city_size)
+    return None, run
+
+def bench_building_on_road(city_size):
+    buildings = zombie21.generate_city_layout(BENCH_SEED, city_size)["buildings"]
+    on_road = zombie21.building_on_road
+    def run():
+        for b in buildings:
+            on_road(b)
+    return None, run
+
+def bench_safe_spawn(city_size):
+    grid = zombie21.CityGrid(zombie21.generate_city_layout(BENCH_SEED, city_size))
+    rng = random.Random(BENCH_SEED)
+    def prepare():
+        rng.seed(BENCH_SEED)
+    def run():
+        for _ in range(SPAWN_CALLS):
+            zombie21.get_safe_spawn(grid, rng)
+    return prepare, run
+
+def make_room(players, city_size=BENCH_CITY_SIZE):
+    """Salle peuplée de `players` joueurs, sans PNJ ni connexion."""
+    city = zombie21.City(zombie21.generate_city_layout(BENCH_SEED, city_size))
+    room = zombie21.Room("bench", city, seed=BENCH_SEED)
+    for i in range(players):
+        room.add_player(f"bench-{i}")
+    return room
+
+def bench_collision(players):
+    """Test de collision d'un pas de marche par joueur (Room.apply_input)."""
+    room = make_room(players)
+    store = room.players
+    step = zombie21.MOVE_SPEED / zombie21.TICK_RATE
+    segments = []
+    for slot in store.slots():
+        x, z, o = store.x[slot], store.z[slot], store.orientation[slot]
+        segments.append((x, z, x + step * math.sin(o), z + step * math.cos(o)))
+    blocked = room.city_grid.segment_blocked
+    def run():
+        for x0, z0, x1, z1 in segments:
+            blocked(x0, z0, x1, z1)
+    return None, run
+
+def bench_infection(players):
+    """Balayage d'infection (broad-phase + check_collision_zombie) pour tous les joueurs."""
+    room = make_room(players)
+    store = room.players
+    slots = list(store.slots())
+    # Un tiers de zombies pour que les deux branches du balayage travaillent
+    for slot in slots[::3]:
+        store.set_role(slot, zombie21.ROLE_ZOMBIE)
+    roles = store.role[:]
+    def prepare():
+        store.role[:] = roles
+        room.rng.seed(BENCH_SEED)
+    def run():
+        for slot in slots:
+            room.apply_infection(slot)
+    return prepare, run
+
+def bench_broadcast(players):
+    """Snapshot delta où chaque joueur a bougé, encodé en binaire et en JSON."""
+    room = make_room(players)
+    store = room.players
+    slots = list(store.slots())
+    room.snapshots.keyframe_interval = 0
+    room.snapshots.build(0)
+    state = {"tick": 0}
+    def prepare():
+        for slot in slots:
+            store.x[slot] += 0.1
+            store.orientation[slot] += 0.01
+        state["tick"] += 1
+    def run():
+        snapshot = room.snapshots.build(state["tick"])
+        snapshot.delta_bytes()
+        snapshot.delta_text()
+    return prepare, run
+
+def bench_keyframe(players):
+    """Keyframe complète en binaire et en JSON (nouveaux clients, resynchronisation)."""
+    room = make_room(players)
+    room.snapshots.keyframe_interval = 0
+    state = {"tick": 0}
+    def prepare():
+        state["tick"] += 1
+        state["snapshot"] = room.snapshots.build(state["tick"])
+    def run():
+        snapshot = state["snapshot"]
+        snapshot.keyframe_bytes()
+        snapshot.keyframe_text()
+    return prepare, run
+
+CASES = {
+    "city_layout": (bench_city_layout, "city_size"),
+    "building_on_road": (bench_building_on_road, "city_size"),
+    "safe_spawn": (bench_safe_spawn, "city_size"),
+    "collision": (bench_collision, "players"),
+    "infection": (bench_infection, "players"),
+    "broadcast": (bench_broadcast, "players"),
+    "keyframe": (bench_keyframe, "players"),
+}
+
+##########################################################################
+#                              Mesure                                    #
+##########################################################################
+def measure(prepare, run, min_time, min_repeat, max_repeat):
+    """
+    Répète `run` (précédé de `prepare`, non chronométré) jusqu'à `min_time`
+    secondes cumulées, après un essai de chauffe. Le ramasse-miettes est coupé
+    pendant la mesure, comme dans timeit. Le minimum est le chiffre le moins
+    bruité ; la médiane est donnée à titre indicatif.
+    """
+    if prepare is not None:
+        prepare()
+    run()
+    samples = []
+    total = 0.0
+    gc.collect()
+    gc.disable()
+    try:
+        while len(samples) < max_repeat and (len(samples) < min_repeat or total < min_time):
+            if prepare is not None:
+                prepare()
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            samples.append(elapsed)
+            total += elapsed
+    finally:
+        gc.enable()
+    return {
+        "repeat": len(samples),
+        "min_ms": min(samples) * 1000,
+        "median_ms": statistics.median(samples) * 1000,
+    }
+
+def run_suite(args):
+    results = {}
+    for name in args.cases:
+        factory, param = CASES[name]
+        values = args.city_sizes if param == "city_size" else args.players
+        for value in values:
+            key = f"{name}/{param}={value}"
+            prepare, run = factory(value)
+            result = measure(prepare, run, args.min_time, args.min_repeat, args.max_repeat)
+            results[key] = result
+            print(f"{key:32s} min {result['min_ms']:10.3f} ms   médiane {result['median_ms']:10.3f} ms"
+                  f"   ({result['repeat']} essais)", file=sys.stderr)
+    return {
+        "label": args.label,
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "numpy": zombie21.np.__version__ if zombie21.np is not None else None,
+        },
+        "results": results,
+    }
+
+##########################################################################
+#                           Comparaison                                  #
+##########################################################################
+def compare(report, baseline, threshold, min_delta):
+    """
+    Compare les minima cas par cas. Renvoie les lignes du rapport et la liste
+    des régressions : ratio > 1 + seuil sur le minimum et sur la médiane, et
+    écart d'au moins `min_delta` ms, pour ne pas confondre le bruit du
+    chronomètre avec une régression.
+    """
+    lines = []
+    regressions = []
+    if baseline.get("machine") != report["machine"]:
+        lines.append("attention : la référence a été mesurée sur une autre machine ou un autre Python")
+    for key, result in report["results"].items():
+        base = baseline["results"].get(key)
+        if base is None:
+            lines.append(f"{key:32s} nouveau")
+            continue
+        ratio = result["min_ms"] / base["min_ms"] if base["min_ms"] else float("inf")
+        median_ratio = result["median_ms"] / base["median_ms"] if base["median_ms"] else float("inf")
+        delta = abs(result["min_ms"] - base["min_ms"])
+        if delta < min_delta:
+            verdict = ""
+        elif ratio > 1 + threshold and median_ratio > 1 + threshold:
+            verdict = "RÉGRESSION"
+            regressions.append(key)
+        elif ratio < 1 / (1 + threshold):
+            verdict = "amélioration"
+        else:
+            verdict = ""
+        lines.append(f"{key:32s} {base['min_ms']:10.3f} -> {result['min_ms']:10.3f} ms  x{ratio:5.2f}  {verdict}")
+    return lines, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-bancs des chemins chauds de zombie21")
+    parser.add_argument("--cases", default=",".join(CASES),
+                        type=lambda v: [name for name in v.split(",") if name],
+                        help="cas à mesurer, séparés par des virgules")
+    parser.add_argument("--players", default=",".join(map(str, PLAYER_COUNTS)),
+                        type=lambda v: [int(n) for n in v.split(",")],
+                        help="nombres de joueurs, séparés par des virgules")
+    parser.add_argument("--city-sizes", default=",".join(map(str, CITY_SIZES)),
+                        type=lambda v: [int(n) for n in v.split(",")],
+                        help="tailles de ville, séparées par des virgules")
+    parser.add_argument("--min-time", type=float, default=0.5, help="temps cumulé minimal par cas (s)")
+    parser.add_argument("--min-repeat", type=int, default=5)
+    parser.add_argument("--max-repeat", type=int, default=1000)
+    parser.add_argument("--label", default=None, help="étiquette de la version mesurée")
+    parser.add_argument("--save", help="enregistre les résultats comme référence (JSON)")
+    parser.add_argument("--compare", help="référence JSON à laquelle comparer les résultats")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="ralentissement toléré avant de signaler une régression (0.25 = +25 %%)")
+    parser.add_argument("--min-delta", type=float, default=0.1,
+                        help="écart minimal (ms) pour signaler une régression ou une amélioration")
+    parser.add_argument("--output", help="fichier JSON de sortie (stdout par défaut)")
+    args = parser.parse_args()
+    unknown = [name for name in args.cases if name not in CASES]
+    if unknown:
+        parser.error(f"cas inconnus : {', '.join(unknown)} (disponibles : {', '.join(CASES)})")
+
+    report = run_suite(args)
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(report, baseline, args.threshold, args.min_delta)
+        report["compare"] = {"baseline": args.compare, "label": baseline.get("label"),
+                             "threshold": args.threshold, "min_delta_ms": args.min_delta,
+                             "regressions": regressions}
+        print(f"\nComparaison avec {args.compare} (seuil +{args.threshold:.0%}) :", file=sys.stderr)
+        for line in lines:
+            print(line, file=sys.stderr)
+    text = json.dumps(report, indent=2)
+    if args.save:
+        with open(args.save, "w") as f:
+            f.write(text + "\n")
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    elif not args.save:
+        print(text)
+    if regressions:
+        print(f"{len(regressions)} régression(s) au-delà de +{args.threshold:.0%}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+"""
+Banc de charge de zombie21 : des bots WebSocket scriptés se connectent à /ws,
+envoient des entrées réalistes (touches tenues) et consomment les diffusions.
+
+Pour chaque palier de joueurs on mesure la latence entrée -> diffusion
+(percentiles), les diffusions par seconde, les octets reçus par client et le
+CPU du serveur. Le résultat est un document JSON, à comparer d'une version à
+l'autre pour détecter les régressions.
+
+    python loadtest.py --players 100,500,1000 --duration 10 --output charge.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+
+import websockets
+
+import zombie21
+
+ROTATING_MASKS = (
+    zombie21.KEY_LEFT,
+    zombie21.KEY_RIGHT,
+    zombie21.KEY_FORWARD | zombie21.KEY_LEFT,
+    zombie21.KEY_FORWARD | zombie21.KEY_RIGHT,
+    zombie21.KEY_BACKWARD | zombie21.KEY_LEFT,
+)
+
+##########################################################################
+#                              Mesures                                   #
+##########################################################################
+class Metrics:
+    """Compteurs partagés par tous les bots ; seule la fenêtre de mesure compte."""
+    def __init__(self):
+        self.measuring = False
+        self.latencies: list[float] = []
+        self.messages = 0
+        self.bytes = 0
+        self.inputs = 0
+        self.errors = 0
+
+    def reset(self):
+        self.latencies = []
+        self.messages = 0
+        self.bytes = 0
+        self.inputs = 0
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+def process_cpu_seconds(pid):
+    """Temps CPU (utilisateur + système) d'un processus, via /proc ou psutil."""
+    if pid is None:
+        return None
+    if pid == os.getpid():
+        return time.process_time()
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    times = psutil.Process(pid).cpu_times()
+    return times.user + times.system
+
+def fetch_json(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.load(response)
+
+##########################################################################
+#                                Bots                                    #
+##########################################################################
+def own_orientation_binary(data, handle):
+    """Orientation du joueur `handle` dans un snapshot binaire, ou None."""
+    kind, _flags, _tick, _base, n1, n2, n3 = zombie21.HEADER_STRUCT.unpack_from(data, 0)
+    if kind not in (zombie21.MSG_KEYFRAME, zombie21.MSG_DELTA):
+        return None
+    record = zombie21.RECORD_STRUCT
+    offset = zombie21.HEADER_STRUCT.size
+    for _ in range(n1):
+        if zombie21.HANDLE_STRUCT.unpack_from(data, offset)[0] == handle:
+            return record.unpack_from(data, offset)[4]
+        offset += record.size
+    offset += n2 * zombie21.HANDLE_STRUCT.size
+    for _ in range(n3):
+        if zombie21.HANDLE_STRUCT.unpack_from(data, offset)[0] == handle:
+            return record.unpack_from(data, offset)[4]
+        offset += record.size
+    return None
+
+def own_orientation_json(data, player_id):
+    message = json.loads(data)
+    if message.get("type") == "keyframe":
+        groups = (message["players"],)
+    elif message.get("type") == "delta":
+        groups = (message["joins"], message["updates"])
+    else:
+        return None
+    for group in groups:
+        for p in group:
+            if p["id"] == player_id and "orientation" in p:
+                return p["orientation"]
+    return None
+
+class Bot:
+    """
+    Un client scripté : alterne des pauses et des périodes où il tient une
+    combinaison de touches qui le fait toujours tourner. La latence mesurée
+    est le délai entre l'envoi d'un nouvel état de touches et la première
+    diffusion où son orientation a changé.
+    """
+    def __init__(self, url, binary, metrics, rng):
+        self.url = url
+        self.binary = binary
+        self.metrics = metrics
+        self.rng = rng
+        self.identity = None
+        self.orientation = None
+        self.pending_since = None
+        self.pending_orientation = None
+        self.seq = 0
+        self.stopped = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        try:
+            async with websockets.connect(self.url, max_size=None, compression=None) as ws:
+                first = await ws.recv()
+                if self.binary:
+                    self.identity = zombie21.ASSIGN_STRUCT.unpack(first)[1]
+                else:
+                    self.identity = json.loads(first)["player_id"]
+                reader = asyncio.create_task(self.read(ws))
+                try:
+                    await self.drive(ws)
+                finally:
+                    reader.cancel()
+        except (OSError, websockets.WebSocketException):
+            self.metrics.errors += 1
+
+    async def read(self, ws):
+        metrics = self.metrics
+        async for data in ws:
+            if metrics.measuring:
+                metrics.messages += 1
+                metrics.bytes += len(data)
+            if self.binary:
+                orientation = own_orientation_binary(data, self.identity)
+            else:
+                orientation = own_orientation_json(data, self.identity)
+            if orientation is None:
+                continue
+            if self.pending_since is not None and orientation != self.pending_orientation:
+                if metrics.measuring:
+                    metrics.latencies.append(time.perf_counter() - self.pending_since)
+                self.pending_since = None
+            self.orientation = orientation
+
+    async def send_keys(self, ws, keys):
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        if self.binary:
+            await ws.send(zombie21.INPUT_STATE_STRUCT.pack(zombie21.INPUT_STATE, keys, self.seq))
+        else:
+            await ws.send(json.dumps({"type": "input", "keys": keys, "seq": self.seq}))
+        if self.metrics.measuring:
+            self.metrics.inputs += 1
+
+    async def drive(self, ws):
+        rng = self.rng
+        while not self.stopped.is_set():
+            await self.send_keys(ws, 0)
+            # Pause assez longue pour que les diffusions en vol soient arrivées
+            if await self.wait(rng.uniform(0.25, 0.6)):
+                break
+            self.pending_orientation = self.orientation
+            self.pending_since = time.perf_counter()
+            await self.send_keys(ws, rng.choice(ROTATING_MASKS))
+            if await self.wait(rng.uniform(0.4, 1.5)):
+                break
+
+    async def wait(self, delay):
+        """Attend `delay` secondes ; vrai si le bot doit s'arrêter."""
+        try:
+            await asyncio.wait_for(self.stopped.wait(), delay)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+
+##########################################################################
+#                              Serveur                                   #
+##########################################################################
+class SubprocessServer:
+    """Serveur lancé dans un processus séparé : son CPU est mesuré seul."""
+    def __init__(self, host, port, rooms):
+        self.host = host
+        self.port = port
+        self.rooms = rooms
+        self.proc = None
+
+    async def __aenter__(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zombie21.py")
+        self.proc = subprocess.Popen(
+            [sys.executable, script, "--host", self.host, "--port", str(self.port),
+             "--rooms", str(self.rooms)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        await wait_for_server(f"http://{self.host}:{self.port}")
+        return self.proc.pid
+
+    async def __aexit__(self, *exc):
+        self.proc.terminate()
+        self.proc.wait(timeout=10)
+
+class InProcessServer:
+    """Serveur uvicorn dans la même boucle que les bots : CPU partagé."""
+    def __init__(self, host, port, rooms):
+        self.host = host
+        self.port = port
+        self.rooms = rooms
+        self.server = None
+        self.task = None
+
+    async def __aenter__(self):
+        import uvicorn
+        zombie21.hosted_room_ids = [f"r{i}" for i in range(self.rooms)]
+        config = uvicorn.Config(zombie21.app, host=self.host, port=self.port, log_level="warning")
+        self.server = uvicorn.Server(config)
+        self.task = asyncio.create_task(self.server.serve())
+        await wait_for_server(f"http://{self.host}:{self.port}")
+        return os.getpid()
+
+    async def __aexit__(self, *exc):
+        self.server.should_exit = True
+        await self.task
+
+class ExternalServer:
+    """Serveur déjà lancé ; son CPU n'est mesuré que si on donne son pid."""
+    def __init__(self, pid):
+        self.pid = pid
+
+    async def __aenter__(self):
+        return self.pid
+
+    async def __aexit__(self, *exc):
+        pass
+
+async def wait_for_server(base_url, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await asyncio.to_thread(fetch_json, base_url + "/stats")
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"le serveur {base_url} ne répond pas")
+            await asyncio.sleep(0.2)
+
+##########################################################################
+#                             Scénario                                   #
+##########################################################################
+async def ramp(bots, count, url, binary, metrics, rng, batch=50):
+    """Ajoute des bots par lots jusqu'à en avoir `count`."""
+    while len(bots) < count:
+        for _ in range(min(batch, count - len(bots))):
+            bot = Bot(url, binary, metrics, random.Random(rng.random()))
+            bot.start()
+            bots.append(bot)
+        await asyncio.sleep(0.1)
+
+def tick_summary(stats):
+    rooms = stats.values()
+    ticks = [room["avg_tick_ms"] for room in rooms]
+    return {
+        "avg_tick_ms": sum(ticks) / len(ticks) if ticks else 0.0,
+        "max_tick_ms": max((room["max_tick_ms"] for room in rooms), default=0.0),
+        "overruns": sum(room["overruns"] for room in rooms),
+        "players": sum(room["players"] for room in rooms),
+    }
+
+async def measure_step(bots, base_url, pid, metrics, duration):
+    metrics.reset()
+    server_cpu = process_cpu_seconds(pid)
+    client_cpu = time.process_time()
+    start = time.perf_counter()
+    metrics.measuring = True
+    await asyncio.sleep(duration)
+    metrics.measuring = False
+    elapsed = time.perf_counter() - start
+    server_cpu_end = process_cpu_seconds(pid)
+    client_cpu = time.process_time() - client_cpu
+    stats = await asyncio.to_thread(fetch_json, base_url + "/stats")
+    latencies = sorted(metrics.latencies)
+    connected = sum(1 for bot in bots if bot.identity is not None and not bot.task.done())
+    return {
+        "players": len(bots),
+        "connected": connected,
+        "duration_s": elapsed,
+        "latency_ms": {
+            "samples": len(latencies),
+            "p50": _ms(percentile(latencies, 50)),
+            "p90": _ms(percentile(latencies, 90)),
+            "p99": _ms(percentile(latencies, 99)),
+            "max": _ms(latencies[-1] if latencies else None),
+        },
+        "broadcasts_per_s": metrics.messages / elapsed,
+        "broadcasts_per_client_per_s": metrics.messages / elapsed / connected if connected else 0.0,
+        "bytes_per_client_per_s": metrics.bytes / elapsed / connected if connected else 0.0,
+        "inputs_per_s": metrics.inputs / elapsed,
+        "server_cpu_percent": (100 * (server_cpu_end - server_cpu) / elapsed
+                               if server_cpu is not None and server_cpu_end is not None else None),
+        # Au-delà de ~90 %, c'est le générateur de charge qui limite la mesure
+        "client_cpu_percent": 100 * client_cpu / elapsed,
+        "errors": metrics.errors,
+        "server": tick_summary(stats),
+    }
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+async def run(args):
+    if args.url:
+        base_url = args.url.rstrip("/")
+        server = ExternalServer(args.server_pid)
+    elif args.mode == "inprocess":
+        base_url = f"http://{args.host}:{args.port}"
+        server = InProcessServer(args.host, args.port, args.rooms)
+    else:
+        base_url = f"http://{args.host}:{args.port}"
+        server = SubprocessServer(args.host, args.port, args.rooms)
+    # Les sockets peuvent viser une passerelle, les /stats restant lus sur le cœur
+    ws_base = args.ws_url.rstrip("/") if args.ws_url else base_url
+    ws_url = "ws" + ws_base[len("http"):] + "/ws" + ("?proto=bin" if args.proto == "bin" else "")
+    rng = random.Random(args.seed)
+    metrics = Metrics()
+    bots: list[Bot] = []
+    steps = []
+    async with server as pid:
+        try:
+            for count in args.players:
+                await ramp(bots, count, ws_url, args.proto == "bin", metrics, rng)
+                await asyncio.sleep(args.warmup)
+                step = await measure_step(bots, base_url, pid, metrics, args.duration)
+                steps.append(step)
+                print(f"{count:6d} joueurs : p50 {step['latency_ms']['p50'] or 0:.1f} ms, "
+                      f"p99 {step['latency_ms']['p99'] or 0:.1f} ms, "
+                      f"{step['broadcasts_per_s']:.0f} diffusions/s, "
+                      f"CPU serveur {step['server_cpu_percent'] or 0:.0f} %",
+                      file=sys.stderr)
+        finally:
+            await asyncio.gather(*(bot.stop() for bot in bots))
+    return {
+        "label": args.label,
+        "config": {
+            "mode": "external" if args.url else args.mode,
+            "proto": args.proto,
+            "rooms": args.rooms,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "seed": args.seed,
+            "cpu_shared": args.mode == "inprocess" and not args.url,
+        },
+        "steps": steps,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Banc de charge WebSocket de zombie21")
+    parser.add_argument("--players", default="50,100,200",
+                        type=lambda v: [int(n) for n in v.split(",")],
+                        help="paliers de joueurs, séparés par des virgules")
+    parser.add_argument("--duration", type=float, default=10.0, help="durée de mesure par palier (s)")
+    parser.add_argument("--warmup", type=float, default=2.0, help="stabilisation avant mesure (s)")
+    parser.add_argument("--mode", choices=("subprocess", "inprocess"), default="subprocess",
+                        help="serveur dans un processus séparé ou dans la boucle des bots")
+    parser.add_argument("--url", help="serveur déjà lancé (http://hôte:port)")
+    parser.add_argument("--server-pid", type=int, help="pid du serveur externe, pour son CPU")
+    parser.add_argument("--ws-url", help="passerelle WebSocket (http://hôte:port), si distincte de --url")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rooms", type=int, default=1)
+    parser.add_argument("--proto", choices=("bin", "json"), default="bin")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", default=None, help="étiquette de la version mesurée")
+    parser.add_argument("--output", help="fichier JSON de sortie (stdout par défaut)")
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Rejeu d'un journal d'entrées de zombie21 (voir --record) : la salle est recréée
+à partir des graines de l'en-tête puis simulée sans socket ni attente, tick
+après tick, aussi vite que possible. Les sommes de contrôle journalisées sont
+vérifiées au passage : un rejeu doit reproduire la partie au bit près.
+
+Sert aussi de banc de débit du cœur de simulation : ticks par seconde, avec ou
+sans construction et encodage des snapshots.
+
+    python zombie21.py --record journaux/
+    python replay.py journaux/r0-1760000000-1234.zrec --snapshots --output rejeu.json
+"""
+import argparse
+import json
+import mmap
+import struct
+import sys
+import time
+
+import zombie21
+
+EVENT_NAMES = {
+    zombie21.EVENT_JOIN: "join",
+    zombie21.EVENT_LEAVE: "leave",
+    zombie21.EVENT_INPUT: "input",
+    zombie21.EVENT_NPC_SPAWN: "npc_spawn",
+    zombie21.EVENT_NPC_DESPAWN: "npc_despawn",
+    zombie21.EVENT_RECYCLE: "recycle",
+    zombie21.EVENT_CHECKSUM: "checksum",
+    zombie21.EVENT_RESTORE: "restore",
+}
+RESTORE_WORDS = zombie21.RESTORE_STATE_STRUCT.size // 4
+
+##########################################################################
+#                          Lecture du journal                            #
+##########################################################################
+def read_header(buffer):
+    magic, version, broad_phase, city_seed, room_seed, size, tick_rate, move_speed, rot_speed = \
+        zombie21.RECORD_HEADER_STRUCT.unpack_from(buffer)
+    if magic != zombie21.RECORD_MAGIC:
+        raise ValueError("ce fichier n'est pas un journal zombie21")
+    if version != zombie21.RECORD_FORMAT_VERSION:
+        raise ValueError(f"version de journal {version} non prise en charge")
+    return {
+        "broad_phase": list(zombie21.BROAD_PHASES)[broad_phase],
+        "city_seed": city_seed,
+        "room_seed": room_seed,
+        "city_size": int(size) if size == int(size) else size,
+        "tick_rate": tick_rate,
+        "move_speed": move_speed,
+        "rot_speed": rot_speed,
+    }
+
+def iter_events(buffer):
+    """Événements lus directement dans le mmap ; une fin tronquée est ignorée."""
+    start = zombie21.RECORD_HEADER_STRUCT.size
+    size = zombie21.RECORD_EVENT_STRUCT.size
+    end = start + (len(buffer) - start) // size * size
+    return zombie21.RECORD_EVENT_STRUCT.iter_unpack(memoryview(buffer)[start:end])
+
+##########################################################################
+#                               Rejeu                                    #
+##########################################################################
+class Divergence(Exception):
+    pass
+
+class Replay:
+    """Une salle recréée à l'identique, pilotée par les événements du journal."""
+    def __init__(self, header, snapshots=False):
+        # Mêmes paramètres que la salle enregistrée, quel que soit l'environnement
+        zombie21.MOVE_SPEED = header["move_speed"]
+        zombie21.ROT_SPEED = header["rot_speed"]
+        zombie21.BROAD_PHASE = header["broad_phase"]
+        city = zombie21.City(zombie21.generate_city_layout(header["city_seed"], header["city_size"]))
+        self.room = zombie21.Room("replay", city, seed=header["room_seed"])
+        loop = self.room.loop
+        loop.tick_rate = header["tick_rate"]
+        loop.tick_interval = 1.0 / header["tick_rate"]
+        self.snapshots = snapshots
+        # handle binaire -> id de joueur du rejeu
+        self.handles: dict[int, str] = {}
+        # handle -> mots de l'état en cours de reprise
+        self.restoring: dict[int, list] = {}
+        self.serial = 0
+        self.counts = {name: 0 for name in EVENT_NAMES.values()}
+        self.checked = 0
+        self.snapshot_bytes = 0
+
+    def apply(self, kind, flags, handle, value):
+        room = self.room
+        name = EVENT_NAMES.get(kind, "unknown")
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if kind == zombie21.EVENT_INPUT:
+            room.loop.queue_input(self.handles[handle], flags & zombie21.KEY_MASK, value,
+                                  merge=bool(flags & zombie21.EVENT_MERGED))
+        elif kind == zombie21.EVENT_JOIN:
+            player_id = f"replay-{self.serial}"
+            self.serial += 1
+            slot = room.add_player(player_id)
+            if slot != handle:
+                raise Divergence(f"tick {room.loop.tick} : arrivée sur l'emplacement {slot}, attendu {handle}")
+            self.handles[handle] = player_id
+        elif kind == zombie21.EVENT_LEAVE:
+            room.remove_player(self.handles.pop(handle))
+        elif kind == zombie21.EVENT_NPC_SPAWN:
+            room.npcs.spawn(value)
+            room.loop.dirty = True
+        elif kind == zombie21.EVENT_NPC_DESPAWN:
+            room.npcs.despawn(value)
+            room.loop.dirty = True
+        elif kind == zombie21.EVENT_RECYCLE:
+            room.recycle()
+        elif kind == zombie21.EVENT_RESTORE:
+            words = self.restoring.setdefault(handle, [0] * RESTORE_WORDS)
+            words[flags] = value
+            if flags == RESTORE_WORDS - 1:
+                role, score, x, z, orientation = zombie21.RESTORE_STATE_STRUCT.unpack(
+                    struct.pack(f"<{RESTORE_WORDS}I", *words))
+                room.restore_player(handle, role, x, z, orientation, score)
+                del self.restoring[handle]
+        elif kind == zombie21.EVENT_CHECKSUM:
+            checksum = zombie21.state_checksum(room.players)
+            if checksum != value:
+                raise Divergence(f"tick {room.loop.tick} : somme de contrôle {checksum:08x}, attendu {value:08x}")
+            self.checked += 1
+
+    def step(self):
+        room = self.room
+        if room.loop.step() and self.snapshots:
+            snapshot = room.snapshots.build(room.loop.tick)
+            self.snapshot_bytes += len(snapshot.delta_bytes())
+
+    def run(self, events):
+        """Applique chaque événement avant le tick qui le suit, jusqu'au dernier."""
+        loop = self.room.loop
+        for tick, kind, flags, handle, value in events:
+            while loop.tick < tick:
+                self.step()
+            self.apply(kind, flags, handle, value)
+
+def replay(path, snapshots=False):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        header = read_header(buffer)
+        session = Replay(header, snapshots)
+        error = None
+        cpu = time.process_time()
+        start = time.perf_counter()
+        try:
+            session.run(iter_events(buffer))
+        except Divergence as exc:
+            error = str(exc)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+    room = session.room
+    ticks = room.loop.tick
+    return {
+        "log": path,
+        "header": header,
+        "ticks": ticks,
+        "simulated_s": ticks / header["tick_rate"],
+        "events": session.counts,
+        "checksums_verified": session.checked,
+        "divergence": error,
+        "final_checksum": f"{zombie21.state_checksum(room.players):08x}",
+        "players": room.humans(),
+        "npcs": room.npcs.count,
+        "wall_s": elapsed,
+        "cpu_s": cpu,
+        "ticks_per_s": ticks / elapsed if elapsed else None,
+        # Combien de fois plus vite que le temps réel
+        "speedup": ticks / header["tick_rate"] / elapsed if elapsed else None,
+        "snapshot_bytes": session.snapshot_bytes if snapshots else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Rejeu et banc de débit de la simulation zombie21")
+    parser.add_argument("log", help="journal .zrec produit par zombie21.py --record")
+    parser.add_argument("--snapshots", action="store_true",
+                        help="construire et encoder un snapshot à chaque tick modifié")
+    parser.add_argument("--output", help="fichier JSON de sortie (stdout par défaut)")
+    args = parser.parse_args()
+    report = replay(args.log, args.snapshots)
+    print(f"{report['ticks']} ticks en {report['wall_s']:.2f} s "
+          f"({report['ticks_per_s'] or 0:.0f} ticks/s, x{report['speedup'] or 0:.0f} temps réel), "
+          f"{report['checksums_verified']} sommes de contrôle vérifiées",
+          file=sys.stderr)
+    if report["divergence"]:
+        print(f"DIVERGENCE : {report['divergence']}", file=sys.stderr)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if report["divergence"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,66 @@
 import random
 import json
 import math
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, JSONResponse
+import mmap
+import struct
+import gzip
+import hashlib
+import hmac
+import zlib
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+import os
+import sys
+import time
+import threading
+import asyncio
+import logging
+import argparse
+import multiprocessing
+import tempfile
+from collections import deque
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response
 import uvicorn
 
-app = FastAPI()
+# Compression brotli optionnelle : gzip seul si le module n'est pas installé
+try:
+    import brotli
+except ImportError:
+    brotli = None
+# NumPy optionnel : génération vectorisée de la ville, sinon boucle Python équivalente
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger("zombie21")
+
+@asynccontextmanager
+async def lifespan(app):
+    # Les boucles de simulation des salles tournent pendant toute la durée de vie du serveur
+    tick_tasks = start_rooms()
+    if simulation_hub is not None:
+        await simulation_hub.start()
+    if lag_monitor is not None:
+        lag_monitor.start()
+    yield
+    if lag_monitor is not None:
+        await lag_monitor.stop()
+    if simulation_hub is not None:
+        await simulation_hub.stop()
+    for room in rooms.values():
+        room.loop.stop()
+    await asyncio.gather(*tick_tasks)
+    if world_snapshots is not None:
+        await world_snapshots.stop()
+    for room in rooms.values():
+        if room.recorder is not None:
+            room.recorder.close()
+
+app = FastAPI(lifespan=lifespan)
 
 ##########################################################################
 #                        PAGE HTML & JS                                   #
@@ -65,78 +120,76 @@ html_content = """
   ///////////////////////////////
   //    Modèles de personnages  //
   ///////////////////////////////
-  function createZombieModel() {
-      const group = new THREE.Group();
-      // Tête
-      const headGeo = new THREE.SphereGeometry(1, 16, 16);
-      const headMat = new THREE.MeshStandardMaterial({ color: 0x006400 });
-      const head = new THREE.Mesh(headGeo, headMat);
-      head.position.set(0, 2.5, 0);
-      group.add(head);
-      // Corps
-      const bodyGeo = new THREE.CylinderGeometry(1, 1, 3, 16);
-      const bodyMat = new THREE.MeshStandardMaterial({ color: 0x555555 });
-      const body = new THREE.Mesh(bodyGeo, bodyMat);
-      body.position.set(0, 1, 0);
-      group.add(body);
-      // Bras
-      const armGeo = new THREE.CylinderGeometry(0.3, 0.3, 2, 12);
-      const armMat = new THREE.MeshStandardMaterial({ color: 0x555555 });
-      const leftArm = new THREE.Mesh(armGeo, armMat);
-      leftArm.rotation.z = Math.PI / 2;
-      leftArm.position.set(-1.3, 1.5, 0);
-      group.add(leftArm);
-      const rightArm = leftArm.clone();
-      rightArm.position.set(1.3, 1.5, 0);
-      group.add(rightArm);
-      // Jambes
-      const legGeo = new THREE.CylinderGeometry(0.4, 0.4, 2.5, 12);
-      const legMat = new THREE.MeshStandardMaterial({ color: 0x333333 });
-      const leftLeg = new THREE.Mesh(legGeo, legMat);
-      leftLeg.position.set(-0.5, -1, 0);
-      group.add(leftLeg);
-      const rightLeg = leftLeg.clone();
-      rightLeg.position.set(0.5, -1, 0);
-      group.add(rightLeg);
-      return group;
+  // Géométries et matériaux créés une seule fois et partagés par tous les modèles
+  const modelGeometries = {};
+  const modelMaterials = new Map();
+
+  function modelGeometry(part) {
+      if (!modelGeometries[part]) {
+          modelGeometries.head = new THREE.SphereGeometry(1, 16, 16);
+          modelGeometries.body = new THREE.CylinderGeometry(1, 1, 3, 16);
+          modelGeometries.arm = new THREE.CylinderGeometry(0.3, 0.3, 2, 12);
+          modelGeometries.leg = new THREE.CylinderGeometry(0.4, 0.4, 2.5, 12);
+      }
+      return modelGeometries[part];
+  }
+
+  function modelMaterial(color) {
+      let material = modelMaterials.get(color);
+      if (!material) {
+          material = new THREE.MeshStandardMaterial({ color: color });
+          modelMaterials.set(color, material);
+      }
+      return material;
   }
 
-  function createCivilianModel() {
+  // Couleurs de tête, corps (et bras), jambes par rôle
+  const MODEL_COLORS = {
+      zombie: { head: 0x006400, body: 0x555555, leg: 0x333333 },
+      civil: { head: 0xFAD6A5, body: 0x87CEFA, leg: 0x000080 },
+  };
+
+  function createModel(role) {
+      const colors = MODEL_COLORS[role] || MODEL_COLORS.civil;
       const group = new THREE.Group();
+      const part = (name, color, x, y) => {
+          const mesh = new THREE.Mesh(modelGeometry(name), modelMaterial(color));
+          mesh.position.set(x, y, 0);
+          mesh.castShadow = true;
+          group.add(mesh);
+          return mesh;
+      };
       // Tête
-      const headGeo = new THREE.SphereGeometry(1, 16, 16);
-      const headMat = new THREE.MeshStandardMaterial({ color: 0xFAD6A5 });
-      const head = new THREE.Mesh(headGeo, headMat);
-      head.position.set(0, 2.5, 0);
-      group.add(head);
+      part("head", colors.head, 0, 2.5);
       // Corps
-      const bodyGeo = new THREE.CylinderGeometry(1, 1, 3, 16);
-      const bodyMat = new THREE.MeshStandardMaterial({ color: 0x87CEFA });
-      const body = new THREE.Mesh(bodyGeo, bodyMat);
-      body.position.set(0, 1, 0);
-      group.add(body);
+      part("body", colors.body, 0, 1);
       // Bras
-      const armGeo = new THREE.CylinderGeometry(0.3, 0.3, 2, 12);
-      const armMat = new THREE.MeshStandardMaterial({ color: 0x87CEFA });
-      const leftArm = new THREE.Mesh(armGeo, armMat);
-      leftArm.rotation.z = Math.PI / 2;
-      leftArm.position.set(-1.3, 1.5, 0);
-      group.add(leftArm);
-      const rightArm = leftArm.clone();
-      rightArm.position.set(1.3, 1.5, 0);
-      group.add(rightArm);
+      part("arm", colors.body, -1.3, 1.5).rotation.z = Math.PI / 2;
+      part("arm", colors.body, 1.3, 1.5).rotation.z = Math.PI / 2;
       // Jambes
-      const legGeo = new THREE.CylinderGeometry(0.4, 0.4, 2.5, 12);
-      const legMat = new THREE.MeshStandardMaterial({ color: 0x000080 });
-      const leftLeg = new THREE.Mesh(legGeo, legMat);
-      leftLeg.position.set(-0.5, -1, 0);
-      group.add(leftLeg);
-      const rightLeg = leftLeg.clone();
-      rightLeg.position.set(0.5, -1, 0);
-      group.add(rightLeg);
+      part("leg", colors.leg, -0.5, -1);
+      part("leg", colors.leg, 0.5, -1);
+      group.userData.role = role;
       return group;
   }
 
+  // Modèles des joueurs partis, réutilisés au lieu d'être reconstruits
+  const MODEL_POOL_LIMIT = 64;
+  const modelPool = { zombie: [], civil: [] };
+
+  function acquireModel(role) {
+      const pool = modelPool[role] || modelPool.civil;
+      const mesh = pool.length ? pool.pop() : createModel(role);
+      scene.add(mesh);
+      return mesh;
+  }
+
+  function releaseModel(mesh) {
+      scene.remove(mesh);
+      const pool = modelPool[mesh.userData.role];
+      if (pool && pool.length < MODEL_POOL_LIMIT) pool.push(mesh);
+  }
+
   ///////////////////////////////
   //    Variables globales     //
   ///////////////////////////////
@@ -146,13 +199,171 @@ html_content = """
   
   // État multijoueur
   let localPlayerId = null;
-  let playersState = {};
-  let playersMeshes = {};
+  // id -> état du joueur, id -> modèle 3D
+  let playersState = new Map();
+  const playersMeshes = new Map();
+  // Tick du dernier snapshot appliqué (base attendue du prochain delta)
+  let lastTick = null;
+  let resyncPending = false;
+
+  ///////////////////////////////
+  //   Chargement de la ville  //
+  ///////////////////////////////
+  // La ville est servie par tuiles carrées de tileSize unités. Une tuile :
+  // en-tête de 84 octets (magie, version, détail, i, j, nombre de boîtes,
+  // côté, hash de la ville, sha256 des boîtes) puis, par boîte, 5 float32
+  // (x, z, largeur, profondeur, hauteur) et l'indice de couleur en uint32
+  const TILE_HEADER = 84, TILE_VERSION = 2;
+  function parseTile(buffer) {
+      const view = new DataView(buffer);
+      const count = view.getUint32(12, true);
+      const boxes = new Array(count);
+      for (let i = 0, o = TILE_HEADER; i < count; i++, o += 24) {
+          boxes[i] = {
+              x: view.getFloat32(o, true),
+              z: view.getFloat32(o + 4, true),
+              width: view.getFloat32(o + 8, true),
+              depth: view.getFloat32(o + 12, true),
+              height: view.getFloat32(o + 16, true),
+              color: view.getUint32(o + 20, true)
+          };
+      }
+      return boxes;
+  }
+
+  function toHex(bytes) {
+      return Array.from(bytes, b => b.toString(16).padStart(2, "0")).join("");
+  }
+
+  async function sha256Hex(buffer) {
+      return toHex(new Uint8Array(await crypto.subtle.digest("SHA-256", buffer)));
+  }
+
+  // Les tuiles sont en cache immuable : une copie corrompue ou d'une autre
+  // ville resterait affichée pour toujours. On vérifie l'en-tête (tuile et
+  // ville attendues, taille), puis le sha256 des boîtes quand crypto.subtle
+  // existe (contexte sécurisé seulement).
+  async function tileValid(buffer, i, j, lod) {
+      if (buffer.byteLength < TILE_HEADER) return false;
+      const view = new DataView(buffer);
+      if (String.fromCharCode(...new Uint8Array(buffer, 0, 4)) !== "ZTIL"
+          || view.getUint16(4, true) !== TILE_VERSION || view.getUint8(6) !== lod
+          || view.getUint16(8, true) !== i || view.getUint16(10, true) !== j
+          || buffer.byteLength !== TILE_HEADER + view.getUint32(12, true) * 24
+          || toHex(new Uint8Array(buffer, 20, 32)) !== cityInfo.hash) {
+          return false;
+      }
+      if (!(window.crypto && crypto.subtle)) return true;
+      return await sha256Hex(buffer.slice(TILE_HEADER)) === toHex(new Uint8Array(buffer, 52, 32));
+  }
+
+  async function fetchTile(url) {
+      const response = await fetch(url);
+      if (!response.ok) throw new Error(url + " : " + response.status);
+      return response.arrayBuffer();
+  }
+
+  // Détail complet (immeubles instanciés, mobilier, collisions prédites) à
+  // TILE_NEAR tuiles de la caméra, géométrie simplifiée et fusionnée jusqu'à
+  // TILE_FAR, rien au-delà : le démarrage et la mémoire du client ne
+  // dépendent pas de la taille de la carte.
+  const TILE_NEAR = 1, TILE_FAR = 3;
+  const LOD_FULL = 0, LOD_LOW = 1;
+  // { size, tileSize, tileCount, url, hash } d'après /join
+  let cityInfo = null;
+  // "i,j" -> { i, j, lod, loading, meshes, cells }
+  const tiles = new Map();
+  let tileCenter = null;
+
+  function tileUrl(i, j, lod) {
+      return cityInfo.url.replace("{i}", i).replace("{j}", j) + "&lod=" + lod;
+  }
+
+  // Appelé à chaque image ; ne fait rien tant que la caméra reste dans la même tuile
+  function updateTiles(x, z) {
+      if (!cityInfo) return;
+      const last = cityInfo.tileCount - 1;
+      const ci = Math.min(last, Math.max(0, Math.floor(x / cityInfo.tileSize)));
+      const cj = Math.min(last, Math.max(0, Math.floor(z / cityInfo.tileSize)));
+      const center = ci + "," + cj;
+      if (center === tileCenter) return;
+      tileCenter = center;
+      const wanted = new Map();
+      for (let i = Math.max(0, ci - TILE_FAR); i <= Math.min(last, ci + TILE_FAR); i++) {
+          for (let j = Math.max(0, cj - TILE_FAR); j <= Math.min(last, cj + TILE_FAR); j++) {
+              const ring = Math.max(Math.abs(i - ci), Math.abs(j - cj));
+              wanted.set(i + "," + j, { i, j, ring, lod: ring <= TILE_NEAR ? LOD_FULL : LOD_LOW });
+          }
+      }
+      tiles.forEach((tile, key) => {
+          if (!wanted.has(key)) {
+              clearTile(tile);
+              tiles.delete(key);
+          }
+      });
+      // Les tuiles les plus proches sont demandées en premier
+      Array.from(wanted.values()).sort((a, b) => a.ring - b.ring).forEach(w => {
+          const tile = tiles.get(w.i + "," + w.j);
+          if (tile && (tile.loading === w.lod || (tile.loading === null && tile.lod === w.lod))) return;
+          loadTile(w.i, w.j, w.lod);
+      });
+  }
+
+  function loadTile(i, j, lod) {
+      const key = i + "," + j;
+      let tile = tiles.get(key);
+      if (!tile) {
+          tile = { i, j, lod: null, loading: null, meshes: [], cells: null };
+          tiles.set(key, tile);
+      }
+      tile.loading = lod;
+      const url = tileUrl(i, j, lod);
+      fetchTile(url)
+        .then(async buffer => {
+            if (await tileValid(buffer, i, j, lod)) return buffer;
+            // Copie en cache invalide : on contourne le cache HTTP
+            const response = await fetch(url, { cache: "reload" });
+            if (!response.ok) throw new Error("tuile " + key + " : " + response.status);
+            buffer = await response.arrayBuffer();
+            if (!(await tileValid(buffer, i, j, lod))) throw new Error("tuile " + key + " invalide");
+            return buffer;
+        })
+        .then(buffer => {
+            // Tuile déchargée ou autre détail demandé entre-temps
+            if (tiles.get(key) !== tile || tile.loading !== lod) return;
+            const boxes = parseTile(buffer);
+            // L'ancien niveau reste affiché jusqu'ici : pas de trou pendant le chargement
+            clearTile(tile);
+            tile.lod = lod;
+            tile.loading = null;
+            if (lod === LOD_FULL) {
+                tile.meshes = addBuildings(boxes).concat(addStreetElements(i, j));
+                tile.cells = indexBuildings(boxes, i, j);
+            } else {
+                tile.meshes = [addMergedBuildings(boxes)];
+            }
+            tile.meshes = tile.meshes.filter(mesh => mesh);
+        })
+        .catch(() => {
+            if (tile.loading === lod) tile.loading = null;
+        });
+  }
+
+  // Les géométries et matériaux partagés restent ; seuls les lots de la tuile sont libérés
+  function clearTile(tile) {
+      tile.meshes.forEach(mesh => {
+          scene.remove(mesh);
+          if (mesh.isInstancedMesh) mesh.dispose();
+          else mesh.geometry.dispose();
+      });
+      tile.meshes = [];
+      tile.cells = null;
+  }
 
   ///////////////////////////////
   //   Initialisation 3D       //
   ///////////////////////////////
-  function initScene() {
+  function initScene(room) {
       scene = new THREE.Scene();
       scene.background = new THREE.Color(0xB3E5FC);
       scene.fog = new THREE.FogExp2(0xB3E5FC, 0.002);
@@ -181,12 +392,113 @@ html_content = """
       directionalLight.shadow.camera.far = 2000;
       scene.add(directionalLight);
 
+      // Sol et routes couvrent toute la carte ; immeubles et mobilier arrivent par tuiles
+      cityInfo = {
+          size: room.city_size,
+          tileSize: room.tile_size,
+          tileCount: Math.max(1, Math.ceil(room.city_size / room.tile_size)),
+          url: room.tiles,
+          hash: room.city_hash
+      };
+      addGroundAndRoads(cityInfo.size);
+  
+      window.addEventListener('resize', onWindowResize, false);
+  }
+
+  ////////////////////////////////////////
+  //      Rendu instancié du décor      //
+  ////////////////////////////////////////
+  // Le décor est statique : une géométrie et un matériau partagés par sorte
+  // d'objet, et un InstancedMesh (un seul appel de dessin) par lot.
+  const placer = new THREE.Object3D();
+
+  // items : [{x, y, z, sx, sy, sz}] ; l'échelle est optionnelle (1 par défaut)
+  function addInstances(geometry, material, items, castShadow, receiveShadow) {
+      if (!items.length) return null;
+      const mesh = new THREE.InstancedMesh(geometry, material, items.length);
+      items.forEach((it, i) => {
+          placer.position.set(it.x, it.y, it.z);
+          placer.scale.set(it.sx || 1, it.sy || 1, it.sz || 1);
+          placer.updateMatrix();
+          mesh.setMatrixAt(i, placer.matrix);
+      });
+      mesh.instanceMatrix.needsUpdate = true;
+      // La sphère englobante est celle de la géométrie seule : pas de culling par lot
+      mesh.frustumCulled = false;
+      mesh.castShadow = !!castShadow;
+      mesh.receiveShadow = !!receiveShadow;
+      scene.add(mesh);
+      return mesh;
+  }
+
+  // Palette de couleurs pastel, indexée par la couleur tirée côté serveur
+  const buildingColors = ["#F8BBD0", "#CE93D8", "#B39DDB", "#9FA8DA", "#90CAF9",
+                          "#81D4FA", "#80DEEA", "#80CBC4", "#A5D6A7", "#C5E1A5"];
+
+  let buildingBox = null, buildingMaterials = null;
+  let lowDetailBox = null, lowDetailMaterial = null, lowDetailColors = null;
+
+  // Un cube unité, mis à l'échelle de chaque immeuble ; un lot par couleur.
+  // Renvoie les lots créés.
+  function addBuildings(buildings) {
+      if (!buildingBox) {
+          buildingBox = new THREE.BoxGeometry(1, 1, 1);
+          buildingMaterials = buildingColors.map(color => new THREE.MeshStandardMaterial({ color: color }));
+      }
+      const batches = buildingColors.map(() => []);
+      buildings.forEach(b => {
+          batches[b.color % buildingColors.length].push({
+              x: b.x, y: b.height / 2, z: b.z, sx: b.width, sy: b.height, sz: b.depth
+          });
+      });
+      return batches.map((items, c) => addInstances(buildingBox, buildingMaterials[c], items, true, true));
+  }
+
+  // Tuiles lointaines : toutes les boîtes recopiées dans une seule géométrie
+  // à couleurs par sommet, sans ombres (un appel de dessin par tuile)
+  function addMergedBuildings(boxes) {
+      if (!boxes.length) return null;
+      if (!lowDetailBox) {
+          lowDetailBox = new THREE.BoxGeometry(1, 1, 1).toNonIndexed();
+          lowDetailMaterial = new THREE.MeshLambertMaterial({ vertexColors: true });
+          lowDetailColors = buildingColors.map(color => new THREE.Color(color));
+      }
+      const unit = lowDetailBox.attributes.position.array;
+      const unitNormals = lowDetailBox.attributes.normal.array;
+      const n = unit.length;
+      const positions = new Float32Array(n * boxes.length);
+      const normals = new Float32Array(n * boxes.length);
+      const colors = new Float32Array(n * boxes.length);
+      boxes.forEach((b, k) => {
+          const color = lowDetailColors[b.color % lowDetailColors.length];
+          normals.set(unitNormals, k * n);
+          for (let v = 0, o = k * n; v < n; v += 3, o += 3) {
+              positions[o] = b.x + unit[v] * b.width;
+              positions[o + 1] = (unit[v + 1] + 0.5) * b.height;
+              positions[o + 2] = b.z + unit[v + 2] * b.depth;
+              colors[o] = color.r;
+              colors[o + 1] = color.g;
+              colors[o + 2] = color.b;
+          }
+      });
+      const geometry = new THREE.BufferGeometry();
+      geometry.setAttribute("position", new THREE.BufferAttribute(positions, 3));
+      geometry.setAttribute("normal", new THREE.BufferAttribute(normals, 3));
+      geometry.setAttribute("color", new THREE.BufferAttribute(colors, 3));
+      geometry.computeBoundingSphere();
+      const mesh = new THREE.Mesh(geometry, lowDetailMaterial);
+      scene.add(mesh);
+      return mesh;
+  }
+  
+  // Sol et routes, dimensionnés d'après la ville reçue du serveur
+  function addGroundAndRoads(size) {
       ////////////////////////////////////////
-      //   Création du sol (zone 0..400)     //
+      //   Création du sol (zone 0..size)    //
       ////////////////////////////////////////
-      const groundGeometry = new THREE.PlaneGeometry(400, 400);
+      const groundGeometry = new THREE.PlaneGeometry(size, size);
       groundGeometry.rotateX(-Math.PI / 2);
-      groundGeometry.translate(200, 0, 200);
+      groundGeometry.translate(size / 2, 0, size / 2);
       const groundMaterial = new THREE.MeshStandardMaterial({ color: 0x66BB6A });
       const ground = new THREE.Mesh(groundGeometry, groundMaterial);
       ground.receiveShadow = true;
@@ -195,128 +507,90 @@ html_content = """
       ////////////////////////////////////////
       //       Création des routes          //
       ////////////////////////////////////////
-      const roadColor = 0x424242;
-      // Routes verticales (positions x = 0, 40, …, 400)
-      for (let i = 0; i <= 10; i++) {
-          let roadGeom = new THREE.PlaneGeometry(4, 400);
-          roadGeom.rotateX(-Math.PI / 2);
-          roadGeom.translate(0, 0.05, 200);
-          const roadMat = new THREE.MeshStandardMaterial({ color: roadColor });
-          let road = new THREE.Mesh(roadGeom, roadMat);
-          road.receiveShadow = true;
-          road.position.set(i * 40, 0, 0);
-          scene.add(road);
-  
-          // Passage piéton vertical
-          let crossGeom = new THREE.PlaneGeometry(4, 2);
-          crossGeom.rotateX(-Math.PI / 2);
-          crossGeom.translate(0, 0.06, 200);
-          let crossMat = new THREE.MeshBasicMaterial({ color: 0xffffff });
-          let cross = new THREE.Mesh(crossGeom, crossMat);
-          cross.position.set(i * 40, 0, 0);
-          scene.add(cross);
-      }
-      // Routes horizontales (positions z = 0, 40, …, 400)
-      for (let j = 0; j <= 10; j++) {
-          let roadGeom = new THREE.PlaneGeometry(400, 4);
-          roadGeom.rotateX(-Math.PI / 2);
-          roadGeom.translate(200, 0.05, 0);
-          const roadMat = new THREE.MeshStandardMaterial({ color: roadColor });
-          let road = new THREE.Mesh(roadGeom, roadMat);
-          road.receiveShadow = true;
-          road.position.set(0, 0, j * 40);
-          scene.add(road);
-  
-          // Passage piéton horizontal
-          let crossGeom = new THREE.PlaneGeometry(2, 4);
-          crossGeom.rotateX(-Math.PI / 2);
-          crossGeom.translate(200, 0.06, 0);
-          let crossMat = new THREE.MeshBasicMaterial({ color: 0xffffff });
-          let cross = new THREE.Mesh(crossGeom, crossMat);
-          cross.position.set(0, 0, j * 40);
-          scene.add(cross);
-      }
-  
-      ////////////////////////////////////////
-      //    Chargement des immeubles        //
-      ////////////////////////////////////////
-      // Palette de couleurs pastel
-      const buildingColors = ["#F8BBD0", "#CE93D8", "#B39DDB", "#9FA8DA", "#90CAF9", 
-                              "#81D4FA", "#80DEEA", "#80CBC4", "#A5D6A7", "#C5E1A5"];
-  
-      fetch('/city')
-        .then(response => response.json())
-        .then(city => {
-            city.buildings.forEach(b => {
-                const geometry = new THREE.BoxGeometry(b.width, b.height, b.depth);
-                const color = buildingColors[Math.floor(Math.random() * buildingColors.length)];
-                const material = new THREE.MeshStandardMaterial({ color });
-                const mesh = new THREE.Mesh(geometry, material);
-                mesh.position.set(b.x, b.height/2, b.z);
-                mesh.castShadow = true;
-                mesh.receiveShadow = true;
-                scene.add(mesh);
-            });
-            addStreetElements();
-        });
-  
-      window.addEventListener('resize', onWindowResize, false);
+      const roadMat = new THREE.MeshStandardMaterial({ color: 0x424242 });
+      const crossMat = new THREE.MeshBasicMaterial({ color: 0xffffff });
+      const lines = [];
+      for (let k = 0; k * 40 <= size; k++) lines.push(k * 40);
+      // Routes verticales (positions x = 0, 40, …, size) et leur passage piéton
+      let roadGeom = new THREE.PlaneGeometry(4, size);
+      roadGeom.rotateX(-Math.PI / 2);
+      roadGeom.translate(0, 0.05, size / 2);
+      addInstances(roadGeom, roadMat, lines.map(x => ({ x: x, y: 0, z: 0 })), false, true);
+      let crossGeom = new THREE.PlaneGeometry(4, 2);
+      crossGeom.rotateX(-Math.PI / 2);
+      crossGeom.translate(0, 0.06, size / 2);
+      addInstances(crossGeom, crossMat, lines.map(x => ({ x: x, y: 0, z: 0 })));
+      // Routes horizontales (positions z = 0, 40, …, size)
+      roadGeom = new THREE.PlaneGeometry(size, 4);
+      roadGeom.rotateX(-Math.PI / 2);
+      roadGeom.translate(size / 2, 0.05, 0);
+      addInstances(roadGeom, roadMat, lines.map(z => ({ x: 0, y: 0, z: z })), false, true);
+      crossGeom = new THREE.PlaneGeometry(2, 4);
+      crossGeom.rotateX(-Math.PI / 2);
+      crossGeom.translate(size / 2, 0.06, 0);
+      addInstances(crossGeom, crossMat, lines.map(z => ({ x: 0, y: 0, z: z })));
   }
   
   ////////////////////////////////////////
   //   Éléments de rue (lampadaires, bancs, arbres)
   ////////////////////////////////////////
-  function addStreetElements() {
-      // Lampadaires placés au centre de chaque bloc (grille 10x10)
-      for (let i = 0; i < 10; i++) {
-          for (let j = 0; j < 10; j++) {
-              const x = i * 40 + 20;
-              const z = j * 40 + 20;
-              const postGeom = new THREE.CylinderGeometry(0.1, 0.1, 10, 8);
-              const postMat = new THREE.MeshStandardMaterial({ color: 0x424242 });
-              const lampPost = new THREE.Mesh(postGeom, postMat);
-              lampPost.position.set(x, 5, z);
-              lampPost.castShadow = true;
-              scene.add(lampPost);
-  
-              const lampHeadGeom = new THREE.SphereGeometry(0.5, 8, 8);
-              const lampHeadMat = new THREE.MeshBasicMaterial({ color: 0xFFEB3B });
-              const lampHead = new THREE.Mesh(lampHeadGeom, lampHeadMat);
-              lampHead.position.set(x, 10, z);
-              scene.add(lampHead);
-          }
+  let streetAssets = null;
+  // 50 arbres pour une carte de 400 x 400, à densité constante
+  const TREE_DENSITY = 50 / (400 * 400);
+
+  // Générateur pseudo-aléatoire (mulberry32) : une tuile rechargée retrouve ses arbres
+  function tileRandom(i, j) {
+      let a = (Math.imul(i, 73856093) ^ Math.imul(j, 19349663)) >>> 0;
+      return () => {
+          a = (a + 0x6D2B79F5) >>> 0;
+          let t = Math.imul(a ^ (a >>> 15), a | 1);
+          t ^= t + Math.imul(t ^ (t >>> 7), t | 61);
+          return ((t ^ (t >>> 14)) >>> 0) / 4294967296;
+      };
+  }
+
+  // Mobilier d'une tuile ; renvoie les lots créés
+  function addStreetElements(ti, tj) {
+      if (!streetAssets) {
+          streetAssets = {
+              lamp: [new THREE.CylinderGeometry(0.1, 0.1, 10, 8), new THREE.MeshStandardMaterial({ color: 0x424242 })],
+              head: [new THREE.SphereGeometry(0.5, 8, 8), new THREE.MeshBasicMaterial({ color: 0xFFEB3B })],
+              bench: [new THREE.BoxGeometry(4, 0.5, 1), new THREE.MeshStandardMaterial({ color: 0x8D6E63 })],
+              trunk: [new THREE.CylinderGeometry(0.5, 0.5, 5, 8), new THREE.MeshStandardMaterial({ color: 0xA1887F })],
+              foliage: [new THREE.SphereGeometry(3, 8, 8), new THREE.MeshStandardMaterial({ color: 0x66BB6A })],
+          };
       }
-      // Bancs : placés décalés dans chaque bloc
-      for (let i = 0; i < 10; i++) {
-          for (let j = 0; j < 10; j++) {
-              const x = i * 40 + 28;
-              const z = j * 40 + 10;
-              const benchGeom = new THREE.BoxGeometry(4, 0.5, 1);
-              const benchMat = new THREE.MeshStandardMaterial({ color: 0x8D6E63 });
-              const bench = new THREE.Mesh(benchGeom, benchMat);
-              bench.position.set(x, 0.3, z);
-              bench.castShadow = true;
-              scene.add(bench);
+      const size = cityInfo.size, tileSize = cityInfo.tileSize;
+      const x0 = ti * tileSize, z0 = tj * tileSize;
+      const x1 = Math.min(size, x0 + tileSize), z1 = Math.min(size, z0 + tileSize);
+      const lamps = [], heads = [], benches = [];
+      for (let i = x0 / 40; (i + 1) * 40 <= x1; i++) {
+          for (let j = z0 / 40; (j + 1) * 40 <= z1; j++) {
+              // Lampadaire au centre de chaque bloc de 40 unités
+              lamps.push({ x: i * 40 + 20, y: 5, z: j * 40 + 20 });
+              heads.push({ x: i * 40 + 20, y: 10, z: j * 40 + 20 });
+              // Banc décalé dans le bloc
+              benches.push({ x: i * 40 + 28, y: 0.3, z: j * 40 + 10 });
           }
       }
-      // Arbres : position aléatoire dans la zone
-      for (let i = 0; i < 50; i++) {
-          const trunkGeom = new THREE.CylinderGeometry(0.5, 0.5, 5, 8);
-          const trunkMat = new THREE.MeshStandardMaterial({ color: 0xA1887F });
-          const trunk = new THREE.Mesh(trunkGeom, trunkMat);
-          const foliageGeom = new THREE.SphereGeometry(3, 8, 8);
-          const foliageMat = new THREE.MeshStandardMaterial({ color: 0x66BB6A });
-          const foliage = new THREE.Mesh(foliageGeom, foliageMat);
-  
-          let x = Math.random() * 400;
-          let z = Math.random() * 400;
-          trunk.position.set(x, 2.5, z);
-          foliage.position.set(x, 6, z);
-          trunk.castShadow = true;
-          foliage.castShadow = true;
-          scene.add(trunk);
-          scene.add(foliage);
+      // Arbres : position aléatoire dans la tuile
+      const random = tileRandom(ti, tj);
+      const trunks = [], foliage = [];
+      const trees = Math.round(TREE_DENSITY * (x1 - x0) * (z1 - z0));
+      for (let k = 0; k < trees; k++) {
+          const x = x0 + random() * (x1 - x0);
+          const z = z0 + random() * (z1 - z0);
+          trunks.push({ x: x, y: 2.5, z: z });
+          foliage.push({ x: x, y: 6, z: z });
       }
+      const a = streetAssets;
+      return [
+          addInstances(a.lamp[0], a.lamp[1], lamps, true),
+          addInstances(a.head[0], a.head[1], heads),
+          addInstances(a.bench[0], a.bench[1], benches, true),
+          addInstances(a.trunk[0], a.trunk[1], trunks, true),
+          addInstances(a.foliage[0], a.foliage[1], foliage, true),
+      ];
   }
   
   ////////////////////////////////////////
@@ -333,6 +607,11 @@ html_content = """
   ////////////////////////////////////////
   function animate() {
       requestAnimationFrame(animate);
+      flushInput();
+      const frameTime = nowSeconds();
+      const frameDt = lastFrame === null ? 0 : Math.min(frameTime - lastFrame, 0.25);
+      lastFrame = frameTime;
+      positionPlayerMeshes(frameDt);
   
       // Cycle jour/nuit (60 secondes)
       let elapsed = clock.getElapsedTime();
@@ -342,28 +621,428 @@ html_content = """
       directionalLight.color.setRGB(1, intensity, intensity * 0.8);
   
       // Vue à la première personne : la caméra suit le joueur local
-      if (localPlayerId && playersState[localPlayerId]) {
-          const p = playersState[localPlayerId];
-          camera.position.set(p.x, 5, p.z);
-          const lookX = p.x + 50 * Math.sin(p.orientation);
-          const lookZ = p.z + 50 * Math.cos(p.orientation);
+      if (localPlayerId !== null && playersState.has(localPlayerId)) {
+          const p = playersState.get(localPlayerId);
+          // Position prédite (plus l'écart de correction en cours de résorption)
+          const view = predicted
+              ? { x: predicted.x + smoothX, z: predicted.z + smoothZ, orientation: predicted.orientation + smoothO }
+              : p;
+          camera.position.set(view.x, 5, view.z);
+          const lookX = view.x + 50 * Math.sin(view.orientation);
+          const lookZ = view.z + 50 * Math.cos(view.orientation);
           camera.lookAt(lookX, 5, lookZ);
   
           document.getElementById("roleLabel").textContent = (p.role === "zombie") ? "Zombie" : "Civil";
           document.getElementById("scoreLabel").textContent = p.score;
       }
+      updateTiles(camera.position.x, camera.position.z);
   
       renderer.render(scene, camera);
   }
   
+  ////////////////////////////////////////
+  //   Synchronisation des modèles 3D   //
+  ////////////////////////////////////////
+  // Ne touche qu'aux joueurs du diff : removed sont partis, touched sont
+  // arrivés ou ont pu changer de rôle. O(taille du diff) par message.
+  function updatePlayerMeshes(removed, touched) {
+      removed.forEach(pid => {
+          const mesh = playersMeshes.get(pid);
+          if (mesh) {
+              releaseModel(mesh);
+              playersMeshes.delete(pid);
+          }
+      });
+      touched.forEach(pid => {
+          const p = playersState.get(pid);
+          if (!p) return;
+          let mesh = playersMeshes.get(pid);
+          if (mesh && mesh.userData.role === p.role) return;
+          // Nouveau joueur, ou civil devenu zombie : on change de modèle
+          if (mesh) releaseModel(mesh);
+          mesh = acquireModel(p.role);
+          playersMeshes.set(pid, mesh);
+          // Base du modèle à y = 0 ; animate() le déplace ensuite à chaque image
+          mesh.position.set(p.x, 0, p.z);
+      });
+  }
+
+  ////////////////////////////////////////
+  //        Protocole binaire           //
+  ////////////////////////////////////////
+  // Binaire par défaut ; ajouter ?proto=json à l'URL de la page pour déboguer en JSON
+  const useBinary = new URLSearchParams(location.search).get("proto") !== "json";
+  const MSG_ASSIGN = 1, MSG_KEYFRAME = 2, MSG_DELTA = 3;
+  const FLAG_GAME_OVER = 1;
+  const NO_TICK = 0xFFFFFFFF;
+  const HEADER_SIZE = 16, RECORD_SIZE = 20;
+  const INPUT_RESYNC = 5, INPUT_STATE = 6;
+
+  function readRecord(view, off) {
+      return {
+          id: view.getUint16(off, true),
+          role: view.getUint8(off + 2) ? "zombie" : "civil",
+          x: view.getFloat32(off + 4, true),
+          y: 0,
+          z: view.getFloat32(off + 8, true),
+          orientation: view.getFloat32(off + 12, true),
+          score: view.getInt32(off + 16, true),
+      };
+  }
+
+  // Traduit un message binaire dans la même forme que les messages JSON
+  function decodeBinary(buffer) {
+      const view = new DataView(buffer);
+      const type = view.getUint8(0);
+      if (type === MSG_ASSIGN) {
+          const token = Array.from(new Uint8Array(buffer, 15, 16), b => b.toString(16).padStart(2, "0")).join("");
+          return { type: "assign_id", player_id: view.getUint16(1, true),
+                   tick_rate: view.getFloat32(3, true), move_speed: view.getFloat32(7, true),
+                   rot_speed: view.getFloat32(11, true), token: token };
+      }
+      const flags = view.getUint8(1);
+      const tick = view.getUint32(2, true);
+      const base = view.getUint32(6, true);
+      const n1 = view.getUint16(10, true), n2 = view.getUint16(12, true), n3 = view.getUint16(14, true);
+      const data = { tick: tick };
+      if (flags & FLAG_GAME_OVER) data.gameOver = "ZOMBIES WON";
+      let off = HEADER_SIZE;
+      const records = (n) => {
+          const out = new Array(n);
+          for (let i = 0; i < n; i++, off += RECORD_SIZE) out[i] = readRecord(view, off);
+          return out;
+      };
+      if (type === MSG_KEYFRAME) {
+          data.type = "keyframe";
+          data.players = records(n1);
+      } else if (type === MSG_DELTA) {
+          data.type = "delta";
+          data.base = (base === NO_TICK) ? null : base;
+          data.joins = records(n1);
+          data.leaves = new Array(n2);
+          for (let i = 0; i < n2; i++, off += 2) data.leaves[i] = view.getUint16(off, true);
+          data.updates = records(n3);
+      }
+      // Accusé des entrées propre à ce client, à la fin du message
+      if (off + 8 <= buffer.byteLength) {
+          data.ack = [view.getUint32(off, true), view.getUint32(off + 4, true)];
+      }
+      return data;
+  }
+
+  function sendResync(ws) {
+      if (ws.readyState !== WebSocket.OPEN) return;
+      ws.send(useBinary ? new Uint8Array([INPUT_RESYNC]) : JSON.stringify({ type: "resync" }));
+  }
+
+  ////////////////////////////////////////
+  //        Entrées clavier             //
+  ////////////////////////////////////////
+  // Le client envoie l'état des touches tenues, jamais un message par keydown :
+  // au plus un message par image, et seulement quand le masque change.
+  const KEY_BITS = { ArrowLeft: 1, ArrowRight: 2, ArrowUp: 4, ArrowDown: 8 };
+  let heldKeys = 0;
+  // Touches enfoncées depuis le dernier envoi (un appui bref doit partir au moins une fois)
+  let tappedKeys = 0;
+  let sentKeys = 0;
+  let inputSeq = 0;
+  let gameSocket = null;
+
+  document.addEventListener("keydown", (event) => {
+      const bit = KEY_BITS[event.key];
+      if (!bit) return;
+      event.preventDefault();
+      heldKeys |= bit;
+      tappedKeys |= bit;
+  });
+  document.addEventListener("keyup", (event) => {
+      const bit = KEY_BITS[event.key];
+      if (bit) heldKeys &= ~bit;
+  });
+  // Fenêtre quittée : les keyup ne nous parviendront pas
+  window.addEventListener("blur", () => { heldKeys = 0; });
+
+  function flushInput() {
+      const ws = gameSocket;
+      if (!ws || ws.readyState !== WebSocket.OPEN) return;
+      const keys = heldKeys | tappedKeys;
+      tappedKeys = 0;
+      if (keys === sentKeys) return;
+      sentKeys = keys;
+      inputSeq = (inputSeq + 1) >>> 0;
+      rememberInput(inputSeq, keys);
+      if (useBinary) {
+          const buf = new DataView(new ArrayBuffer(6));
+          buf.setUint8(0, INPUT_STATE);
+          buf.setUint8(1, keys);
+          buf.setUint32(2, inputSeq, true);
+          ws.send(buf.buffer);
+      } else {
+          ws.send(JSON.stringify({ type: "input", keys: keys, seq: inputSeq }));
+      }
+  }
+
+  ////////////////////////////////////////
+  //   Prédiction et interpolation      //
+  ////////////////////////////////////////
+  // Le joueur local est simulé ici avec les règles du serveur (touches tenues,
+  // vitesses par seconde) puis réconcilié avec l'état autoritaire grâce à
+  // l'accusé [séquence, ticks] de chaque snapshot. Les autres joueurs sont
+  // interpolés entre snapshots, affichés avec un léger retard.
+  let tickRate = 20, moveSpeed = 60, rotSpeed = 3;
+  // Entrées non confirmées : {seq, keys, start, end} (end null pour l'état courant)
+  let pendingInputs = [];
+  let predicted = null;
+  // Écart visuel après une correction, résorbé en quelques images
+  let smoothX = 0, smoothZ = 0, smoothO = 0;
+  // Positions récentes des autres joueurs, datées en temps serveur
+  let history = new Map();
+  let clockOffset = null;
+  let lastFrame = null;
+  const CELL_SIZE = 20;
+
+  function nowSeconds() { return performance.now() / 1000; }
+  function interpDelay() { return Math.max(0.1, 2 / tickRate); }
+  function wrapAngle(a) { return Math.atan2(Math.sin(a), Math.cos(a)); }
+
+  // Grille des immeubles d'une tuile au détail complet, pour ne pas prédire
+  // à travers les murs (le joueur est toujours dans une telle tuile)
+  function indexBuildings(boxes, ti, tj) {
+      const n = Math.ceil(cityInfo.tileSize / CELL_SIZE);
+      const x0 = ti * cityInfo.tileSize, z0 = tj * cityInfo.tileSize;
+      const cells = new Array(n * n);
+      const clampCell = (v) => Math.min(n - 1, Math.max(0, Math.floor(v / CELL_SIZE)));
+      boxes.forEach(b => {
+          const box = [b.x - b.width / 2, b.x + b.width / 2, b.z - b.depth / 2, b.z + b.depth / 2];
+          for (let i = clampCell(box[0] - x0); i <= clampCell(box[1] - x0); i++) {
+              for (let j = clampCell(box[2] - z0); j <= clampCell(box[3] - z0); j++) {
+                  (cells[i * n + j] ||= []).push(box);
+              }
+          }
+      });
+      return cells;
+  }
+
+  function insideBuilding(x, z) {
+      if (!cityInfo) return false;
+      const tileSize = cityInfo.tileSize;
+      const tile = tiles.get(Math.floor(x / tileSize) + "," + Math.floor(z / tileSize));
+      if (!tile || !tile.cells) return false;
+      const n = Math.ceil(tileSize / CELL_SIZE);
+      const i = Math.floor((x - tile.i * tileSize) / CELL_SIZE);
+      const j = Math.floor((z - tile.j * tileSize) / CELL_SIZE);
+      const boxes = tile.cells[i * n + j];
+      return !!boxes && boxes.some(b => x >= b[0] && x <= b[1] && z >= b[2] && z <= b[3]);
+  }
+
+  // Même intégration que Room.apply_input, par pas d'au plus un tick
+  function integrate(state, keys, duration) {
+      const turn = ((keys & 1) ? 1 : 0) - ((keys & 2) ? 1 : 0);
+      const walk = ((keys & 4) ? 1 : 0) - ((keys & 8) ? 1 : 0);
+      if (!turn && !walk) return;
+      while (duration > 1e-6) {
+          const dt = Math.min(duration, 1 / tickRate);
+          duration -= dt;
+          state.orientation += turn * rotSpeed * dt;
+          if (!walk) continue;
+          const d = walk * moveSpeed * dt;
+          const x = state.x + d * Math.sin(state.orientation);
+          const z = state.z + d * Math.cos(state.orientation);
+          if (!insideBuilding(x, z) && !insideBuilding((x + state.x) / 2, (z + state.z) / 2)) {
+              state.x = x;
+              state.z = z;
+          }
+      }
+  }
+
+  function rememberInput(seq, keys) {
+      const now = nowSeconds();
+      const last = pendingInputs[pendingInputs.length - 1];
+      if (last) last.end = now;
+      pendingInputs.push({ seq: seq, keys: keys, start: now, end: null });
+      if (pendingInputs.length > 256) pendingInputs.shift();
+  }
+
+  // Repart de l'état autoritaire et rejoue les entrées que le serveur n'a pas (entièrement) appliquées
+  function reconcile(p, ack) {
+      const [ackSeq, ackTicks] = ack;
+      pendingInputs = pendingInputs.filter(input => input.seq >= ackSeq);
+      const state = { x: p.x, z: p.z, orientation: p.orientation };
+      const now = nowSeconds();
+      pendingInputs.forEach(input => {
+          let duration = (input.end === null ? now : input.end) - input.start;
+          if (input.seq === ackSeq) duration = Math.max(0, duration - ackTicks / tickRate);
+          integrate(state, input.keys, duration);
+      });
+      if (predicted) {
+          smoothX += predicted.x - state.x;
+          smoothZ += predicted.z - state.z;
+          smoothO += wrapAngle(predicted.orientation - state.orientation);
+      }
+      predicted = state;
+  }
+
+  // Appelée après chaque snapshot appliqué, avec les ids qu'il a modifiés
+  function recordHistory(data, changed) {
+      const serverTime = data.tick / tickRate;
+      const now = nowSeconds();
+      const offset = serverTime - now;
+      // Un snapshot arrivé plus tôt que prévu recale l'horloge, sinon on dérive lentement
+      if (clockOffset === null || offset > clockOffset) clockOffset = offset;
+      else clockOffset += 0.05 * (offset - clockOffset);
+      if (data.type === "keyframe") {
+          for (const pid of history.keys()) {
+              if (!playersState.has(pid)) history.delete(pid);
+          }
+      } else {
+          data.leaves.forEach(pid => { history.delete(pid); });
+      }
+      changed.forEach(pid => {
+          const p = playersState.get(pid);
+          if (!p) return;
+          let buf = history.get(pid);
+          if (!buf) history.set(pid, buf = []);
+          const last = buf[buf.length - 1];
+          // Immobile jusqu'au tick précédent : sans ce point on glisserait sur tout l'intervalle
+          if (last && last.t < serverTime - 1.5 / tickRate) {
+              buf.push({ t: serverTime - 1 / tickRate, x: last.x, z: last.z });
+          }
+          buf.push({ t: serverTime, x: p.x, z: p.z });
+          if (buf.length > 8) buf.splice(0, buf.length - 8);
+      });
+      if (data.ack && localPlayerId !== null && playersState.has(localPlayerId)) {
+          reconcile(playersState.get(localPlayerId), data.ack);
+      }
+  }
+
+  function sampleHistory(buf, t) {
+      if (t <= buf[0].t) return buf[0];
+      for (let i = buf.length - 1; i > 0; i--) {
+          const a = buf[i - 1], b = buf[i];
+          if (t >= a.t) {
+              if (t >= b.t) return b;
+              const k = (t - a.t) / (b.t - a.t);
+              return { x: a.x + (b.x - a.x) * k, z: a.z + (b.z - a.z) * k };
+          }
+      }
+      return buf[buf.length - 1];
+  }
+
+  // Positionne les modèles à chaque image : prédiction pour soi, interpolation pour les autres
+  function positionPlayerMeshes(frameDt) {
+      if (predicted) {
+          integrate(predicted, sentKeys, frameDt);
+          const decay = Math.exp(-10 * frameDt);
+          smoothX *= decay; smoothZ *= decay; smoothO *= decay;
+      }
+      const renderTime = nowSeconds() + (clockOffset || 0) - interpDelay();
+      playersMeshes.forEach((mesh, pid) => {
+          if (predicted && pid === localPlayerId) {
+              mesh.position.set(predicted.x + smoothX, 0, predicted.z + smoothZ);
+              return;
+          }
+          const buf = history.get(pid);
+          const p = buf && buf.length ? sampleHistory(buf, renderTime) : playersState.get(pid);
+          if (p) mesh.position.set(p.x, 0, p.z);
+      });
+  }
+
   ////////////////////////////////////////
   //     WebSocket / Multijoueur        //
   ////////////////////////////////////////
-  function initWebSocket() {
-      const ws = new WebSocket("ws://" + location.host + "/ws");
+  // Jeton de reprise : après un redémarrage du serveur (ou une coupure), le
+  // joueur retrouve sa salle, son rôle et son score. Gardé par onglet.
+  const RESUME_KEY = "zombieResume";
+  // Reconnexion : attente doublée à chaque échec, plafonnée, avec une part
+  // aléatoire pour que les clients ne reviennent pas tous ensemble
+  const RECONNECT_BASE = 1000, RECONNECT_MAX = 30000;
+  let reconnectAttempts = 0;
+
+  function savedResume() {
+      try {
+          return JSON.parse(sessionStorage.getItem(RESUME_KEY) || "null");
+      } catch (e) {
+          return null;
+      }
+  }
+
+  function showStatus(text) {
+      const message = document.getElementById("gameOverMessage");
+      message.innerText = text;
+      message.style.display = "block";
+  }
+
+  // Le serveur (ou le routeur) choisit la salle la moins chargée, ou redonne
+  // la sienne à un joueur qui revient
+  function joinRoom() {
+      const resume = savedResume();
+      return fetch(resume ? '/join?room=' + encodeURIComponent(resume.room) : '/join')
+        .then(response => {
+            if (!response.ok) throw new Error("/join : " + response.status);
+            return response.json();
+        });
+  }
+
+  function connect() {
+      joinRoom()
+        .then(room => {
+            if (!cityInfo) {
+                initScene(room);
+                animate();
+            } else if (room.city_hash !== cityInfo.hash) {
+                // Serveur redémarré sur une autre ville : page neuve, le jeton reste en sessionStorage
+                location.reload();
+                return;
+            } else {
+                resetSession();
+            }
+            initWebSocket(room);
+        })
+        .catch(scheduleReconnect);
+  }
+
+  function scheduleReconnect() {
+      const delay = Math.min(RECONNECT_MAX, RECONNECT_BASE * 2 ** reconnectAttempts);
+      reconnectAttempts++;
+      showStatus("Reconnexion...");
+      setTimeout(connect, delay * (0.5 + Math.random() / 2));
+  }
+
+  // Nouvelle socket, nouveau joueur côté serveur : rien de l'ancienne session ne vaut plus
+  function resetSession() {
+      localPlayerId = null;
+      lastTick = null;
+      resyncPending = false;
+      pendingInputs = [];
+      predicted = null;
+      sentKeys = 0;
+      history = new Map();
+      clockOffset = null;
+  }
+
+  function initWebSocket(room) {
+      const url = room.ws;
+      // Le routeur renvoie une URL absolue (autre processus), le serveur seul un chemin
+      const wsUrl = url.startsWith("ws") ? url : "ws://" + location.host + url;
+      const resume = savedResume();
+      const ws = new WebSocket(wsUrl + (useBinary ? "&proto=bin" : "")
+                               + (resume && resume.room === room.room ? "&resume=" + resume.token : ""));
+      ws.binaryType = "arraybuffer";
       ws.onopen = () => { console.log("Connecté au serveur WebSocket"); };
+      ws.onclose = (event) => {
+          if (gameSocket !== ws) return;
+          gameSocket = null;
+          if (event.code === 1008) {
+              // Expulsé pour lenteur : se reconnecter aussitôt ne ferait que recommencer
+              showStatus("Déconnecté : connexion trop lente");
+              return;
+          }
+          // Coupure, serveur qui redémarre (1012) ou saturé (1013) : le jeton
+          // fera reprendre la partie
+          scheduleReconnect();
+      };
       ws.onmessage = (event) => {
-          const data = JSON.parse(event.data);
+          const data = (typeof event.data === "string") ? JSON.parse(event.data) : decodeBinary(event.data);
           if (data.gameOver) {
               document.getElementById("gameOverMessage").style.display = "block";
               document.getElementById("gameOverMessage").innerText = data.gameOver;
@@ -371,56 +1050,59 @@ html_content = """
               document.getElementById("gameOverMessage").style.display = "none";
           }
           if (data.type === "assign_id") {
+              try {
+                  sessionStorage.setItem(RESUME_KEY, JSON.stringify({ room: room.room, token: data.token }));
+              } catch (e) {}
+              reconnectAttempts = 0;
               localPlayerId = data.player_id;
+              tickRate = data.tick_rate;
+              moveSpeed = data.move_speed;
+              rotSpeed = data.rot_speed;
               return;
           }
-          if (data.players) {
-              data.players.forEach(p => { playersState[p.id] = p; });
-              for (let pid in playersState) {
-                  if (!data.players.some(obj => obj.id === pid)) {
-                      delete playersState[pid];
+          let removed, touched;
+          if (data.type === "keyframe") {
+              // État complet : on repart de zéro
+              playersState = new Map();
+              data.players.forEach(p => { playersState.set(p.id, p); });
+              lastTick = data.tick;
+              resyncPending = false;
+              removed = [];
+              playersMeshes.forEach((mesh, pid) => { if (!playersState.has(pid)) removed.push(pid); });
+              touched = data.players.map(p => p.id);
+              recordHistory(data, touched);
+          } else if (data.type === "delta") {
+              if (data.base !== lastTick) {
+                  // Un delta manque : on demande une keyframe au serveur
+                  if (!resyncPending) {
+                      resyncPending = true;
+                      sendResync(ws);
                   }
+                  return;
               }
-              data.players.forEach(p => {
-                  let mesh = playersMeshes[p.id];
-                  if (!mesh) {
-                      if (p.role === "zombie") {
-                          mesh = createZombieModel();
-                      } else {
-                          mesh = createCivilianModel();
-                      }
-                      mesh.castShadow = true;
-                      playersMeshes[p.id] = mesh;
-                      scene.add(mesh);
-                  }
-                  // Positionner le modèle de façon à ce que la base soit à y = 0
-                  mesh.position.set(p.x, 0, p.z);
+              // Départs d'abord : un handle binaire libéré peut être réattribué au même tick
+              data.leaves.forEach(pid => { playersState.delete(pid); });
+              data.joins.forEach(p => { playersState.set(p.id, p); });
+              touched = data.joins.map(p => p.id);
+              data.updates.forEach(u => {
+                  const p = playersState.get(u.id);
+                  if (!p) return;
+                  if (u.role !== undefined && u.role !== p.role) touched.push(u.id);
+                  Object.assign(p, u);
               });
-              for (let pid in playersMeshes) {
-                  if (!data.players.some(obj => obj.id === pid)) {
-                      scene.remove(playersMeshes[pid]);
-                      delete playersMeshes[pid];
-                  }
-              }
+              lastTick = data.tick;
+              removed = data.leaves;
+              recordHistory(data, data.joins.map(p => p.id).concat(data.updates.map(u => u.id)));
+          } else {
+              return;
           }
+          updatePlayerMeshes(removed, touched);
       };
-      document.addEventListener("keydown", (event) => {
-          if (event.key === "ArrowLeft") {
-              ws.send(JSON.stringify({ type: "rotate_left" }));
-          } else if (event.key === "ArrowRight") {
-              ws.send(JSON.stringify({ type: "rotate_right" }));
-          } else if (event.key === "ArrowUp") {
-              ws.send(JSON.stringify({ type: "forward" }));
-          } else if (event.key === "ArrowDown") {
-              ws.send(JSON.stringify({ type: "backward" }));
-          }
-      });
+      gameSocket = ws;
   }
   
   // Initialisation
-  initScene();
-  initWebSocket();
-  animate();
+  connect();
   </script>
 </body>
 </html>
@@ -436,6 +1118,18 @@ def building_bounding_box(b):
     z_max = b["z"] + b["depth"] / 2
     return x_min, x_max, z_min, z_max
 
+# Routes : bandes de ±ROAD_HALF_WIDTH autour des lignes x et z multiples de ROAD_SPACING
+ROAD_SPACING = 40
+ROAD_HALF_WIDTH = 2
+
+def clear_of_roads(lo, hi):
+    """
+    Vrai si l'intervalle [lo, hi] ne touche aucune bande de route. La seule
+    ligne candidate est la plus grande ≤ hi + demi-largeur : test en O(1),
+    valable aussi bien sur des flottants que sur des tableaux NumPy.
+    """
+    return (hi + ROAD_HALF_WIDTH) // ROAD_SPACING * ROAD_SPACING < lo - ROAD_HALF_WIDTH
+
 def building_on_road(b):
     """
     Vérifie si la bounding box de l'immeuble intersecte une route.
@@ -443,196 +1137,3618 @@ def building_on_road(b):
     occupant une bande de ±2 unités autour de la position.
     """
     x_min, x_max, z_min, z_max = building_bounding_box(b)
-    road_half = 2
-    for r in range(0, 401, 40):
-        if not (x_max < r - road_half or x_min > r + road_half):
-            return True
-    for r in range(0, 401, 40):
-        if not (z_max < r - road_half or z_min > r + road_half):
-            return True
-    return False
+    return not (clear_of_roads(x_min, x_max) and clear_of_roads(z_min, z_max))
 
-def get_safe_spawn(city):
+def get_safe_spawn(grid, rng=random):
     """
-    Renvoie un (x, z) aléatoire dans 0..400 qui n'est pas dans la bounding box d'un immeuble.
+    Renvoie un (x, z) aléatoire dans la ville qui n'est pas dans la bounding box d'un immeuble.
     """
-    for _ in range(100):
-        x = random.uniform(0, 400)
-        z = random.uniform(0, 400)
-        collision = False
-        for b in city["buildings"]:
-            bx_min, bx_max, bz_min, bz_max = building_bounding_box(b)
-            if bx_min <= x <= bx_max and bz_min <= z <= bz_max:
-                collision = True
-                break
-        if not collision:
-            return x, z
-    return 200, 200
+    return grid.sample_free_point(rng)
 
 ##########################################################################
 #                        Génération de la ville                          #
 ##########################################################################
-def generate_city_layout():
-    """
-    Divise la zone 0..400 en une grille 20x20.
-    Dans chaque bloc de taille 20x20, on essaie jusqu'à 5 fois de placer un immeuble
-    dans une zone sûre (définie par une marge) et qui n'intersecte pas les routes.
-    La probabilité de placement dans chaque bloc est de 70%.
-    La hauteur des immeubles est tirée aléatoirement entre 10 et 50.
-    """
-    city = {"buildings": []}
-    grid_x = 20
-    grid_y = 20
-    block_size = 400 / grid_x  # 20 unités par bloc
-    margin = 2
-    placement_probability = 0.7
-    for i in range(grid_x):
-        for j in range(grid_y):
-            if random.random() < placement_probability:
-                placed = False
-                attempts = 0
-                while not placed and attempts < 5:
-                    attempts += 1
-                    width = random.uniform(2, block_size - 2 * margin)
-                    depth = random.uniform(2, block_size - 2 * margin)
-                    height = random.uniform(10, 50)
-                    safe_x_min = i * block_size + margin + width/2
-                    safe_x_max = (i + 1) * block_size - margin - width/2
-                    safe_z_min = j * block_size + margin + depth/2
-                    safe_z_max = (j + 1) * block_size - margin - depth/2
-                    if safe_x_min > safe_x_max or safe_z_min > safe_z_max:
-                        continue
-                    x = random.uniform(safe_x_min, safe_x_max)
-                    z = random.uniform(safe_z_min, safe_z_max)
-                    new_building = {"x": x, "z": z, "width": width, "depth": depth, "height": height}
-                    if building_on_road(new_building):
-                        continue
-                    city["buildings"].append(new_building)
-                    placed = True
-    return city
+CITY_SEED = int(os.environ["ZOMBIE_CITY_SEED"]) if os.environ.get("ZOMBIE_CITY_SEED") else None
+CITY_SIZE = int(os.environ.get("ZOMBIE_CITY_SIZE", "400"))
+CITY_BLOCK_SIZE = 20
+CITY_BLOCK_MARGIN = 2
+PLACEMENT_PROBABILITY = 0.7
+PLACEMENT_ATTEMPTS = 5
+# Tirages par bloc : le placement, puis largeur, profondeur, hauteur, x, z par essai
+DRAWS_PER_ATTEMPT = 5
+DRAWS_PER_BLOCK = 1 + PLACEMENT_ATTEMPTS * DRAWS_PER_ATTEMPT
+# Couleur d'immeuble : indice dans la palette pastel du client, tiré sur un flux
+# à part (clé dérivée) pour ne pas décaler les tirages de géométrie
+BUILDING_PALETTE_SIZE = 10
+_COLOR_SALT = 0xC010
+
+# Générateur à compteur (splitmix64) : le tirage n°k d'une graine ne dépend que
+# de (graine, k). Les blocs peuvent donc être tirés dans n'importe quel ordre,
+# en lot avec NumPy ou un par un en Python, avec exactement le même résultat.
+_MASK64 = (1 << 64) - 1
+_GOLDEN = 0x9E3779B97F4A7C15
+_MIX1 = 0xBF58476D1CE4E5B9
+_MIX2 = 0x94D049BB133111EB
+
+def _splitmix64(z):
+    z = (z ^ (z >> 30)) * _MIX1 & _MASK64
+    z = (z ^ (z >> 27)) * _MIX2 & _MASK64
+    return z ^ (z >> 31)
+
+def _uniform(key, counter):
+    """Flottant uniforme dans [0, 1) pour le tirage `counter` de la clé."""
+    return (_splitmix64((key + (counter + 1) * _GOLDEN) & _MASK64) >> 11) * 2.0 ** -53
+
+def _uniform_np(key, counters):
+    """Version NumPy de _uniform ; l'arithmétique uint64 boucle modulo 2**64."""
+    z = np.uint64(key) + (counters + np.uint64(1)) * np.uint64(_GOLDEN)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(_MIX1)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(_MIX2)
+    z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+def _candidate(i, j, u_width, u_depth, u_height, u_x, u_z):
+    """
+    Immeuble candidat du bloc (i, j) à partir de cinq tirages uniformes.
+    Mêmes opérations flottantes pour des scalaires ou des tableaux : les deux
+    chemins de generate_city_layout() produisent des villes identiques.
+    """
+    bs = CITY_BLOCK_SIZE
+    margin = CITY_BLOCK_MARGIN
+    width = 2 + (bs - 2 * margin - 2) * u_width
+    depth = 2 + (bs - 2 * margin - 2) * u_depth
+    height = 10 + 40 * u_height
+    safe_x_min = i * bs + margin + width / 2
+    safe_x_max = (i + 1) * bs - margin - width / 2
+    safe_z_min = j * bs + margin + depth / 2
+    safe_z_max = (j + 1) * bs - margin - depth / 2
+    x = safe_x_min + (safe_x_max - safe_x_min) * u_x
+    z = safe_z_min + (safe_z_max - safe_z_min) * u_z
+    valid = ((safe_x_min <= safe_x_max) & (safe_z_min <= safe_z_max)
+             & clear_of_roads(x - width / 2, x + width / 2)
+             & clear_of_roads(z - depth / 2, z + depth / 2))
+    return x, z, width, depth, height, valid
 
-city_layout = generate_city_layout()
+def generate_city_layout(seed=None, size=CITY_SIZE):
+    """
+    Divise la zone 0..size en blocs de 20x20.
+    Chaque bloc reçoit un immeuble avec une probabilité de 70%, au premier de
+    5 candidats qui tient dans la zone sûre du bloc (définie par une marge) et
+    n'intersecte pas les routes. La hauteur est tirée entre 10 et 50.
+    Une même graine donne toujours la même ville ; sans graine on en tire une.
+    """
+    if seed is None:
+        seed = int.from_bytes(os.urandom(4), "little")
+    key = _splitmix64(seed & _MASK64)
+    color_key = _splitmix64(key ^ _COLOR_SALT)
+    n = int(size // CITY_BLOCK_SIZE)
+    if np is not None:
+        buildings = _generate_buildings_numpy(key, color_key, n)
+    else:
+        buildings = _generate_buildings_python(key, color_key, n)
+    return {"seed": seed, "size": size, "buildings": buildings}
+
+def _generate_buildings_numpy(key, color_key, n):
+    """Tous les candidats de tous les blocs en un seul lot."""
+    blocks = np.arange(n * n, dtype=np.uint64)
+    base = blocks * np.uint64(DRAWS_PER_BLOCK)
+    placed = _uniform_np(key, base) < PLACEMENT_PROBABILITY
+    streams = np.arange(1, DRAWS_PER_BLOCK, dtype=np.uint64).reshape(PLACEMENT_ATTEMPTS, DRAWS_PER_ATTEMPT)
+    u = _uniform_np(key, base[:, None, None] + streams)
+    i = (blocks // np.uint64(n)).astype(np.float64)[:, None]
+    j = (blocks % np.uint64(n)).astype(np.float64)[:, None]
+    x, z, width, depth, height, valid = _candidate(i, j, *(u[..., k] for k in range(DRAWS_PER_ATTEMPT)))
+    # Premier essai valide de chaque bloc retenu
+    rows = np.nonzero(placed & valid.any(axis=1))[0]
+    first = valid[rows].argmax(axis=1)
+    columns = [a[rows, first].tolist() for a in (x, z, width, depth, height)]
+    colors = (_uniform_np(color_key, blocks[rows]) * BUILDING_PALETTE_SIZE).astype(np.int64).tolist()
+    return [{"x": bx, "z": bz, "width": bw, "depth": bd, "height": bh, "color": bc}
+            for bx, bz, bw, bd, bh, bc in zip(*columns, colors)]
+
+def _generate_buildings_python(key, color_key, n):
+    """Même tirage que la version NumPy, bloc par bloc."""
+    buildings = []
+    for block in range(n * n):
+        base = block * DRAWS_PER_BLOCK
+        if _uniform(key, base) >= PLACEMENT_PROBABILITY:
+            continue
+        i, j = divmod(block, n)
+        for attempt in range(PLACEMENT_ATTEMPTS):
+            counter = base + 1 + attempt * DRAWS_PER_ATTEMPT
+            x, z, width, depth, height, valid = _candidate(
+                i, j, *(_uniform(key, counter + k) for k in range(DRAWS_PER_ATTEMPT)))
+            if valid:
+                color = int(_uniform(color_key, block) * BUILDING_PALETTE_SIZE)
+                buildings.append({"x": x, "z": z, "width": width, "depth": depth,
+                                  "height": height, "color": color})
+                break
+    return buildings
 
 ##########################################################################
-#                        Logique multijoueur                             #
+#                    Index spatial des immeubles                         #
 ##########################################################################
-players = {}
+class CityGrid:
+    """
+    Grille uniforme alignée sur les blocs de 20 unités, construite une seule fois
+    à partir de generate_city_layout(). Chaque cellule contient les bounding boxes
+    des immeubles qui la recouvrent (en pratique au plus une ou deux), ce qui rend
+    les tests de point en O(1) et les tests de segment proportionnels au nombre
+    de cellules traversées.
+    """
+    def __init__(self, city, cell_size=20.0, size=None):
+        self.cell_size = cell_size
+        self.size = size if size is not None else city.get("size", 400)
+        # +1 pour inclure les points situés exactement sur le bord de la carte
+        self.cols = int(math.ceil(self.size / cell_size)) + 1
+        self.rows = self.cols
+        cells = [None] * (self.cols * self.rows)
+        for b in city["buildings"]:
+            box = building_bounding_box(b)
+            i_min, j_min = self._cell(box[0], box[2])
+            i_max, j_max = self._cell(box[1], box[3])
+            for i in range(max(i_min, 0), min(i_max, self.cols - 1) + 1):
+                for j in range(max(j_min, 0), min(j_max, self.rows - 1) + 1):
+                    k = i * self.rows + j
+                    if cells[k] is None:
+                        cells[k] = []
+                    cells[k].append(box)
+        self.cells = [tuple(c) if c else () for c in cells]
+        # Cellules entièrement libres, utilisées en dernier recours pour le spawn
+        self.free_cells = [k for k, c in enumerate(self.cells) if not c
+                           and (k // self.rows + 1) * cell_size <= self.size
+                           and (k % self.rows + 1) * cell_size <= self.size]
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-    async def broadcast(self, message: str):
-        for conn in self.active_connections:
-            await conn.send_text(message)
+    def _cell(self, x, z):
+        return int(x // self.cell_size), int(z // self.cell_size)
+
+    def _boxes(self, i, j):
+        if 0 <= i < self.cols and 0 <= j < self.rows:
+            return self.cells[i * self.rows + j]
+        return ()
 
-manager = ConnectionManager()
+    def contains(self, x, z):
+        """Vrai si le point (x, z) est dans la bounding box d'un immeuble."""
+        i, j = self._cell(x, z)
+        for x_min, x_max, z_min, z_max in self._boxes(i, j):
+            if x_min <= x <= x_max and z_min <= z <= z_max:
+                return True
+        return False
 
-def check_collision_zombie(p1, p2, threshold=5.0):
-    dx = p1["x"] - p2["x"]
-    dz = p1["z"] - p2["z"]
-    return math.sqrt(dx*dx + dz*dz) < threshold
+    def segment_blocked(self, x0, z0, x1, z1):
+        """
+        Vrai si le segment (x0, z0) -> (x1, z1) touche un immeuble.
+        Les cellules traversées sont parcourues par DDA (Amanatides & Woo).
+        """
+        dx = x1 - x0
+        dz = z1 - z0
+        i, j = self._cell(x0, z0)
+        i_end, j_end = self._cell(x1, z1)
+        step_i = 1 if dx > 0 else -1
+        step_j = 1 if dz > 0 else -1
+        cs = self.cell_size
+        t_max_x = ((i + (step_i > 0)) * cs - x0) / dx if dx else math.inf
+        t_max_z = ((j + (step_j > 0)) * cs - z0) / dz if dz else math.inf
+        t_delta_x = cs / abs(dx) if dx else math.inf
+        t_delta_z = cs / abs(dz) if dz else math.inf
+        for _ in range(abs(i_end - i) + abs(j_end - j) + 1):
+            for box in self._boxes(i, j):
+                if _segment_hits_box(x0, z0, dx, dz, box):
+                    return True
+            if t_max_x < t_max_z:
+                i += step_i
+                t_max_x += t_delta_x
+            else:
+                j += step_j
+                t_max_z += t_delta_z
+        return False
 
-async def broadcast_game_state():
-    state = {"players": list(players.values())}
-    if state["players"] and all(p["role"] == "zombie" for p in state["players"]):
-        state["gameOver"] = "ZOMBIES WON"
-    await manager.broadcast(json.dumps(state))
+    def sample_free_point(self, rng=random, attempts=100):
+        """
+        Tire un point uniforme dans 0..size hors des immeubles.
+        Chaque essai coûte O(1) ; si la carte est trop dense on se rabat sur
+        une cellule entièrement libre.
+        """
+        for _ in range(attempts):
+            x = rng.uniform(0, self.size)
+            z = rng.uniform(0, self.size)
+            if not self.contains(x, z):
+                return x, z
+        if self.free_cells:
+            k = self.free_cells[int(rng.random() * len(self.free_cells))]
+            i, j = divmod(k, self.rows)
+            return ((i + rng.random()) * self.cell_size,
+                    (j + rng.random()) * self.cell_size)
+        return self.size / 2, self.size / 2
+
+def _segment_hits_box(x0, z0, dx, dz, box):
+    """Test segment / boîte alignée (méthode des slabs), bornes incluses."""
+    x_min, x_max, z_min, z_max = box
+    t0, t1 = 0.0, 1.0
+    for p, d, lo, hi in ((x0, dx, x_min, x_max), (z0, dz, z_min, z_max)):
+        if d == 0:
+            if p < lo or p > hi:
+                return False
+            continue
+        ta = (lo - p) / d
+        tb = (hi - p) / d
+        if ta > tb:
+            ta, tb = tb, ta
+        t0 = max(t0, ta)
+        t1 = min(t1, tb)
+        if t0 > t1:
+            return False
+    return True
 
 ##########################################################################
-#                           Routes FastAPI                               #
+#                        Diffusion de la ville                           #
 ##########################################################################
-@app.get("/")
-async def get_index():
-    return HTMLResponse(html_content)
+# En-tête du format binaire : magie, version, nombre d'immeubles, taille de la carte.
+# 16 octets pour que le tableau de float32 qui suit soit aligné côté client.
+CITY_MAGIC = b"ZCTY"
+CITY_FORMAT_VERSION = 2
+CITY_HEADER_STRUCT = struct.Struct("<4sHxxIf")
+# Un immeuble : x, z, largeur, profondeur, hauteur, indice de couleur
+CITY_BOX_STRUCT = struct.Struct("<fffffI")
+# Les URL publiées par /join contiennent le hash : le contenu ne change jamais
+CITY_CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+# Sans hash dans l'URL, le client doit revalider (304 si l'ETag correspond)
+CITY_CACHE_REVALIDATE = "public, no-cache"
+# Tuiles : côté multiple de l'espacement des routes, pour qu'aucun immeuble
+# (toujours entre deux routes) ne soit à cheval sur deux tuiles
+CITY_TILE_SIZE = max(ROAD_SPACING, int(os.environ.get("ZOMBIE_CITY_TILE", "200")) // ROAD_SPACING * ROAD_SPACING)
+CITY_TILE_MAGIC = b"ZTIL"
+CITY_TILE_FORMAT_VERSION = 2
+# En-tête d'une tuile : magie, version, niveau de détail, i, j, nombre de boîtes,
+# côté de la tuile, hash de la ville et sha256 des boîtes qui suivent (32 octets
+# chacun) : le client vérifie sa copie en cache avant de l'afficher
+CITY_TILE_HEADER_STRUCT = struct.Struct("<4sHBxHHIf32s32s")
+TILE_DETAIL_FULL = 0
+TILE_DETAIL_LOW = 1
 
-@app.get("/city")
-async def get_city():
-    return JSONResponse(city_layout)
+def negotiate_encoding(bodies, accept_encoding):
+    """Choisit la meilleure compression disponible et acceptée par le client."""
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip().lower())
+    for encoding in ("br", "gzip"):
+        if encoding in bodies and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
 
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
-    player_id = str(id(websocket))
-    # Probabilité initiale de zombie réduite à 5%
-    role = "zombie" if random.random() < 0.05 else "civil"
-    # Choisir une position de spawn sûre
-    spawn_x, spawn_z = get_safe_spawn(city_layout)
-    init_orientation = random.uniform(0, 2*math.pi)
-    players[player_id] = {
-        "id": player_id,
-        "role": role,
-        "x": spawn_x,
-        "y": 0,
-        "z": spawn_z,
-        "orientation": init_orientation,
-        "score": 0
-    }
-    await websocket.send_json({"type": "assign_id", "player_id": player_id})
-    await broadcast_game_state()
-    try:
-        while True:
-            data_text = await websocket.receive_text()
-            try:
-                data = json.loads(data_text)
-            except json.JSONDecodeError:
-                continue
-            player = players.get(player_id)
-            if not player:
-                continue
-  
-            old_x, old_z = player["x"], player["z"]
-            rot_speed = 0.1
-            move_speed = 2.0
-  
-            if data.get("type") == "rotate_left":
-                player["orientation"] += rot_speed
-            elif data.get("type") == "rotate_right":
-                player["orientation"] -= rot_speed
-            elif data.get("type") == "forward":
-                player["x"] += move_speed * math.sin(player["orientation"])
-                player["z"] += move_speed * math.cos(player["orientation"])
-            elif data.get("type") == "backward":
-                player["x"] -= move_speed * math.sin(player["orientation"])
-                player["z"] -= move_speed * math.cos(player["orientation"])
-  
-            # Empêcher le déplacement si collision avec un immeuble
-            if any(player["x"] >= b["x"] - b["width"]/2 and player["x"] <= b["x"] + b["width"]/2 and
-                   player["z"] >= b["z"] - b["depth"]/2 and player["z"] <= b["z"] + b["depth"]/2
-                   for b in city_layout["buildings"]):
-                player["x"] = old_x
-                player["z"] = old_z
-  
-            # Conversion zombie/civil avec probabilité de 5%
-            if player["role"] == "zombie":
-                for other in players.values():
-                    if other["role"] == "civil" and check_collision_zombie(player, other):
-                        if random.random() < 0.05:
-                            other["role"] = "zombie"
-                            player["score"] += 1
-            elif player["role"] == "civil":
-                for other in players.values():
-                    if other["role"] == "zombie" and check_collision_zombie(player, other):
-                        if random.random() < 0.05:
-                            other["score"] += 1
-                            player["role"] = "zombie"
-                            break
-  
-            await broadcast_game_state()
-  
-    except WebSocketDisconnect:
-        manager.disconnect(websocket)
-        if player_id in players:
-            del players[player_id]
-        await broadcast_game_state()
+class CityPayload:
+    """
+    Toutes les représentations de la ville, encodées une seule fois à la
+    création de la salle : JSON compact, binaire packé, et leurs variantes
+    gzip/brotli. Le hash (sha256 du binaire, forme canonique) sert d'ETag
+    et permet au client de vérifier la ville qu'il a en cache.
+    """
+    def __init__(self, city):
+        buildings = city["buildings"]
+        size = city.get("size", 400)
+        packed = bytearray(CITY_HEADER_STRUCT.size + CITY_BOX_STRUCT.size * len(buildings))
+        CITY_HEADER_STRUCT.pack_into(packed, 0, CITY_MAGIC, CITY_FORMAT_VERSION,
+                                     len(buildings), size)
+        offset = CITY_HEADER_STRUCT.size
+        for b in buildings:
+            CITY_BOX_STRUCT.pack_into(packed, offset, b["x"], b["z"],
+                                      b["width"], b["depth"], b["height"], b.get("color", 0))
+            offset += CITY_BOX_STRUCT.size
+        self.hash = hashlib.sha256(packed).hexdigest()
+        self.buildings = len(buildings)
+        text = json.dumps(city, separators=(",", ":")).encode()
+        # kind -> {encodage -> octets}
+        self.bodies = {"json": self._encodings(text), "bin": self._encodings(bytes(packed))}
+
+    @staticmethod
+    def _encodings(body):
+        # mtime=0 : la sortie gzip est déterministe, donc l'ETag aussi
+        encoded = {"identity": body, "gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            encoded["br"] = brotli.compress(body, quality=11)
+        return encoded
+
+    def etag(self, kind, encoding):
+        """ETag fort : chaque représentation (format + compression) a le sien."""
+        if encoding == "identity":
+            return f'"{self.hash}-{kind}"'
+        return f'"{self.hash}-{kind}-{encoding}"'
+
+    @staticmethod
+    def matches(if_none_match, etag):
+        """
+        Vrai si l'un des ETags envoyés par le client est exactement `etag`,
+        celui de la représentation servie (format et compression compris).
+        If-None-Match se compare en mode faible (RFC 9110) : seul le préfixe
+        W/ est ignoré, jamais une partie de l'étiquette.
+        """
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == etag:
+                return True
+        return False
+
+    def negotiate(self, kind, accept_encoding):
+        return negotiate_encoding(self.bodies[kind], accept_encoding)
+
+    def sizes(self):
+        return {kind: {enc: len(body) for enc, body in bodies.items()}
+                for kind, bodies in self.bodies.items()}
+
+class CityTiles:
+    """
+    Index des immeubles par tuile, construit une fois par ville. Les tuiles
+    sont encodées (binaire et compressions) à leur première demande puis
+    gardées : le travail suit la zone explorée, pas la taille de la carte.
+
+    Deux niveaux de détail : les immeubles tels quels, ou une boîte par îlot
+    (entre quatre routes) pour les tuiles lointaines.
+    """
+    def __init__(self, layout, city_hash, tile_size=CITY_TILE_SIZE):
+        self.hash = city_hash
+        self.tile_size = tile_size
+        self.size = layout.get("size", 400)
+        self.count = max(1, math.ceil(self.size / tile_size))
+        last = self.count - 1
+        self.index: dict[tuple[int, int], list] = {}
+        for b in layout["buildings"]:
+            key = (min(last, int(b["x"] // tile_size)), min(last, int(b["z"] // tile_size)))
+            self.index.setdefault(key, []).append(b)
+        # (i, j, détail) -> {encodage -> octets}
+        self._bodies: dict = {}
+
+    def contains(self, i, j):
+        return 0 <= i < self.count and 0 <= j < self.count
+
+    def boxes(self, i, j, detail):
+        """(x, z, largeur, profondeur, hauteur, couleur) des boîtes de la tuile."""
+        buildings = self.index.get((i, j), ())
+        if detail == TILE_DETAIL_FULL:
+            return [(b["x"], b["z"], b["width"], b["depth"], b["height"], b.get("color", 0))
+                    for b in buildings]
+        blocks: dict = {}
+        for b in buildings:
+            blocks.setdefault((int(b["x"] // ROAD_SPACING), int(b["z"] // ROAD_SPACING)), []).append(b)
+        boxes = []
+        for group in blocks.values():
+            # Emprise englobante, hauteur moyenne pondérée par la surface, couleur du plus gros immeuble
+            x_min = min(b["x"] - b["width"] / 2 for b in group)
+            x_max = max(b["x"] + b["width"] / 2 for b in group)
+            z_min = min(b["z"] - b["depth"] / 2 for b in group)
+            z_max = max(b["z"] + b["depth"] / 2 for b in group)
+            area = sum(b["width"] * b["depth"] for b in group)
+            height = sum(b["width"] * b["depth"] * b["height"] for b in group) / area
+            biggest = max(group, key=lambda b: b["width"] * b["depth"] * b["height"])
+            boxes.append(((x_min + x_max) / 2, (z_min + z_max) / 2, x_max - x_min, z_max - z_min,
+                          height, biggest.get("color", 0)))
+        return boxes
+
+    def bodies(self, i, j, detail):
+        key = (i, j, detail)
+        bodies = self._bodies.get(key)
+        if bodies is None:
+            boxes = self.boxes(i, j, detail)
+            packed = bytearray(CITY_TILE_HEADER_STRUCT.size + CITY_BOX_STRUCT.size * len(boxes))
+            offset = CITY_TILE_HEADER_STRUCT.size
+            for box in boxes:
+                CITY_BOX_STRUCT.pack_into(packed, offset, *box)
+                offset += CITY_BOX_STRUCT.size
+            digest = hashlib.sha256(memoryview(packed)[CITY_TILE_HEADER_STRUCT.size:]).digest()
+            CITY_TILE_HEADER_STRUCT.pack_into(packed, 0, CITY_TILE_MAGIC, CITY_TILE_FORMAT_VERSION,
+                                              detail, i, j, len(boxes), self.tile_size,
+                                              bytes.fromhex(self.hash), digest)
+            bodies = self._bodies[key] = CityPayload._encodings(bytes(packed))
+        return bodies
+
+    def etag(self, i, j, detail, encoding):
+        if encoding == "identity":
+            return f'"{self.hash}-t{i}.{j}.{detail}"'
+        return f'"{self.hash}-t{i}.{j}.{detail}-{encoding}"'
+
+class City:
+    """
+    Une ville et ses structures dérivées (index spatial, représentations
+    servies), construites une seule fois et partagées par toutes les salles.
+    """
+    def __init__(self, layout):
+        self.layout = layout
+        self.seed = layout.get("seed")
+        self.grid = CityGrid(layout)
+        self.payload = CityPayload(layout)
+        self.tiles = CityTiles(layout, self.payload.hash)
+        self._nav_grid = None
+
+    @property
+    def nav_grid(self):
+        """Grille de marche (NumPy), construite au premier besoin."""
+        if self._nav_grid is None:
+            self._nav_grid = NavGrid(self.layout)
+        return self._nav_grid
+
+##########################################################################
+#                        Stockage des joueurs                            #
+##########################################################################
+ROLE_CIVIL = 0
+ROLE_ZOMBIE = 1
+ROLE_NAMES = ("civil", "zombie")
+ROLE_CODES = {"civil": ROLE_CIVIL, "zombie": ROLE_ZOMBIE}
+
+class PlayerStore:
+    """
+    Joueurs d'une salle en structure de tableaux : x, z et orientation dans des
+    tableaux de flottants contigus, rôles dans un bytearray, scores dans un tableau
+    d'entiers. Les emplacements libérés sont recyclés par une free-list et l'indice
+    d'emplacement sert de handle dans le protocole binaire. Les compteurs de zombies
+    et de civils sont tenus à jour à chaque changement de rôle.
+    """
+    def __init__(self, capacity=64, limit=0x10000):
+        self.limit = limit
+        self.capacity = 0
+        self.x = array("d")
+        self.z = array("d")
+        self.orientation = array("d")
+        self.role = bytearray()
+        self.score = array("i")
+        # Touches tenues, touches vues depuis le dernier tick, dernière séquence reçue
+        self.keys = bytearray()
+        self.taps = bytearray()
+        self.input_seq = array("I")
+        # Ticks simulés avec l'état de touches `input_seq` (accusé renvoyé au client)
+        self.input_ticks = array("I")
+        self.ids: list = []
+        self.free: list[int] = []
+        # id joueur -> emplacement, dans l'ordre d'arrivée
+        self.slot_of: dict = {}
+        self.zombies = 0
+        self.civilians = 0
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        capacity = min(capacity, self.limit)
+        extra = capacity - self.capacity
+        if extra <= 0:
+            raise RuntimeError("plus d'emplacement joueur disponible")
+        self.x.extend(array("d", bytes(8 * extra)))
+        self.z.extend(array("d", bytes(8 * extra)))
+        self.orientation.extend(array("d", bytes(8 * extra)))
+        self.role.extend(bytes(extra))
+        self.score.extend(array("i", bytes(4 * extra)))
+        self.keys.extend(bytes(extra))
+        self.taps.extend(bytes(extra))
+        self.input_seq.extend(array("I", bytes(4 * extra)))
+        self.input_ticks.extend(array("I", bytes(4 * extra)))
+        self.ids.extend([None] * extra)
+        # pop() rend d'abord les plus petits emplacements
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __contains__(self, player_id):
+        return player_id in self.slot_of
+
+    def slots(self):
+        return self.slot_of.values()
+
+    def add(self, player_id, role, x, z, orientation):
+        if not self.free:
+            self._grow(2 * self.capacity)
+        slot = self.free.pop()
+        self.ids[slot] = player_id
+        self.slot_of[player_id] = slot
+        self.x[slot] = x
+        self.z[slot] = z
+        self.orientation[slot] = orientation
+        self.score[slot] = 0
+        self.keys[slot] = 0
+        self.taps[slot] = 0
+        self.input_seq[slot] = 0
+        self.input_ticks[slot] = 0
+        self.role[slot] = role
+        if role == ROLE_ZOMBIE:
+            self.zombies += 1
+        else:
+            self.civilians += 1
+        return slot
+
+    def remove(self, player_id):
+        slot = self.slot_of.pop(player_id, None)
+        if slot is None:
+            return None
+        if self.role[slot] == ROLE_ZOMBIE:
+            self.zombies -= 1
+        else:
+            self.civilians -= 1
+        self.ids[slot] = None
+        self.free.append(slot)
+        return slot
+
+    def set_role(self, slot, role):
+        if self.role[slot] == role:
+            return
+        if role == ROLE_ZOMBIE:
+            self.zombies += 1
+            self.civilians -= 1
+        else:
+            self.zombies -= 1
+            self.civilians += 1
+        self.role[slot] = role
+
+    def game_over(self):
+        """Tous les joueurs sont des zombies : O(1) grâce aux compteurs."""
+        return self.civilians == 0 and self.zombies > 0
+
+##########################################################################
+#                   Broad-phase de proximité des joueurs                 #
+##########################################################################
+INFECTION_RADIUS = 5.0
+
+class BroadPhase(ABC):
+    """
+    Interface commune des structures de broad-phase sur les positions des joueurs.
+    query() renvoie un sur-ensemble des clés situées à moins de `radius` du point ;
+    le test exact (narrow phase) reste à la charge de l'appelant.
+    """
+    @abstractmethod
+    def insert(self, key, x, z): ...
+    @abstractmethod
+    def move(self, key, x, z): ...
+    @abstractmethod
+    def remove(self, key): ...
+    @abstractmethod
+    def query(self, x, z, radius): ...
+
+class BruteForceBroadPhase(BroadPhase):
+    """Aucun filtrage : tous les joueurs sont candidats (ZOMBIE_BROAD_PHASE=brute)."""
+    def __init__(self):
+        self.keys = {}
+    def insert(self, key, x, z):
+        self.keys[key] = None
+    def move(self, key, x, z):
+        pass
+    def remove(self, key):
+        self.keys.pop(key, None)
+    def query(self, x, z, radius):
+        return list(self.keys)
+
+class SpatialHash(BroadPhase):
+    """
+    Hachage spatial à cellules carrées de `cell_size`, mis à jour de façon incrémentale :
+    un déplacement ne touche les cellules que si le joueur change de case.
+    Avec cell_size égal au seuil de contact, une requête ne visite que 3x3 cellules.
+    """
+    def __init__(self, cell_size=INFECTION_RADIUS):
+        self.cell_size = cell_size
+        self.cells: dict[tuple, dict] = {}
+        self.key_cells: dict = {}
+
+    def _cell(self, x, z):
+        return int(x // self.cell_size), int(z // self.cell_size)
+
+    def insert(self, key, x, z):
+        cell = self._cell(x, z)
+        self.key_cells[key] = cell
+        self.cells.setdefault(cell, {})[key] = None
+
+    def move(self, key, x, z):
+        cell = self._cell(x, z)
+        old = self.key_cells.get(key)
+        if old == cell:
+            return
+        if old is not None:
+            self._discard(key, old)
+        self.key_cells[key] = cell
+        self.cells.setdefault(cell, {})[key] = None
+
+    def remove(self, key):
+        old = self.key_cells.pop(key, None)
+        if old is not None:
+            self._discard(key, old)
+
+    def _discard(self, key, cell):
+        bucket = self.cells[cell]
+        del bucket[key]
+        if not bucket:
+            del self.cells[cell]
+
+    def query(self, x, z, radius):
+        i_min, j_min = self._cell(x - radius, z - radius)
+        i_max, j_max = self._cell(x + radius, z + radius)
+        found = []
+        for i in range(i_min, i_max + 1):
+            for j in range(j_min, j_max + 1):
+                bucket = self.cells.get((i, j))
+                if bucket:
+                    found.extend(bucket)
+        return found
+
+BROAD_PHASES = {
+    "hash": SpatialHash,
+    "brute": BruteForceBroadPhase,
+}
+
+def make_broad_phase(name):
+    try:
+        return BROAD_PHASES[name]()
+    except KeyError:
+        raise ValueError(f"broad-phase inconnue : {name!r} (choix : {', '.join(BROAD_PHASES)})")
+
+BROAD_PHASE = os.environ.get("ZOMBIE_BROAD_PHASE", "hash")
+
+##########################################################################
+#                    Zone d'intérêt (interest management)                #
+##########################################################################
+# Rayon de visibilité d'un client (0 désactive le filtrage) ; le brouillard
+# FogExp2 du client rend les joueurs quasi invisibles au-delà de ~600 unités.
+AOI_RADIUS = float(os.environ.get("ZOMBIE_AOI_RADIUS", "600"))
+# Un joueur visible ne disparaît qu'au-delà de AOI_RADIUS * AOI_HYSTERESIS
+AOI_HYSTERESIS = float(os.environ.get("ZOMBIE_AOI_HYSTERESIS", "1.2"))
+
+class InterestManager:
+    """
+    Construit pour chaque client un snapshot limité aux joueurs proches de lui.
+    Un hachage spatial à grosses cellules (moitié du rayon de sortie) borne chaque
+    requête à 5x5 cellules : construire N snapshots filtrés reste proche de O(N).
+    """
+    def __init__(self, store, radius=AOI_RADIUS, hysteresis=AOI_HYSTERESIS):
+        self.store = store
+        self.radius = radius
+        self.leave_radius = radius * hysteresis
+        self.enabled = radius > 0
+        self.index = SpatialHash(cell_size=max(self.leave_radius / 2, 1.0))
+
+    def visible_set(self, center_id, known):
+        """
+        Ids des joueurs visibles depuis center_id, avec hystérésis pour ceux déjà connus.
+        L'index est tenu par emplacement du PlayerStore ; les ensembles renvoyés sont
+        des ids, stables même quand un emplacement est réattribué.
+        """
+        store = self.store
+        center = store.slot_of.get(center_id)
+        if center is None:
+            return None
+        xs, zs, ids = store.x, store.z, store.ids
+        x, z = xs[center], zs[center]
+        enter2 = self.radius * self.radius
+        leave2 = self.leave_radius * self.leave_radius
+        visible = {center_id}
+        for slot in self.index.query(x, z, self.leave_radius):
+            dx = xs[slot] - x
+            dz = zs[slot] - z
+            d2 = dx*dx + dz*dz
+            if d2 < enter2 or (d2 < leave2 and ids[slot] in known):
+                visible.add(ids[slot])
+        return visible
+
+    def message_for(self, conn, snapshot, force_keyframe):
+        """
+        Message filtré pour un client, ou None si rien de visible n'a changé.
+        Les fragments par joueur sont encodés une seule fois par tick (voir Snapshot).
+        """
+        visible = self.visible_set(conn.client_id, conn.visible)
+        if visible is None:
+            return None
+        game_over = snapshot.game_over
+        if force_keyframe:
+            message = snapshot.keyframe_for(visible, conn.binary)
+        else:
+            known = conn.visible
+            changed = snapshot.changed
+            joins = [pid for pid in visible if pid not in known]
+            leaves = [pid for pid in known if pid not in visible]
+            updates = [pid for pid in visible if pid in changed and pid in known]
+            if not joins and not leaves and not updates and game_over == conn.game_over:
+                return None
+            message = snapshot.delta_for(conn.enqueued_tick, joins, leaves, updates, conn.binary)
+        conn.visible = visible
+        conn.game_over = game_over
+        return message
+
+##########################################################################
+#                              Métriques                                 #
+##########################################################################
+# Exposées au format texte Prometheus sur /metrics. Désactivées (ZOMBIE_METRICS=0),
+# chaque métrique est remplacée par NULL_METRIC : un appel de méthode vide sur le
+# chemin chaud, et les chronométrages sont sautés grâce à METRICS_ENABLED.
+METRICS_ENABLED = os.environ.get("ZOMBIE_METRICS", "1") != "0"
+
+def _label_text(names, values):
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.value = 0
+        self.children: dict = {}
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def labels(self, *values):
+        """Compteur fils ; à résoudre une fois hors du chemin chaud."""
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = Counter(self.name, self.help)
+        return child
+
+    def samples(self):
+        if not self.labelnames:
+            yield self.name, "", self.value
+        for values, child in self.children.items():
+            yield self.name, _label_text(self.labelnames, values), child.value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # Une case par borne, plus +Inf ; cumulées seulement à l'export
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            yield self.name + "_bucket", f'{{le="{float(bound)!r}"}}', cumulative
+        yield self.name + "_bucket", '{le="+Inf"}', self.count
+        yield self.name + "_sum", "", self.sum
+        yield self.name + "_count", "", self.count
+
+class Gauge:
+    """Jauge lue au moment de l'export : read() renvoie des (valeurs d'étiquettes, valeur)."""
+    kind = "gauge"
+
+    def __init__(self, name, help, read, labelnames=()):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labelnames = labelnames
+
+    def samples(self):
+        for values, value in self.read():
+            yield self.name, _label_text(self.labelnames, values) if values else "", value
+
+class NullMetric:
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def labels(self, *values):
+        return self
+
+NULL_METRIC = NullMetric()
+
+class MetricsRegistry:
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.metrics: list = []
+
+    def _register(self, metric):
+        if not self.enabled:
+            return NULL_METRIC
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, buckets):
+        return self._register(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, read, labelnames=()):
+        return self._register(Gauge(name, help, read, labelnames))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+CONNECTIONS_TOTAL = metrics.counter("zombie_connections_total", "Connexions WebSocket acceptées")
+DISCONNECTS = metrics.counter("zombie_disconnects_total", "Déconnexions par cause", ("reason",))
+DISCONNECTS_CLIENT = DISCONNECTS.labels("client")
+DISCONNECTS_BACKPRESSURE = DISCONNECTS.labels("backpressure")
+INBOUND_MESSAGES = metrics.counter("zombie_inbound_messages_total", "Messages reçus par type", ("type",))
+INBOUND_INPUT = INBOUND_MESSAGES.labels("input")
+INBOUND_RESYNC = INBOUND_MESSAGES.labels("resync")
+INBOUND_INVALID = INBOUND_MESSAGES.labels("invalid")
+JSON_DECODE_ERRORS = metrics.counter("zombie_json_decode_errors_total", "Messages JSON illisibles")
+INPUTS_LIMITED = metrics.counter("zombie_inputs_rate_limited_total", "Entrées fusionnées (débit dépassé)")
+MESSAGES_DROPPED = metrics.counter("zombie_messages_dropped_total", "États jetés par délestage")
+COLLISION_CHECKS = metrics.counter("zombie_collision_checks_total", "Candidats testés par la narrow phase")
+INFECTION_ROLLS = metrics.counter("zombie_infection_rolls_total", "Contacts zombie/civil tirés au sort")
+INFECTIONS = metrics.counter("zombie_infections_total", "Civils transformés en zombies")
+TICK_SECONDS = metrics.histogram("zombie_tick_seconds", "Durée d'un tick de simulation", LATENCY_BUCKETS)
+TICK_OVERRUNS = metrics.counter("zombie_tick_overruns_total", "Ticks ayant dépassé leur budget")
+SNAPSHOT_BUILD_SECONDS = metrics.histogram("zombie_snapshot_build_seconds",
+                                           "Calcul du diff d'un snapshot", LATENCY_BUCKETS)
+BROADCAST_SERIALIZE_SECONDS = metrics.histogram("zombie_broadcast_serialize_seconds",
+                                                "Sérialisation et mise en file d'une diffusion", LATENCY_BUCKETS)
+BROADCAST_BYTES = metrics.histogram("zombie_broadcast_bytes", "Octets mis en file par diffusion", SIZE_BUCKETS)
+SEND_LATENCY = metrics.histogram("zombie_send_latency_seconds",
+                                 "Délai entre mise en file et fin d'envoi", LATENCY_BUCKETS)
+EVENT_LOOP_LAG = metrics.histogram("zombie_event_loop_lag_seconds",
+                                   "Retard de réveil de la boucle asyncio", LATENCY_BUCKETS)
+EVENT_LOOP_STALLS = metrics.counter("zombie_event_loop_stalls_total", "Blocages de la boucle au-delà du seuil")
+
+##########################################################################
+#                        Logique multijoueur                             #
+##########################################################################
+SEND_QUEUE_SIZE = int(os.environ.get("ZOMBIE_SEND_QUEUE_SIZE", "8"))
+# "latest" : on jette les états en attente pour ne garder que le plus récent
+# "disconnect" : idem, mais un client dont l'envoi est bloqué depuis plus de MAX_CLIENT_LAG secondes est déconnecté
+BACKPRESSURE_POLICY = os.environ.get("ZOMBIE_BACKPRESSURE", "latest")
+MAX_CLIENT_LAG = float(os.environ.get("ZOMBIE_MAX_CLIENT_LAG", "5.0"))
+# Débit d'entrées par connexion (seau à jetons) : au-delà, les messages sont fusionnés
+INPUT_RATE = float(os.environ.get("ZOMBIE_INPUT_RATE", "30"))
+INPUT_BURST = float(os.environ.get("ZOMBIE_INPUT_BURST", "10"))
+
+class ClientConnection:
+    """
+    Une socket cliente avec sa file d'envoi bornée et sa tâche d'écriture dédiée,
+    pour qu'un client lent ne retarde jamais les autres.
+    """
+    def __init__(self, websocket: WebSocket, client_id, queue_size=SEND_QUEUE_SIZE, binary=False):
+        self.websocket = websocket
+        self.client_id = client_id
+        # Protocole négocié à la connexion : binaire compact ou JSON (débogage)
+        self.binary = binary
+        self.queue_size = queue_size
+        self.pending: deque = deque()
+        self.wakeup = asyncio.Event()
+        self.writer: asyncio.Task | None = None
+        self.closed = False
+        # Tick du dernier snapshot mis en file pour ce client (None : il doit
+        # recevoir une keyframe). Ce n'est pas un accusé de réception : les deltas
+        # suivants supposent que ce snapshot lui parviendra. Un délestage dans la
+        # file remet ce tick à None ; toute autre perte est détectée par le client
+        # (base du delta différente de son dernier tick) qui demande un resync.
+        self.enqueued_tick = None
+        # Joueurs connus du client et dernier état de fin de partie envoyé (zone d'intérêt)
+        self.visible: set = set()
+        self.game_over = None
+        self.send_started = None
+        self.input_tokens = INPUT_BURST
+        self.input_stamp = time.monotonic()
+        self.inputs = 0
+        self.inputs_limited = 0
+        self.sent = 0
+        self.dropped = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def full(self):
+        return len(self.pending) >= self.queue_size
+
+    def allow_input(self, rate=INPUT_RATE, burst=INPUT_BURST):
+        """Seau à jetons : vrai si ce message d'entrée tient dans le débit autorisé."""
+        now = time.monotonic()
+        self.input_tokens = min(burst, self.input_tokens + (now - self.input_stamp) * rate)
+        self.input_stamp = now
+        self.inputs += 1
+        if self.input_tokens >= 1:
+            self.input_tokens -= 1
+            return True
+        self.inputs_limited += 1
+        INPUTS_LIMITED.inc()
+        return False
+
+    def offer(self, message, policy=BACKPRESSURE_POLICY, max_lag=MAX_CLIENT_LAG, droppable=True):
+        """
+        Met un message en file sans jamais bloquer.
+        Les messages non jetables (attribution d'id, etc.) survivent au délestage.
+        Renvoie False si le client doit être déconnecté.
+        """
+        if self.closed:
+            return False
+        now = time.perf_counter()
+        if policy == "disconnect" and self.lag(now) > max_lag:
+            return False
+        if self.full():
+            # Les états en attente sont périmés : on ne garde que le plus récent
+            kept = deque(item for item in self.pending if not item[2])
+            self.dropped += len(self.pending) - len(kept)
+            MESSAGES_DROPPED.inc(len(self.pending) - len(kept))
+            self.pending = kept
+            # Le client a perdu des deltas : il lui faudra une keyframe
+            self.enqueued_tick = None
+        self.pending.append((now, message, droppable))
+        self.wakeup.set()
+        return True
+
+    async def _write_loop(self):
+        try:
+            while True:
+                if not self.pending:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                enqueued_at, message, _ = self.pending.popleft()
+                self.send_started = time.perf_counter()
+                if isinstance(message, bytes):
+                    await self.websocket.send_bytes(message)
+                else:
+                    await self.websocket.send_text(message)
+                self.send_started = None
+                latency = time.perf_counter() - enqueued_at
+                self.sent += 1
+                self.last_latency = latency
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                SEND_LATENCY.observe(latency)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Socket morte : le endpoint se chargera du nettoyage à sa prochaine lecture
+            self.closed = True
+
+    def lag(self, now=None):
+        """Depuis combien de secondes l'envoi en cours est bloqué."""
+        if self.send_started is None:
+            return 0.0
+        return (now or time.perf_counter()) - self.send_started
+
+    async def close(self, code=1008):
+        self.closed = True
+        if self.writer:
+            self.writer.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stats(self):
+        return {
+            "queue_depth": len(self.pending),
+            "lag_ms": self.lag() * 1000,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "inputs": self.inputs,
+            "inputs_limited": self.inputs_limited,
+            "last_send_latency_ms": self.last_latency * 1000,
+            "avg_send_latency_ms": self.total_latency * 1000 / self.sent if self.sent else 0.0,
+            "max_send_latency_ms": self.max_latency * 1000,
+        }
+
+class ConnectionManager:
+    def __init__(self, queue_size=SEND_QUEUE_SIZE, policy=BACKPRESSURE_POLICY, max_lag=MAX_CLIENT_LAG,
+                 interest=None):
+        if policy not in ("latest", "disconnect"):
+            raise ValueError(f"politique de backpressure inconnue : {policy!r}")
+        self.interest = interest
+        self.queue_size = queue_size
+        self.policy = policy
+        self.max_lag = max_lag
+        self.active_connections: dict[WebSocket, ClientConnection] = {}
+    async def connect(self, websocket: WebSocket, client_id, binary=False):
+        await websocket.accept()
+        conn = ClientConnection(websocket, client_id, self.queue_size, binary)
+        conn.start()
+        self.active_connections[websocket] = conn
+        CONNECTIONS_TOTAL.inc()
+        return conn
+    def disconnect(self, websocket: WebSocket):
+        conn = self.active_connections.pop(websocket, None)
+        if conn:
+            DISCONNECTS_CLIENT.inc()
+        if conn and conn.writer:
+            conn.writer.cancel()
+    def send(self, websocket: WebSocket, message):
+        conn = self.active_connections.get(websocket)
+        if conn and not conn.offer(message, self.policy, self.max_lag, droppable=False):
+            self._kick(websocket)
+    def broadcast(self, message: str):
+        # Fan-out non bloquant : chaque client a sa propre file et sa tâche d'écriture
+        for websocket, conn in list(self.active_connections.items()):
+            if not conn.offer(message, self.policy, self.max_lag):
+                self._kick(websocket)
+    def broadcast_snapshot(self, snapshot):
+        """
+        Envoie à chaque client le delta du snapshot si le dernier snapshot mis en
+        file pour lui en est la base, sinon (nouveau venu, délestage, demande de
+        resync, intervalle) une keyframe. Aucun accusé de réception n'est attendu :
+        un trou côté client se rattrape par sa demande de resync.
+        Sans zone d'intérêt, chaque encodage n'est calculé qu'une fois pour tous les clients ;
+        avec, chaque message est assemblé à partir de fragments par joueur mis en cache.
+        Renvoie la taille totale des messages mis en file.
+        """
+        filtered = self.interest is not None and self.interest.enabled
+        payload = 0
+        for websocket, conn in list(self.active_connections.items()):
+            force_keyframe = snapshot.keyframe or conn.enqueued_tick is None or conn.full()
+            if filtered:
+                message = self.interest.message_for(conn, snapshot, force_keyframe)
+            elif not force_keyframe and conn.enqueued_tick == snapshot.base_tick:
+                message = snapshot.delta_bytes() if conn.binary else snapshot.delta_text()
+            else:
+                message = snapshot.keyframe_bytes() if conn.binary else snapshot.keyframe_text()
+            # Rien de visible n'a changé, ou keyframe pas encore relayée par le cœur de simulation
+            if message is None:
+                continue
+            message = snapshot.with_ack(message, conn.client_id)
+            if not conn.offer(message, self.policy, self.max_lag):
+                self._kick(websocket)
+                continue
+            conn.enqueued_tick = snapshot.tick
+            payload += len(message)
+        return payload
+    def request_keyframe(self, websocket: WebSocket):
+        conn = self.active_connections.get(websocket)
+        if conn:
+            conn.enqueued_tick = None
+    def _kick(self, websocket: WebSocket):
+        conn = self.active_connections.pop(websocket, None)
+        if conn:
+            DISCONNECTS_BACKPRESSURE.inc()
+            logger.info("client %s déconnecté : envoi bloqué depuis plus de %.1f s", conn.client_id, self.max_lag)
+            asyncio.ensure_future(conn.close())
+    def stats(self):
+        return {str(conn.client_id): conn.stats() for conn in self.active_connections.values()}
+
+def check_collision_zombie(store, a, b, threshold=INFECTION_RADIUS):
+    # Comparaison des carrés des distances : pas de racine carrée
+    dx = store.x[a] - store.x[b]
+    dz = store.z[a] - store.z[b]
+    return dx*dx + dz*dz < threshold*threshold
+
+##########################################################################
+#                          Protocole binaire                             #
+##########################################################################
+# Négocié à la connexion (/ws?proto=bin). Tout est en little-endian.
+#   en-tête  : type u8, drapeaux u8, tick u32, base u32, n1 u16, n2 u16, n3 u16
+#   keyframe : en-tête (n1 = joueurs) + n1 enregistrements
+#   delta    : en-tête (n1 = arrivées, n2 = départs, n3 = mises à jour)
+#              + n1 enregistrements + n2 handles u16 + n3 enregistrements
+#   enregistrement : handle u16, rôle u8, (bourrage), x f32, z f32, orientation f32, score i32
+# Chaque snapshot est suivi d'un accusé propre au destinataire (ACK_STRUCT) : dernière
+# séquence d'entrée reçue et nombre de ticks simulés avec, pour la réconciliation.
+# L'attribution (ASSIGN_STRUCT) transmet aussi la cadence et les vitesses de la simulation,
+# et le jeton de reprise du joueur (16 octets).
+# Entrées client : INPUT_STATE_STRUCT (opcode, touches tenues, numéro de séquence u32)
+# ou l'octet seul INPUT_RESYNC.
+MSG_ASSIGN = 1
+MSG_KEYFRAME = 2
+MSG_DELTA = 3
+FLAG_GAME_OVER = 1
+NO_TICK = 0xFFFFFFFF
+INPUT_RESYNC = 5
+INPUT_STATE = 6
+
+ASSIGN_STRUCT = struct.Struct("<BHfff16s")
+HEADER_STRUCT = struct.Struct("<BBIIHHH")
+RECORD_STRUCT = struct.Struct("<HBxfffi")
+HANDLE_STRUCT = struct.Struct("<H")
+INPUT_STATE_STRUCT = struct.Struct("<BBI")
+ACK_STRUCT = struct.Struct("<II")
+
+class BinaryEncoder:
+    """
+    Encode les snapshots dans un tampon préalloué avec struct.pack_into, directement
+    depuis les tableaux du PlayerStore : aucun objet intermédiaire par joueur, une
+    seule copie finale partagée par tous les clients.
+    """
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+
+    def _reserve(self, size):
+        if len(self.buf) < size:
+            self.buf = bytearray(max(size, 2 * len(self.buf)))
+        return self.buf
+
+    def _pack_records(self, buf, offset, slots, store):
+        x, z, orientation, role, score = store.x, store.z, store.orientation, store.role, store.score
+        pack_into = RECORD_STRUCT.pack_into
+        for slot in slots:
+            pack_into(buf, offset, slot, role[slot], x[slot], z[slot], orientation[slot], score[slot])
+            offset += RECORD_STRUCT.size
+        return offset
+
+    def encode_keyframe(self, snapshot):
+        store = snapshot.store
+        buf = self._reserve(HEADER_STRUCT.size + len(store) * RECORD_STRUCT.size)
+        flags = FLAG_GAME_OVER if snapshot.game_over else 0
+        HEADER_STRUCT.pack_into(buf, 0, MSG_KEYFRAME, flags, snapshot.tick, NO_TICK, len(store), 0, 0)
+        end = self._pack_records(buf, HEADER_STRUCT.size, store.slots(), store)
+        return bytes(memoryview(buf)[:end])
+
+    def encode_delta(self, snapshot):
+        store = snapshot.store
+        joins = [store.slot_of[pid] for pid in snapshot.joins]
+        updated = [store.slot_of[pid] for pid in snapshot.updates]
+        size = (HEADER_STRUCT.size + (len(joins) + len(updated)) * RECORD_STRUCT.size
+                + len(snapshot.leaves) * HANDLE_STRUCT.size)
+        buf = self._reserve(size)
+        flags = FLAG_GAME_OVER if snapshot.game_over else 0
+        base = NO_TICK if snapshot.base_tick is None else snapshot.base_tick
+        HEADER_STRUCT.pack_into(buf, 0, MSG_DELTA, flags, snapshot.tick, base,
+                                len(joins), len(snapshot.leaves), len(updated))
+        offset = self._pack_records(buf, HEADER_STRUCT.size, joins, store)
+        for pid in snapshot.leaves:
+            HANDLE_STRUCT.pack_into(buf, offset, snapshot.left_handles[pid])
+            offset += HANDLE_STRUCT.size
+        end = self._pack_records(buf, offset, updated, store)
+        return bytes(memoryview(buf)[:end])
+
+binary_encoder = BinaryEncoder()
+
+##########################################################################
+#                     Snapshots delta et keyframes                       #
+##########################################################################
+KEYFRAME_INTERVAL = int(os.environ.get("ZOMBIE_KEYFRAME_INTERVAL", "200"))
+
+def player_record(store, slot):
+    # Trois décimales suffisent au rendu et raccourcissent les messages
+    return {
+        "id": store.ids[slot],
+        "role": ROLE_NAMES[store.role[slot]],
+        "x": round(store.x[slot], 3),
+        "y": 0,
+        "z": round(store.z[slot], 3),
+        "orientation": round(store.orientation[slot], 3),
+        "score": store.score[slot],
+    }
+
+def append_ack(message, seq, ticks):
+    """Accusé [séquence, ticks] en fin de message, binaire ou JSON."""
+    if isinstance(message, bytes):
+        return message + ACK_STRUCT.pack(seq, ticks)
+    return f'{message[:-1]},"ack":[{seq},{ticks}]}}'
+
+class Snapshot:
+    """
+    État du jeu à un tick donné, avec le delta par rapport au snapshot précédent.
+    Il lit directement le PlayerStore de la salle : il n'est valable que pendant le
+    tick qui l'a produit, le temps que tous les messages soient encodés.
+    Les encodages sont calculés à la demande puis partagés par tous les clients.
+    """
+    def __init__(self, store, tick, base_tick, joins, leaves, left_handles, updates, game_over, keyframe):
+        self.store = store
+        self.tick = tick
+        self.base_tick = base_tick
+        # ids des arrivants et des partants, handles binaires des partants
+        self.joins = joins
+        self.leaves = leaves
+        self.left_handles = left_handles
+        # id -> champs modifiés
+        self.updates = updates
+        self.game_over = game_over
+        self.keyframe = keyframe
+        self._delta_text = None
+        self._keyframe_text = None
+        self._delta_bytes = None
+        self._keyframe_bytes = None
+        self._records = {}
+        self._record_json = {}
+        self._record_bytes = {}
+        self._update_json = {}
+
+    @property
+    def changed(self):
+        return self.updates
+
+    def record(self, pid):
+        r = self._records.get(pid)
+        if r is None:
+            r = self._records[pid] = player_record(self.store, self.store.slot_of[pid])
+        return r
+
+    def handle(self, pid):
+        slot = self.store.slot_of.get(pid)
+        return self.left_handles[pid] if slot is None else slot
+
+    def delta_text(self):
+        if self._delta_text is None:
+            state = {"type": "delta", "tick": self.tick, "base": self.base_tick,
+                     "joins": [self.record(pid) for pid in self.joins], "leaves": self.leaves,
+                     "updates": list(self.updates.values())}
+            if self.game_over:
+                state["gameOver"] = self.game_over
+            self._delta_text = json.dumps(state, separators=(",", ":"))
+        return self._delta_text
+
+    def keyframe_text(self):
+        if self._keyframe_text is None:
+            state = {"type": "keyframe", "tick": self.tick,
+                     "players": [self.record(pid) for pid in self.store.slot_of]}
+            if self.game_over:
+                state["gameOver"] = self.game_over
+            self._keyframe_text = json.dumps(state, separators=(",", ":"))
+        return self._keyframe_text
+
+    def delta_bytes(self):
+        if self._delta_bytes is None:
+            self._delta_bytes = binary_encoder.encode_delta(self)
+        return self._delta_bytes
+
+    def keyframe_bytes(self):
+        if self._keyframe_bytes is None:
+            self._keyframe_bytes = binary_encoder.encode_keyframe(self)
+        return self._keyframe_bytes
+
+    # Fragments par joueur pour les messages filtrés par zone d'intérêt
+
+    def record_json(self, pid):
+        frag = self._record_json.get(pid)
+        if frag is None:
+            frag = self._record_json[pid] = json.dumps(self.record(pid), separators=(",", ":"))
+        return frag
+
+    def update_json(self, pid):
+        frag = self._update_json.get(pid)
+        if frag is None:
+            frag = self._update_json[pid] = json.dumps(self.updates[pid], separators=(",", ":"))
+        return frag
+
+    def record_bytes(self, pid):
+        frag = self._record_bytes.get(pid)
+        if frag is None:
+            store = self.store
+            slot = store.slot_of[pid]
+            frag = self._record_bytes[pid] = RECORD_STRUCT.pack(
+                slot, store.role[slot], store.x[slot], store.z[slot], store.orientation[slot], store.score[slot])
+        return frag
+
+    def with_ack(self, message, player_id):
+        """
+        Ajoute au message l'accusé des entrées de son destinataire. Seule cette
+        fin change d'un client à l'autre : le corps reste l'encodage partagé.
+        """
+        store = self.store
+        slot = store.slot_of.get(player_id)
+        if slot is None:
+            return message
+        return append_ack(message, store.input_seq[slot], store.input_ticks[slot])
+
+    def keyframe_for(self, visible, binary):
+        if binary:
+            flags = FLAG_GAME_OVER if self.game_over else 0
+            header = HEADER_STRUCT.pack(MSG_KEYFRAME, flags, self.tick, NO_TICK, len(visible), 0, 0)
+            return header + b"".join([self.record_bytes(pid) for pid in visible])
+        game_over = ',"gameOver":' + json.dumps(self.game_over) if self.game_over else ""
+        return ('{"type":"keyframe","tick":%d,"players":[%s]%s}'
+                % (self.tick, ",".join([self.record_json(pid) for pid in visible]), game_over))
+
+    def delta_for(self, base_tick, joins, leaves, updates, binary):
+        if binary:
+            flags = FLAG_GAME_OVER if self.game_over else 0
+            header = HEADER_STRUCT.pack(MSG_DELTA, flags, self.tick, base_tick,
+                                        len(joins), len(leaves), len(updates))
+            return b"".join([header]
+                            + [self.record_bytes(pid) for pid in joins]
+                            + [HANDLE_STRUCT.pack(self.handle(pid)) for pid in leaves]
+                            + [self.record_bytes(pid) for pid in updates])
+        game_over = ',"gameOver":' + json.dumps(self.game_over) if self.game_over else ""
+        return ('{"type":"delta","tick":%d,"base":%d,"joins":[%s],"leaves":%s,"updates":[%s]%s}'
+                % (self.tick, base_tick, ",".join([self.record_json(pid) for pid in joins]),
+                   json.dumps(leaves, separators=(",", ":")),
+                   ",".join([self.update_json(pid) for pid in updates]), game_over))
+
+class SnapshotBuilder:
+    """
+    Compare le PlayerStore à une copie des tableaux du snapshot précédent pour
+    n'envoyer que les champs modifiés ; les enregistrements complets ne sont
+    construits que pour les arrivants et les keyframes.
+    """
+    def __init__(self, store, keyframe_interval=KEYFRAME_INTERVAL, game_over=None):
+        self.store = store
+        self.keyframe_interval = keyframe_interval
+        # Condition de fin de partie (par défaut : toutes les entrées du store)
+        self.game_over = game_over or store.game_over
+        self.prev_slots: dict = {}
+        self.prev_x = array("d")
+        self.prev_z = array("d")
+        self.prev_orientation = array("d")
+        self.prev_role = bytearray()
+        self.prev_score = array("i")
+        self.tick = None
+        self.count = 0
+
+    def build(self, tick):
+        store = self.store
+        current = store.slot_of
+        previous = self.prev_slots
+        joins = [pid for pid in current if pid not in previous]
+        leaves = [pid for pid in previous if pid not in current]
+        left_handles = {pid: previous[pid] for pid in leaves}
+        x, z, orientation, role, score = store.x, store.z, store.orientation, store.role, store.score
+        px, pz, po, prole, pscore = (self.prev_x, self.prev_z, self.prev_orientation,
+                                     self.prev_role, self.prev_score)
+        updates = {}
+        for pid, slot in current.items():
+            if pid not in previous:
+                continue
+            diff = None
+            if x[slot] != px[slot] or z[slot] != pz[slot]:
+                diff = {"id": pid, "x": round(x[slot], 3), "z": round(z[slot], 3)}
+            if orientation[slot] != po[slot]:
+                diff = diff or {"id": pid}
+                diff["orientation"] = round(orientation[slot], 3)
+            if role[slot] != prole[slot]:
+                diff = diff or {"id": pid}
+                diff["role"] = ROLE_NAMES[role[slot]]
+            if score[slot] != pscore[slot]:
+                diff = diff or {"id": pid}
+                diff["score"] = score[slot]
+            if diff is not None:
+                updates[pid] = diff
+        game_over = "ZOMBIES WON" if self.game_over() else None
+        self.count += 1
+        keyframe = self.keyframe_interval > 0 and self.count % self.keyframe_interval == 0
+        snapshot = Snapshot(store, tick, self.tick, joins, leaves, left_handles, updates, game_over, keyframe)
+        # Copies contiguës (memcpy) pour le prochain delta
+        self.prev_slots = dict(current)
+        self.prev_x = x[:]
+        self.prev_z = z[:]
+        self.prev_orientation = orientation[:]
+        self.prev_role = role[:]
+        self.prev_score = score[:]
+        self.tick = tick
+        return snapshot
+
+##########################################################################
+#                        Boucle de simulation                            #
+##########################################################################
+TICK_RATE = float(os.environ.get("ZOMBIE_TICK_RATE", "20"))
+# Touches tenues, envoyées par le client sous forme de masque
+KEY_LEFT = 1
+KEY_RIGHT = 2
+KEY_FORWARD = 4
+KEY_BACKWARD = 8
+KEY_MASK = KEY_LEFT | KEY_RIGHT | KEY_FORWARD | KEY_BACKWARD
+
+class GameLoop:
+    """
+    Boucle de simulation autoritaire à fréquence fixe d'une salle.
+    Les sockets se contentent d'enregistrer les touches tenues par chaque
+    joueur ; à chaque tick la boucle intègre les déplacements sur la durée du
+    tick, applique collisions et infections puis diffuse un seul état du jeu.
+    """
+    def __init__(self, room, tick_rate=TICK_RATE):
+        self.room = room
+        self.tick_rate = tick_rate
+        self.tick_interval = 1.0 / tick_rate
+        self.tick = 0
+        self.dirty = False
+        self.last_tick_duration = 0.0
+        self.max_tick_duration = 0.0
+        self.total_tick_duration = 0.0
+        self.overruns = 0
+        self._running = False
+
+    def add_player(self, player_id):
+        self.dirty = True
+
+    def remove_player(self, player_id):
+        self.dirty = True
+
+    def queue_input(self, player_id, keys, seq, merge=False):
+        """
+        Enregistre l'état des touches d'un joueur. Les touches vues entre deux
+        ticks sont cumulées pour qu'un appui bref compte au moins un tick ;
+        une entrée fusionnée (débit dépassé) ne met à jour que l'état courant.
+        """
+        store = self.room.players
+        slot = store.slot_of.get(player_id)
+        if slot is None:
+            return
+        recorder = self.room.recorder
+        if recorder is not None:
+            recorder.record(EVENT_INPUT, slot, keys | (EVENT_MERGED if merge else 0), seq)
+        store.keys[slot] = keys
+        if not merge:
+            store.taps[slot] |= keys
+        store.input_seq[slot] = seq
+        store.input_ticks[slot] = 0
+
+    def step(self):
+        """
+        Fait avancer la simulation d'un tick à partir des touches tenues.
+        Renvoie True si l'état du jeu a changé depuis le dernier tick.
+        """
+        room = self.room
+        store = room.players
+        keys, taps, input_ticks = store.keys, store.taps, store.input_ticks
+        moved = []
+        for slot in store.slots():
+            held = keys[slot] | taps[slot]
+            if not held:
+                continue
+            taps[slot] = 0
+            input_ticks[slot] += 1
+            if room.apply_input(slot, held, self.tick_interval):
+                moved.append(slot)
+        for slot in moved:
+            room.apply_infection(slot)
+        if room.npcs.count:
+            room.npcs.step(self.tick_interval)
+            moved = True
+        self.tick += 1
+        changed = self.dirty or bool(moved)
+        self.dirty = False
+        return changed
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._running = True
+        next_tick = loop.time()
+        while self._running:
+            start = time.perf_counter()
+            if self.step():
+                self.room.broadcast_game_state(self.tick)
+            self.room.after_tick()
+            duration = time.perf_counter() - start
+            self.last_tick_duration = duration
+            self.total_tick_duration += duration
+            self.max_tick_duration = max(self.max_tick_duration, duration)
+            TICK_SECONDS.observe(duration)
+            if duration > self.tick_interval:
+                self.overruns += 1
+                TICK_OVERRUNS.inc()
+                logger.warning("%s tick %d: %.1f ms (budget %.1f ms, %d dépassements)",
+                               self.room.room_id, self.tick, duration * 1000,
+                               self.tick_interval * 1000, self.overruns)
+            next_tick += self.tick_interval
+            delay = next_tick - loop.time()
+            if delay < 0:
+                # En retard : on repart de maintenant plutôt que d'enchaîner les ticks
+                next_tick = loop.time()
+                delay = 0
+            await asyncio.sleep(delay)
+
+    def stop(self):
+        self._running = False
+
+    def stats(self):
+        return {
+            "tick": self.tick,
+            "tick_rate": self.tick_rate,
+            "last_tick_ms": self.last_tick_duration * 1000,
+            "max_tick_ms": self.max_tick_duration * 1000,
+            "avg_tick_ms": self.total_tick_duration * 1000 / self.tick if self.tick else 0.0,
+            "overruns": self.overruns,
+        }
+
+##########################################################################
+#                  Navigation : champs de flux partagés                  #
+##########################################################################
+# Plutôt qu'une recherche de chemin par agent et par tick, un champ de distance
+# par cible commune (les civils, les zombies) calculé par un BFS multi-sources
+# sur une grille de marche : chaque agent lit ensuite sa direction en O(1).
+NAV_CELL = 2.0
+# Au-delà, la maille grossit pour borner le coût d'un BFS complet
+NAV_MAX_SIDE = 256
+# Écart (en mailles) toléré entre les cibles du champ en cache et les cibles actuelles
+NAV_TOLERANCE = 2
+# Part des anciennes cibles qui peuvent disparaître (civil infecté…) sans recalcul complet
+NAV_STALE_SHARE = 0.05
+# Âge maximal d'un champ (ticks) avant recalcul complet
+NAV_MAX_AGE = int(os.environ.get("ZOMBIE_NAV_MAX_AGE", "20"))
+# Marge autour des immeubles, pour que les agents ne les frôlent pas
+NAV_CLEARANCE = 1.0
+NAV_UNREACHABLE = np.iinfo(np.int32).max if np is not None else None
+# Voisinage à 8 pour choisir une direction, dans l'ordre de NAV_HEADINGS
+NAV_DIRECTIONS = ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+NAV_HEADINGS = tuple(math.atan2(di, dj) for di, dj in NAV_DIRECTIONS)
+
+class NavGrid:
+    """
+    Grille de marche de la ville, bordée d'une rangée de mailles bloquées pour
+    que les voisins d'une maille soient toujours des indices valides.
+    Bloquées : les mailles dont le centre est dans un immeuble (élargi de
+    NAV_CLEARANCE). Les mailles sur le quadrillage des routes restent toujours
+    praticables, ce qui garantit la connexité entre les blocs.
+    """
+    def __init__(self, layout, cell=NAV_CELL, max_side=NAV_MAX_SIDE):
+        size = layout.get("size", 400)
+        self.cell = max(cell, size / max_side)
+        self.cols = int(math.ceil(size / self.cell))
+        self.rows = self.cols
+        self.stride = self.rows + 2
+        centers = (np.arange(self.cols) + 0.5) * self.cell
+        q = self.cell / 4
+        road = ~clear_of_roads(centers - q, centers + q)
+        blocked = np.zeros((self.cols, self.rows), dtype=bool)
+        for b in layout["buildings"]:
+            x_min, x_max, z_min, z_max = building_bounding_box(b)
+            i0, i1 = np.searchsorted(centers, (x_min - NAV_CLEARANCE, x_max + NAV_CLEARANCE))
+            j0, j1 = np.searchsorted(centers, (z_min - NAV_CLEARANCE, z_max + NAV_CLEARANCE))
+            blocked[i0:i1, j0:j1] = True
+        blocked &= ~(road[:, None] | road[None, :])
+        walkable = np.zeros((self.cols + 2, self.rows + 2), dtype=bool)
+        walkable[1:-1, 1:-1] = ~blocked
+        self.walkable = walkable.ravel()
+        # Tampon de dédoublonnage de relax()
+        self.stamp = np.zeros(self.walkable.size, dtype=np.intp)
+        s = self.stride
+        self.offsets4 = np.array((s, -s, 1, -1), dtype=np.intp)
+        self.offsets8 = np.array([di * s + dj for di, dj in NAV_DIRECTIONS], dtype=np.intp)
+
+    def cells(self, x, z):
+        """Indices (grille bordée) des mailles contenant les points (x, z)."""
+        i = np.clip((x / self.cell).astype(np.intp), 0, self.cols - 1) + 1
+        j = np.clip((z / self.cell).astype(np.intp), 0, self.rows - 1) + 1
+        return i * self.stride + j
+
+    def relax(self, dist, frontier):
+        """
+        Propage les distances depuis `frontier` (mailles de même distance) en
+        largeur, par vagues vectorisées ; ne touche que les mailles améliorées.
+        """
+        walkable = self.walkable
+        offsets = self.offsets4
+        stamp = self.stamp
+        while frontier.size:
+            d = dist[frontier[0]] + 1
+            nb = (frontier[:, None] + offsets).ravel()
+            nb = nb[walkable[nb]]
+            nb = nb[dist[nb] > d]
+            # Dédoublonnage sans tri : seule la dernière écriture de chaque maille survit
+            order = np.arange(nb.size)
+            stamp[nb] = order
+            nb = nb[stamp[nb] == order]
+            dist[nb] = d
+            frontier = nb
+
+class FlowField:
+    """
+    Distance (en mailles) à la cible la plus proche et direction à suivre,
+    pour tous les agents à la fois. Le champ est gardé en cache tant que les
+    anciennes cibles ont une cible actuelle à NAV_TOLERANCE mailles près ;
+    les nouvelles cibles y sont alors ajoutées par relaxation incrémentale.
+    Sinon (cibles disparues ou parties loin) ou au-delà de NAV_MAX_AGE ticks,
+    il est recalculé entièrement.
+    """
+    def __init__(self, nav, flee=False, tolerance=NAV_TOLERANCE, max_age=NAV_MAX_AGE, phase=0):
+        self.nav = nav
+        # Fuite : on remonte la distance au lieu de la descendre
+        self.flee = flee
+        self.tolerance = tolerance
+        self.max_age = max_age
+        # Âge donné au champ après un recalcul complet : décale les recalculs de plusieurs champs
+        self.phase = phase
+        self.dist = None
+        self.sources = None
+        self.age = 0
+        self.full_updates = 0
+        self.incremental_updates = 0
+
+    def _covered(self, sources):
+        """
+        Vrai si les anciennes cibles ont presque toutes (NAV_STALE_SHARE près)
+        une cible actuelle dans la tolérance.
+        """
+        nav = self.nav
+        gone = np.setdiff1d(self.sources, sources, assume_unique=True)
+        if not gone.size:
+            return True
+        t = self.tolerance
+        # Table des sommes cumulées du masque des cibles : comptage par fenêtre en O(1)
+        mask = np.zeros(nav.walkable.size, dtype=np.int32)
+        mask[sources] = 1
+        table = np.zeros((nav.cols + 3, nav.rows + 3), dtype=np.int32)
+        table[1:, 1:] = mask.reshape(nav.cols + 2, nav.rows + 2).cumsum(0).cumsum(1)
+        i, j = np.divmod(gone, nav.stride)
+        i0, i1 = np.clip(i - t, 0, nav.cols + 1), np.clip(i + t + 1, 0, nav.cols + 2)
+        j0, j1 = np.clip(j - t, 0, nav.rows + 1), np.clip(j + t + 1, 0, nav.rows + 2)
+        found = table[i1, j1] - table[i0, j1] - table[i1, j0] + table[i0, j0]
+        return int((found == 0).sum()) <= NAV_STALE_SHARE * self.sources.size
+
+    def update(self, sources):
+        """`sources` : indices de mailles des cibles, triés et sans doublon."""
+        self.age += 1
+        if self.dist is None or self.age >= self.max_age or not self._covered(sources):
+            self.dist = np.full(self.nav.walkable.size, NAV_UNREACHABLE, dtype=np.int32)
+            self.dist[sources] = 0
+            if sources.size:
+                self.nav.relax(self.dist, sources)
+            self.age = -self.phase if not self.full_updates else 0
+            self.full_updates += 1
+        else:
+            # Une cible déjà à moins de `tolerance` mailles d'une ancienne ne change presque rien
+            fresh = sources[self.dist[sources] > self.tolerance]
+            if fresh.size:
+                self.dist[fresh] = 0
+                self.nav.relax(self.dist, fresh)
+                self.incremental_updates += 1
+        self.sources = sources
+
+    def lookup(self, cells):
+        """
+        Distance et direction (angle, comme les orientations) pour chaque maille :
+        vers la voisine (8-voisinage) la plus proche des cibles, ou la plus
+        éloignée en fuite. O(1) par agent, calculé seulement pour les mailles lues.
+        """
+        nav = self.nav
+        neighbours = cells[:, None] + nav.offsets8
+        d = self.dist[neighbours].astype(np.int64)
+        if self.flee:
+            d = np.where(nav.walkable[neighbours] & (d != NAV_UNREACHABLE), d, -1)
+            best = d.argmax(axis=1)
+        else:
+            best = d.argmin(axis=1)
+        return self.dist[cells], np.asarray(NAV_HEADINGS)[best]
+
+    def stats(self):
+        return {"full": self.full_updates, "incremental": self.incremental_updates, "age": self.age}
+
+class Navigation:
+    """
+    Champs de flux d'une salle : vers les civils (poursuite des zombies) et
+    loin des zombies (fuite des civils), mis à jour une fois par tick.
+    """
+    def __init__(self, grid):
+        self.grid = grid
+        self.pursue = FlowField(self.grid)
+        # Recalculs complets décalés d'un demi-cycle : jamais les deux sur un même tick
+        self.flee = FlowField(self.grid, flee=True, phase=NAV_MAX_AGE // 2)
+
+    def update(self, x, z, zombie):
+        """Positions et rôles de tous les agents de la salle (joueurs compris)."""
+        cells = self.grid.cells(x, z)
+        self.pursue.update(np.unique(cells[~zombie]))
+        self.flee.update(np.unique(cells[zombie]))
+
+    def stats(self):
+        return {"nav_pursue": self.pursue.stats(), "nav_flee": self.flee.stats()}
+
+##########################################################################
+#                            Foules de PNJ                               #
+##########################################################################
+# Nombre maximal de PNJ par salle occupée (nécessite NumPy) ; la foule est
+# facultative : sans ZOMBIE_NPCS, une salle ne contient que ses joueurs
+NPC_TARGET = int(os.environ.get("ZOMBIE_NPCS", "0"))
+# Fraction de la durée d'un tick au-delà de laquelle la foule est réduite
+NPC_TICK_BUDGET = float(os.environ.get("ZOMBIE_NPC_TICK_BUDGET", "0.5"))
+NPC_ADAPT_EVERY = 20
+NPC_SPAWN_PER_TICK = 50
+NPC_ZOMBIE_SHARE = 0.1
+NPC_ID_PREFIX = "npc-"
+# Vitesses en unités (ou radians) par seconde, un peu sous celles des joueurs
+NPC_CIVIL_SPEED = 35.0
+NPC_ZOMBIE_SPEED = 25.0
+NPC_TURN_SPEED = 4.0
+NPC_WANDER_TURN = 1.5
+# Les PNJ perçoivent les agrégats des cellules voisines (3x3) de cette taille
+NPC_SENSE_CELL = 20.0
+# Au-delà, distances en mailles de navigation : poursuite et fuite par champs de flux
+NPC_PURSUIT_RANGE = 60
+NPC_FLEE_RANGE = 15
+
+def _box_sum3(a):
+    """Somme de chaque case d'une grille 2D et de ses 8 voisines."""
+    p = np.pad(a, 1)
+    rows, cols = a.shape
+    return sum(p[1 + di:1 + di + rows, 1 + dj:1 + dj + cols]
+               for di in (-1, 0, 1) for dj in (-1, 0, 1))
+
+class NpcCrowd:
+    """
+    PNJ civils et zombies d'une salle. Ce sont des entrées ordinaires du
+    PlayerStore : mêmes rôles, mêmes règles d'infection, mêmes snapshots et
+    handles binaires que les joueurs. En revanche leur pilotage (errance,
+    fuite, poursuite), l'évitement des immeubles et les tests d'infection sont
+    calculés en lot avec NumPy, sur des vues des tableaux du store.
+    Le nombre de PNJ suit la durée mesurée des ticks.
+    """
+    def __init__(self, room, target=NPC_TARGET, tick_budget=NPC_TICK_BUDGET, seed=None):
+        self.room = room
+        if target and np is None:
+            logger.warning("NumPy absent : pas de PNJ")
+            target = 0
+        self.target = target
+        self.tick_budget = tick_budget
+        self.budget = 0
+        self.ids: list[str] = []
+        self.slots = None
+        self.serial = 0
+        self.avg_tick = 0.0
+        self.ticks = 0
+        self.rng = np.random.default_rng(seed) if np is not None else None
+        self.boxes = None
+        self.navigation = None
+
+    @property
+    def count(self):
+        return len(self.ids)
+
+    def zombies(self):
+        """Nombre de PNJ zombies, compté en lot sur le tableau des rôles."""
+        if not self.ids:
+            return 0
+        roles = np.frombuffer(self.room.players.role, dtype=np.uint8)
+        return int(np.count_nonzero(roles[self.slots] == ROLE_ZOMBIE))
+
+    def _refresh_slots(self):
+        slot_of = self.room.players.slot_of
+        self.slots = np.fromiter((slot_of[pid] for pid in self.ids), dtype=np.intp, count=len(self.ids))
+
+    def spawn(self, n):
+        room = self.room
+        store = room.players
+        for _ in range(n):
+            pid = f"{NPC_ID_PREFIX}{self.serial}"
+            self.serial += 1
+            role = ROLE_ZOMBIE if room.rng.random() < NPC_ZOMBIE_SHARE else ROLE_CIVIL
+            x, z = get_safe_spawn(room.city_grid, room.rng)
+            slot = store.add(pid, role, x, z, room.rng.uniform(0, 2*math.pi))
+            room.interest.index.insert(slot, x, z)
+            self.ids.append(pid)
+        self._refresh_slots()
+        if room.recorder is not None:
+            room.recorder.record(EVENT_NPC_SPAWN, value=n)
+
+    def despawn(self, n):
+        room = self.room
+        if room.recorder is not None:
+            room.recorder.record(EVENT_NPC_DESPAWN, value=n)
+        for _ in range(min(n, len(self.ids))):
+            slot = room.players.remove(self.ids.pop())
+            room.interest.index.remove(slot)
+        self._refresh_slots()
+
+    def adapt(self, duration, interval):
+        """
+        Ajuste le budget de PNJ d'après la durée moyenne des ticks, puis en
+        ajoute ou en retire quelques-uns par tick pour s'en rapprocher.
+        Sans joueur humain dans la salle, la foule disparaît.
+        """
+        if not self.target:
+            return
+        self.avg_tick += 0.1 * (duration - self.avg_tick)
+        self.ticks += 1
+        if self.ticks % NPC_ADAPT_EVERY == 0:
+            load = self.avg_tick / interval
+            if load > self.tick_budget:
+                self.budget = int(self.budget * 0.8)
+            elif load < 0.6 * self.tick_budget:
+                self.budget += max(NPC_SPAWN_PER_TICK, self.budget // 4)
+        goal = self.target if len(self.room.players) > self.count else 0
+        self.budget = min(self.budget, goal)
+        if self.count < self.budget:
+            self.spawn(min(NPC_SPAWN_PER_TICK, self.budget - self.count))
+            self.room.loop.dirty = True
+        elif self.count > self.budget:
+            self.despawn(min(NPC_SPAWN_PER_TICK, self.count - self.budget))
+            self.room.loop.dirty = True
+
+    def _building_boxes(self):
+        """Boîtes des immeubles par cellule de la CityGrid, complétées par des boîtes vides."""
+        grid = self.room.city_grid
+        depth = max((len(c) for c in grid.cells), default=0)
+        boxes = np.empty((len(grid.cells), depth, 4))
+        boxes[...] = (math.inf, -math.inf, math.inf, -math.inf)
+        for k, cell in enumerate(grid.cells):
+            if cell:
+                boxes[k, :len(cell)] = cell
+        return boxes
+
+    def _blocked(self, x, z):
+        """Vrai pour chaque point hors de la carte ou dans un immeuble."""
+        grid = self.room.city_grid
+        if self.boxes is None:
+            self.boxes = self._building_boxes()
+        i = np.clip((x // grid.cell_size).astype(np.intp), 0, grid.cols - 1)
+        j = np.clip((z // grid.cell_size).astype(np.intp), 0, grid.rows - 1)
+        b = self.boxes[i * grid.rows + j]
+        xc = x[:, None]
+        zc = z[:, None]
+        inside = ((xc >= b[..., 0]) & (xc <= b[..., 1]) & (zc >= b[..., 2]) & (zc <= b[..., 3])).any(axis=1)
+        return inside | (x < 0) | (x > grid.size) | (z < 0) | (z > grid.size)
+
+    def step(self, dt):
+        """Fait bouger toute la foule d'un tick puis teste les infections."""
+        room = self.room
+        store = room.players
+        slots = self.slots
+        n = len(slots)
+        # Vues sans copie : elles ne doivent pas survivre au tick (le store ne
+        # pourrait plus s'agrandir)
+        xs = np.frombuffer(store.x, dtype=np.float64)
+        zs = np.frombuffer(store.z, dtype=np.float64)
+        orientations = np.frombuffer(store.orientation, dtype=np.float64)
+        roles = np.frombuffer(store.role, dtype=np.uint8)
+        alive = np.fromiter(store.slots(), dtype=np.intp, count=len(store))
+
+        # Agrégats par cellule (joueurs compris) : effectifs et barycentres
+        size = room.city_grid.size
+        g = int(size // NPC_SENSE_CELL) + 1
+        ax = xs[alive]
+        az = zs[alive]
+        cells = (np.clip((ax // NPC_SENSE_CELL).astype(np.intp), 0, g - 1) * g
+                 + np.clip((az // NPC_SENSE_CELL).astype(np.intp), 0, g - 1))
+        zombie_alive = roles[alive] == ROLE_ZOMBIE
+        sums = {}
+        for name, mask in (("zombie", zombie_alive), ("civil", ~zombie_alive)):
+            sums[name] = [_box_sum3(np.bincount(cells[mask], weights=w, minlength=g * g).reshape(g, g))
+                          for w in (None, ax[mask], az[mask])]
+
+        if self.navigation is None:
+            self.navigation = Navigation(room.city.nav_grid)
+        self.navigation.update(ax, az, zombie_alive)
+
+        x = xs[slots]
+        z = zs[slots]
+        o = orientations[slots]
+        zombie = roles[slots] == ROLE_ZOMBIE
+        ci = np.clip((x // NPC_SENSE_CELL).astype(np.intp), 0, g - 1)
+        cj = np.clip((z // NPC_SENSE_CELL).astype(np.intp), 0, g - 1)
+        # Un zombie vise les civils voisins, un civil fuit les zombies voisins
+        count = np.where(zombie, sums["civil"][0][ci, cj], sums["zombie"][0][ci, cj])
+        seen = count > 0
+        safe = np.where(seen, count, 1.0)
+        dx = np.where(zombie, sums["civil"][1][ci, cj], sums["zombie"][1][ci, cj]) / safe - x
+        dz = np.where(zombie, sums["civil"][2][ci, cj], sums["zombie"][2][ci, cj]) / safe - z
+        heading = np.where(zombie, np.arctan2(dx, dz), np.arctan2(-dx, -dz))
+        # Hors de la maille des cibles, le champ de flux contourne les immeubles
+        cells = self.navigation.grid.cells(x, z)
+        follow = np.zeros(n, dtype=bool)
+        for mask, field, reach in ((zombie, self.navigation.pursue, NPC_PURSUIT_RANGE),
+                                   (~zombie, self.navigation.flee, NPC_FLEE_RANGE)):
+            dist, direction = field.lookup(cells[mask])
+            near = (dist > 0) & (dist <= reach)
+            follow[mask] = near
+            heading[mask] = np.where(near, direction, heading[mask])
+        steer = seen | follow
+        turn = (heading - o + math.pi) % (2 * math.pi) - math.pi
+        max_turn = NPC_TURN_SPEED * dt
+        o = np.where(steer, o + np.clip(turn, -max_turn, max_turn),
+                     o + self.rng.normal(0.0, NPC_WANDER_TURN * dt, n))
+
+        speed = np.where(zombie, NPC_ZOMBIE_SPEED, NPC_CIVIL_SPEED) * dt
+        nx = x + speed * np.sin(o)
+        nz = z + speed * np.cos(o)
+        # Le milieu du pas est testé aussi : aucun immeuble n'est plus fin qu'un pas
+        blocked = self._blocked(nx, nz) | self._blocked((x + nx) / 2, (z + nz) / 2)
+        nx = np.where(blocked, x, nx)
+        nz = np.where(blocked, z, nz)
+        o = np.where(blocked, o + np.pi / 2 * self.rng.choice((-1.0, 1.0), n), o) % (2 * math.pi)
+        xs[slots] = nx
+        zs[slots] = nz
+        orientations[slots] = o
+
+        # L'index de la zone d'intérêt n'est touché que pour les PNJ qui changent de case
+        index = room.interest.index
+        cs = index.cell_size
+        moved = ((x // cs) != (nx // cs)) | ((z // cs) != (nz // cs))
+        for k in np.nonzero(moved)[0].tolist():
+            index.move(int(slots[k]), float(nx[k]), float(nz[k]))
+
+        self._infect(xs, zs, roles, alive)
+
+    def _infect(self, xs, zs, roles, alive):
+        """
+        Contacts zombie/civil impliquant au moins un PNJ, en lot : les paires
+        candidates viennent d'une grille de pas INFECTION_RADIUS (civils triés
+        par case, 3 plages de 3 cases par zombie), puis distance et tirage à 5% sont
+        vectorisés. Les paires entre joueurs restent à apply_infection().
+        """
+        store = self.room.players
+        r = INFECTION_RADIUS
+        is_npc = np.zeros(store.capacity, dtype=bool)
+        is_npc[self.slots] = True
+        zombie_alive = roles[alive] == ROLE_ZOMBIE
+        zombies = alive[zombie_alive]
+        civilians = alive[~zombie_alive]
+        if not len(zombies) or not len(civilians):
+            return
+        width = int(self.room.city_grid.size // r) + 3
+
+        def keys(slots):
+            return (xs[slots] // r).astype(np.int64) * width + (zs[slots] // r).astype(np.int64)
+
+        order = np.argsort(keys(civilians), kind="stable")
+        sorted_keys = keys(civilians)[order]
+        zombie_keys = keys(zombies)
+        pair_z = []
+        pair_c = []
+        for di in (-1, 0, 1):
+            # Les trois cases (di, -1..1) sont contiguës dans l'ordre des clés
+            k = zombie_keys + di * width
+            lo = np.searchsorted(sorted_keys, k - 1, "left")
+            counts = np.searchsorted(sorted_keys, k + 1, "right") - lo
+            total = int(counts.sum())
+            if not total:
+                continue
+            starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+            pair_z.append(np.repeat(zombies, counts))
+            pair_c.append(civilians[order[starts + np.arange(total)]])
+        if not pair_z:
+            return
+        pz = np.concatenate(pair_z)
+        pc = np.concatenate(pair_c)
+        keep = is_npc[pz] | is_npc[pc]
+        pz = pz[keep]
+        pc = pc[keep]
+        COLLISION_CHECKS.inc(len(pz))
+        dx = xs[pz] - xs[pc]
+        dz = zs[pz] - zs[pc]
+        contact = dx*dx + dz*dz < r*r
+        pz = pz[contact]
+        pc = pc[contact]
+        if not len(pz):
+            return
+        INFECTION_ROLLS.inc(len(pz))
+        hit = self.rng.random(len(pz)) < 0.05
+        # Un civil n'est infecté qu'une fois, par le premier zombie tiré
+        infected, first = np.unique(pc[hit], return_index=True)
+        for civ, zom in zip(infected.tolist(), pz[hit][first].tolist()):
+            store.set_role(civ, ROLE_ZOMBIE)
+            store.score[zom] += 1
+            INFECTIONS.inc()
+
+    def stats(self):
+        stats = {"npcs": self.count, "npc_budget": self.budget, "npc_target": self.target}
+        if self.navigation is not None:
+            stats.update(self.navigation.stats())
+        return stats
+
+##########################################################################
+#                     Enregistrement des entrées                         #
+##########################################################################
+# Journal binaire en ajout seul, un fichier par salle, ouvert à sa création :
+#   en-tête : magie, version u16, broad phase u8, graine de la ville u64,
+#             graine de la salle u64, taille de la ville f32, cadence f32,
+#             vitesse f32, vitesse de rotation f32
+#   événement (12 octets) : tick u32, type u8, drapeaux u8, handle u16, valeur u32
+# Le tick est celui de la boucle au moment de l'événement : il s'applique avant
+# le tick suivant. Les décisions prises d'après l'horloge (budget de PNJ, fin de
+# partie) sont journalisées comme des événements pour que le rejeu les reproduise.
+RECORD_DIR = os.environ.get("ZOMBIE_RECORD")
+RECORD_MAGIC = b"ZREC"
+RECORD_FORMAT_VERSION = 1
+RECORD_HEADER_STRUCT = struct.Struct("<4sHBxQQffff")
+RECORD_EVENT_STRUCT = struct.Struct("<IBBHI")
+# Somme de contrôle de l'état tous les N ticks, pour localiser une divergence
+RECORD_CHECK_EVERY = 100
+RECORD_FLUSH_EVERY = 20
+
+EVENT_JOIN = 1
+EVENT_LEAVE = 2
+# drapeaux : masque de touches, plus EVENT_MERGED ; valeur : séquence
+EVENT_INPUT = 3
+EVENT_NPC_SPAWN = 4
+EVENT_NPC_DESPAWN = 5
+EVENT_RECYCLE = 6
+EVENT_CHECKSUM = 7
+# Reprise d'un joueur sauvegardé (voir Room.restore_player) : son état, packé avec
+# RESTORE_STATE_STRUCT, est découpé en mots u32 ; drapeaux : indice du mot
+EVENT_RESTORE = 8
+EVENT_MERGED = 0x80
+RESTORE_STATE_STRUCT = struct.Struct("<Bxxxiddd")
+
+def state_checksum(store):
+    """CRC32 des tableaux de simulation (positions, orientations, rôles, scores)."""
+    crc = 0
+    for column in (store.x, store.z, store.orientation, store.role, store.score):
+        crc = zlib.crc32(column, crc)
+    return crc
+
+class InputRecorder:
+    """
+    Journal des entrées acceptées d'une salle. Il doit être branché avant le
+    premier joueur : la graine de la salle décrit alors tout son état aléatoire.
+    """
+    def __init__(self, path, room):
+        self.path = path
+        self.room = room
+        self.events = 0
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(RECORD_HEADER_STRUCT.pack(
+                RECORD_MAGIC, RECORD_FORMAT_VERSION, list(BROAD_PHASES).index(BROAD_PHASE),
+                room.city.seed & _MASK64, room.seed & _MASK64, room.city_layout["size"],
+                room.loop.tick_rate, MOVE_SPEED, ROT_SPEED))
+
+    def record(self, kind, handle=0, flags=0, value=0):
+        self.file.write(RECORD_EVENT_STRUCT.pack(self.room.loop.tick, kind, flags, handle, value))
+        self.events += 1
+
+    def tick_end(self, tick):
+        if tick % RECORD_CHECK_EVERY == 0:
+            self.record(EVENT_CHECKSUM, value=state_checksum(self.room.players))
+        if tick % RECORD_FLUSH_EVERY == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def stats(self):
+        return {"path": self.path, "events": self.events}
+
+##########################################################################
+#                           Salles de jeu                                #
+##########################################################################
+# Délai entre "ZOMBIES WON" et le redémarrage de la partie dans la même salle
+ROOM_RECYCLE_DELAY = float(os.environ.get("ZOMBIE_RECYCLE_DELAY", "5.0"))
+# Vitesses par seconde : le déplacement ne dépend plus de la répétition clavier
+MOVE_SPEED = float(os.environ.get("ZOMBIE_MOVE_SPEED", "60.0"))
+ROT_SPEED = float(os.environ.get("ZOMBIE_ROT_SPEED", "3.0"))
+
+class Room:
+    """
+    Une partie indépendante : sa ville, ses joueurs, ses connexions et sa boucle
+    de simulation. Un processus peut en héberger plusieurs.
+    """
+    def __init__(self, room_id, city=None, loads=None, load_slot=None, seed=None, joins=None):
+        self.room_id = room_id
+        # Tout l'aléa de la simulation vient de cette graine (rejeu à l'identique)
+        self.seed = seed if seed is not None else int.from_bytes(os.urandom(8), "little")
+        self.rng = random.Random(self.seed)
+        self.recorder = None
+        self.city = city if city is not None else City(generate_city_layout())
+        self.city_layout = self.city.layout
+        self.city_grid = self.city.grid
+        self.city_payload = self.city.payload
+        self.players = PlayerStore()
+        self.player_index = make_broad_phase(BROAD_PHASE)
+        self.interest = InterestManager(self.players)
+        self.snapshots = SnapshotBuilder(self.players, game_over=self.game_over)
+        self.manager = ConnectionManager(interest=self.interest)
+        self.loop = GameLoop(self)
+        self.npcs = NpcCrowd(self, seed=self.seed)
+        # Tableaux partagés avec le routeur en mode multi-processus : joueurs
+        # présents (mis à jour à chaque tick) et arrivées cumulées
+        self.loads = loads
+        self.joins = joins
+        self.load_slot = load_slot
+        self.game_over_at = None
+        self.games_played = 0
+        # Jeton de reprise de chaque joueur connecté (id -> 16 octets)
+        self.tokens: dict[str, bytes] = {}
+        # Joueurs partis ou d'avant un redémarrage, en attente de leur retour :
+        # jeton -> (expiration, rôle, x, z, orientation, score)
+        self.resumable: dict[bytes, tuple] = {}
+
+    def add_player(self, player_id, token=None):
+        """
+        Ajoute un joueur et renvoie son emplacement (handle binaire). Si `token`
+        désigne un joueur en attente de reprise, celui-ci retrouve son état ;
+        sinon il reçoit un nouveau jeton (self.tokens).
+        """
+        # Probabilité initiale de zombie réduite à 5%
+        role = ROLE_ZOMBIE if self.rng.random() < 0.05 else ROLE_CIVIL
+        # Choisir une position de spawn sûre
+        spawn_x, spawn_z = get_safe_spawn(self.city_grid, self.rng)
+        init_orientation = self.rng.uniform(0, 2*math.pi)
+        slot = self.players.add(player_id, role, spawn_x, spawn_z, init_orientation)
+        if self.recorder is not None:
+            self.recorder.record(EVENT_JOIN, slot)
+        self.player_index.insert(slot, spawn_x, spawn_z)
+        self.interest.index.insert(slot, spawn_x, spawn_z)
+        saved = self.resumable.pop(token, None) if token else None
+        if saved is not None and saved[0] > time.time():
+            self.restore_player(slot, *saved[1:])
+        else:
+            token = os.urandom(16)
+        self.tokens[player_id] = token
+        self.loop.add_player(player_id)
+        if self.joins is not None:
+            # Solde une réservation du routeur (voir router_join)
+            self.joins[self.load_slot] += 1
+        return slot
+
+    def restore_player(self, slot, role, x, z, orientation, score):
+        """Rend à un joueur son état sauvegardé ; journalisé pour que le rejeu le suive."""
+        store = self.players
+        store.set_role(slot, role)
+        store.x[slot] = x
+        store.z[slot] = z
+        store.orientation[slot] = orientation
+        store.score[slot] = score
+        self.player_index.move(slot, x, z)
+        self.interest.index.move(slot, x, z)
+        if self.recorder is not None:
+            state = RESTORE_STATE_STRUCT.pack(role, score, x, z, orientation)
+            for index, (word,) in enumerate(struct.iter_unpack("<I", state)):
+                self.recorder.record(EVENT_RESTORE, slot, index, word)
+
+    def remove_player(self, player_id):
+        token = self.tokens.pop(player_id, None)
+        slot = self.players.slot_of.get(player_id)
+        if slot is not None and token is not None and SNAPSHOT_DIR:
+            # Avec la persistance, un joueur parti peut revenir avec son jeton
+            store = self.players
+            self.resumable[token] = (time.time() + RESUME_TTL, store.role[slot], store.x[slot],
+                                     store.z[slot], store.orientation[slot], store.score[slot])
+        slot = self.players.remove(player_id)
+        if slot is not None:
+            if self.recorder is not None:
+                self.recorder.record(EVENT_LEAVE, slot)
+            self.player_index.remove(slot)
+            self.interest.index.remove(slot)
+        self.loop.remove_player(player_id)
+
+    def apply_input(self, slot, keys, dt):
+        """
+        Intègre sur `dt` secondes les touches tenues par un joueur.
+        Le déplacement est annulé s'il fait entrer le joueur dans un immeuble.
+        Renvoie True si le joueur a tourné ou bougé.
+        """
+        store = self.players
+        turn = bool(keys & KEY_LEFT) - bool(keys & KEY_RIGHT)
+        walk = bool(keys & KEY_FORWARD) - bool(keys & KEY_BACKWARD)
+        if turn:
+            store.orientation[slot] += turn * ROT_SPEED * dt
+        if not walk:
+            return bool(turn)
+        old_x, old_z = store.x[slot], store.z[slot]
+        distance = walk * MOVE_SPEED * dt
+        x = old_x + distance * math.sin(store.orientation[slot])
+        z = old_z + distance * math.cos(store.orientation[slot])
+
+        # Empêcher le déplacement si le trajet traverse un immeuble
+        if self.city_grid.segment_blocked(old_x, old_z, x, z):
+            return bool(turn)
+        store.x[slot] = x
+        store.z[slot] = z
+        self.player_index.move(slot, x, z)
+        self.interest.index.move(slot, x, z)
+        return True
+
+    def apply_infection(self, slot):
+        """
+        Conversion zombie/civil avec probabilité de 5% pour un joueur qui a bougé.
+        Seuls les joueurs des cellules voisines (broad-phase) sont testés.
+        """
+        store = self.players
+        role = store.role
+        nearby = self.player_index.query(store.x[slot], store.z[slot], INFECTION_RADIUS)
+        COLLISION_CHECKS.inc(len(nearby))
+        if role[slot] == ROLE_ZOMBIE:
+            for other in nearby:
+                if role[other] == ROLE_CIVIL and check_collision_zombie(store, slot, other):
+                    INFECTION_ROLLS.inc()
+                    if self.rng.random() < 0.05:
+                        store.set_role(other, ROLE_ZOMBIE)
+                        store.score[slot] += 1
+                        INFECTIONS.inc()
+        else:
+            for other in nearby:
+                if role[other] == ROLE_ZOMBIE and check_collision_zombie(store, slot, other):
+                    INFECTION_ROLLS.inc()
+                    if self.rng.random() < 0.05:
+                        store.score[other] += 1
+                        store.set_role(slot, ROLE_ZOMBIE)
+                        INFECTIONS.inc()
+                        break
+
+    def broadcast_game_state(self, tick):
+        if METRICS_ENABLED:
+            start = time.perf_counter()
+        snapshot = self.snapshots.build(tick)
+        if METRICS_ENABLED:
+            built = time.perf_counter()
+        payload = self.manager.broadcast_snapshot(snapshot)
+        if simulation_hub is not None:
+            payload += simulation_hub.broadcast_snapshot(self, snapshot)
+        if METRICS_ENABLED:
+            SNAPSHOT_BUILD_SECONDS.observe(built - start)
+            BROADCAST_SERIALIZE_SECONDS.observe(time.perf_counter() - built)
+            BROADCAST_BYTES.observe(payload)
+        if not snapshot.game_over:
+            self.game_over_at = None
+        elif self.game_over_at is None:
+            self.game_over_at = time.monotonic()
+
+    def game_over(self):
+        """Tous les joueurs humains sont des zombies : les PNJ ne comptent pas."""
+        store = self.players
+        npc_zombies = self.npcs.zombies()
+        npc_civilians = self.npcs.count - npc_zombies
+        return store.civilians == npc_civilians and store.zombies > npc_zombies
+
+    def humans(self):
+        """Joueurs connectés, PNJ exclus."""
+        return len(self.players) - self.npcs.count
+
+    def after_tick(self):
+        if self.recorder is not None:
+            self.recorder.tick_end(self.loop.tick)
+        self.npcs.adapt(self.loop.last_tick_duration, self.loop.tick_interval)
+        if self.game_over_at is not None and time.monotonic() - self.game_over_at >= ROOM_RECYCLE_DELAY:
+            self.recycle()
+        if self.loads is not None:
+            self.loads[self.load_slot] = self.humans()
+
+    def recycle(self):
+        """
+        Relance une partie dans la même salle et la même ville, sans déconnecter
+        personne : rôles retirés au sort, scores remis à zéro, nouveaux spawns.
+        """
+        store = self.players
+        if self.recorder is not None:
+            self.recorder.record(EVENT_RECYCLE)
+        # Les PNJ ne sont pas dans la broad phase des joueurs
+        npc_slots = set(self.npcs.slots.tolist()) if self.npcs.count else ()
+        rng = self.rng
+        for slot in store.slots():
+            store.set_role(slot, ROLE_ZOMBIE if rng.random() < 0.05 else ROLE_CIVIL)
+            store.score[slot] = 0
+            x, z = get_safe_spawn(self.city_grid, rng)
+            store.x[slot] = x
+            store.z[slot] = z
+            store.orientation[slot] = rng.uniform(0, 2*math.pi)
+            if slot not in npc_slots:
+                self.player_index.move(slot, x, z)
+            self.interest.index.move(slot, x, z)
+        # Au moins un zombie dès qu'il y a de quoi jouer
+        if len(store) > 1 and store.zombies == 0:
+            store.set_role(rng.choice(list(store.slots())), ROLE_ZOMBIE)
+        self.game_over_at = None
+        self.games_played += 1
+        self.loop.dirty = True
+        logger.info("salle %s recyclée (partie %d)", self.room_id, self.games_played + 1)
+
+    def stats(self):
+        return {
+            **self.loop.stats(),
+            "players": self.humans(),
+            **self.npcs.stats(),
+            "zombies": self.players.zombies,
+            "civilians": self.players.civilians,
+            "games_played": self.games_played,
+            "resumable": len(self.resumable),
+            "clients": self.manager.stats(),
+        }
+
+ROOMS_PER_PROCESS = int(os.environ.get("ZOMBIE_ROOMS", "1"))
+# Graine de la salle r0 (r1 : +1, …) ; aléatoire par défaut
+ROOM_SEED = int(os.environ["ZOMBIE_ROOM_SEED"]) if os.environ.get("ZOMBIE_ROOM_SEED") else None
+# Salles hébergées par ce processus ; redéfini par run_worker en mode multi-processus
+hosted_room_ids = [f"r{i}" for i in range(ROOMS_PER_PROCESS)]
+# Tableau de charge (joueurs par salle) partagé avec le routeur, None en mono-processus
+shard_loads = None
+# Arrivées cumulées par salle, partagées de même
+shard_joins = None
+rooms: dict[str, Room] = {}
+
+metrics.gauge("zombie_connections", "Connexions ouvertes par salle",
+              lambda: (((room_id,), len(room.manager.active_connections)) for room_id, room in rooms.items()),
+              ("room",))
+metrics.gauge("zombie_players", "Joueurs par salle",
+              lambda: (((room_id,), room.humans()) for room_id, room in rooms.items()), ("room",))
+metrics.gauge("zombie_npcs", "PNJ simulés par salle",
+              lambda: (((room_id,), room.npcs.count) for room_id, room in rooms.items()), ("room",))
+metrics.gauge("zombie_send_queue_depth", "Messages en attente d'envoi, toutes connexions confondues",
+              lambda: (((room_id,), sum(len(c.pending) for c in room.manager.active_connections.values()))
+                       for room_id, room in rooms.items()),
+              ("room",))
+
+def start_rooms():
+    global world_snapshots
+    # Toutes les salles (et tous les processus) partagent la même ville,
+    # celle du dernier snapshot s'il y en a un
+    start = time.perf_counter()
+    layout = load_world_city()
+    city = City(layout or generate_city_layout(CITY_SEED, CITY_SIZE))
+    for slot, room_id in enumerate(hosted_room_ids):
+        load_slot = int(room_id[1:]) if shard_loads is not None else slot
+        seed = ROOM_SEED + int(room_id[1:]) if ROOM_SEED is not None else None
+        room = rooms[room_id] = Room(room_id, city, loads=shard_loads, load_slot=load_slot, seed=seed,
+                                     joins=shard_joins)
+        if layout is not None:
+            waiting = restore_room(room)
+            logger.info("salle %s restaurée depuis %s en %.1f ms : %d joueurs peuvent reprendre",
+                        room_id, SNAPSHOT_DIR, (time.perf_counter() - start) * 1000, waiting)
+        if RECORD_DIR:
+            path = os.path.join(RECORD_DIR, f"{room_id}-{int(time.time())}-{os.getpid()}.zrec")
+            room.recorder = InputRecorder(path, room)
+            logger.info("salle %s : entrées enregistrées dans %s", room_id, path)
+    if SNAPSHOT_DIR:
+        world_snapshots = WorldSnapshots(SNAPSHOT_DIR)
+        world_snapshots.start()
+    return [asyncio.create_task(room.loop.run()) for room in rooms.values()]
+
+def pick_room():
+    """Salle locale la moins chargée."""
+    return min(rooms.values(), key=lambda room: room.humans())
+
+##########################################################################
+#                        Persistance du monde                            #
+##########################################################################
+# Répertoire des snapshots (ZOMBIE_SNAPSHOT_DIR ou --snapshot) ; None : pas de persistance
+SNAPSHOT_DIR = os.environ.get("ZOMBIE_SNAPSHOT_DIR")
+SNAPSHOT_INTERVAL = float(os.environ.get("ZOMBIE_SNAPSHOT_INTERVAL", "5.0"))
+# Délai pendant lequel un joueur parti (ou coupé par un redémarrage) peut reprendre sa partie
+RESUME_TTL = float(os.environ.get("ZOMBIE_RESUME_TTL", "600"))
+# Fichiers du répertoire :
+#   city-<hash>.zcity   la ville, écrite une seule fois (elle ne change jamais)
+#     en-tête : magie, version u16, graine u64, taille f64, nombre d'immeubles u32
+#     immeuble : x, z, largeur, profondeur, hauteur en f64 (valeurs exactes), couleur u32
+#   room-<id>.zworld    l'état d'une salle, réécrit en entier à chaque snapshot
+#     en-tête : magie, version u16, hash de la ville (sha256 hexadécimal), parties
+#               jouées u32, date de la sauvegarde f64, nombre de joueurs u32
+#     joueur  : jeton (16 octets), rôle u8, x f64, z f64, orientation f64, score i32,
+#               expiration de la reprise f64
+WORLD_CITY_MAGIC = b"ZWCT"
+WORLD_ROOM_MAGIC = b"ZWRM"
+WORLD_FORMAT_VERSION = 1
+WORLD_CITY_HEADER_STRUCT = struct.Struct("<4sH2xQdI")
+WORLD_BUILDING_STRUCT = struct.Struct("<dddddI")
+WORLD_ROOM_HEADER_STRUCT = struct.Struct("<4sH2x64sIdI")
+WORLD_PLAYER_STRUCT = struct.Struct("<16sB3xdddid")
+
+def parse_token(text):
+    """Jeton de reprise envoyé par un client (hexadécimal), ou None s'il est invalide."""
+    if not text or len(text) != 32:
+        return None
+    try:
+        return bytes.fromhex(text)
+    except ValueError:
+        return None
+
+def world_city_path(directory, city_hash):
+    return os.path.join(directory, f"city-{city_hash[:16]}.zcity")
+
+def world_room_path(directory, room_id):
+    return os.path.join(directory, f"room-{room_id}.zworld")
+
+def write_atomic(path, data):
+    """Fichier temporaire, fsync puis renommage : un lecteur ne voit jamais d'écriture partielle."""
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+def pack_world_city(layout):
+    buildings = layout["buildings"]
+    packed = bytearray(WORLD_CITY_HEADER_STRUCT.size + WORLD_BUILDING_STRUCT.size * len(buildings))
+    WORLD_CITY_HEADER_STRUCT.pack_into(packed, 0, WORLD_CITY_MAGIC, WORLD_FORMAT_VERSION,
+                                       layout["seed"] & _MASK64, layout["size"], len(buildings))
+    offset = WORLD_CITY_HEADER_STRUCT.size
+    for b in buildings:
+        WORLD_BUILDING_STRUCT.pack_into(packed, offset, b["x"], b["z"], b["width"], b["depth"],
+                                        b["height"], b.get("color", 0))
+        offset += WORLD_BUILDING_STRUCT.size
+    return bytes(packed)
+
+def read_world_city(path):
+    """Plan de ville lu par mmap ; None si le fichier est absent ou illisible."""
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            magic, version, seed, size, count = WORLD_CITY_HEADER_STRUCT.unpack_from(buffer)
+            start = WORLD_CITY_HEADER_STRUCT.size
+            end = start + count * WORLD_BUILDING_STRUCT.size
+            if magic != WORLD_CITY_MAGIC or version != WORLD_FORMAT_VERSION or end > len(buffer):
+                return None
+            buildings = [{"x": x, "z": z, "width": width, "depth": depth, "height": height, "color": color}
+                         for x, z, width, depth, height, color
+                         in WORLD_BUILDING_STRUCT.iter_unpack(buffer[start:end])]
+    except (OSError, ValueError, struct.error):
+        return None
+    return {"seed": seed, "size": int(size) if size == int(size) else size, "buildings": buildings}
+
+def read_world_room(path):
+    """(en-tête, joueurs) d'un snapshot de salle lu par mmap, ou None."""
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            magic, version, city_hash, games_played, saved_at, count = \
+                WORLD_ROOM_HEADER_STRUCT.unpack_from(buffer)
+            start = WORLD_ROOM_HEADER_STRUCT.size
+            end = start + count * WORLD_PLAYER_STRUCT.size
+            if magic != WORLD_ROOM_MAGIC or version != WORLD_FORMAT_VERSION or end > len(buffer):
+                return None
+            players = list(WORLD_PLAYER_STRUCT.iter_unpack(buffer[start:end]))
+    except (OSError, ValueError, struct.error):
+        return None
+    header = {"city_hash": city_hash.decode(), "games_played": games_played, "saved_at": saved_at}
+    return header, players
+
+def load_world_city(directory=None):
+    """
+    Ville du snapshot le plus récent du répertoire, ou None. Une graine
+    imposée (ZOMBIE_CITY_SEED, --seed) différente l'emporte : nouvelle ville.
+    """
+    directory = directory or SNAPSHOT_DIR
+    if not directory or not os.path.isdir(directory):
+        return None
+    latest = None
+    for name in os.listdir(directory):
+        if name.startswith("room-") and name.endswith(".zworld"):
+            state = read_world_room(os.path.join(directory, name))
+            if state is not None and (latest is None or state[0]["saved_at"] > latest["saved_at"]):
+                latest = state[0]
+    if latest is None:
+        return None
+    layout = read_world_city(world_city_path(directory, latest["city_hash"]))
+    if layout is None or (CITY_SEED is not None and layout["seed"] != CITY_SEED & _MASK64):
+        return None
+    return layout
+
+def restore_room(room, directory=None):
+    """
+    Remet une salle dans l'état de son dernier snapshot, s'il porte sur la
+    même ville. Les joueurs ne sont pas recréés : ils attendent dans
+    `resumable` de revenir avec leur jeton. Renvoie le nombre de joueurs en attente.
+    """
+    state = read_world_room(world_room_path(directory or SNAPSHOT_DIR, room.room_id))
+    if state is None or state[0]["city_hash"] != room.city.payload.hash:
+        return 0
+    header, players = state
+    room.games_played = header["games_played"]
+    now = time.time()
+    room.resumable = {token: (expires, role, x, z, orientation, score)
+                      for token, role, x, z, orientation, score, expires in players if expires > now}
+    return len(room.resumable)
+
+def capture_room(room):
+    """
+    État d'une salle à un instant donné, pris dans la boucle entre deux ticks.
+    Les tableaux du PlayerStore sont copiés d'un bloc (memcpy) ; l'encodage
+    et l'écriture se font ensuite hors de la boucle, sur ces copies.
+    """
+    store = room.players
+    now = time.time()
+    expires = now + RESUME_TTL
+    # Le ménage des reprises expirées se fait ici, à chaque snapshot
+    room.resumable = {token: saved for token, saved in room.resumable.items() if saved[0] > now}
+    return {
+        "room_id": room.room_id,
+        "layout": room.city.layout,
+        "city_hash": room.city.payload.hash,
+        "games_played": room.games_played,
+        "saved_at": now,
+        "expires": expires,
+        "connected": [(room.tokens[pid], slot) for pid, slot in store.slot_of.items() if pid in room.tokens],
+        "role": store.role[:],
+        "x": store.x[:],
+        "z": store.z[:],
+        "orientation": store.orientation[:],
+        "score": store.score[:],
+        "resumable": list(room.resumable.items()),
+    }
+
+def pack_world_room(captured):
+    connected, resumable = captured["connected"], captured["resumable"]
+    packed = bytearray(WORLD_ROOM_HEADER_STRUCT.size
+                       + WORLD_PLAYER_STRUCT.size * (len(connected) + len(resumable)))
+    WORLD_ROOM_HEADER_STRUCT.pack_into(packed, 0, WORLD_ROOM_MAGIC, WORLD_FORMAT_VERSION,
+                                       captured["city_hash"].encode(), captured["games_played"],
+                                       captured["saved_at"], len(connected) + len(resumable))
+    offset = WORLD_ROOM_HEADER_STRUCT.size
+    role, x, z, orientation, score = (captured["role"], captured["x"], captured["z"],
+                                      captured["orientation"], captured["score"])
+    for token, slot in connected:
+        WORLD_PLAYER_STRUCT.pack_into(packed, offset, token, role[slot], x[slot], z[slot],
+                                      orientation[slot], score[slot], captured["expires"])
+        offset += WORLD_PLAYER_STRUCT.size
+    for token, (expires, *saved) in resumable:
+        WORLD_PLAYER_STRUCT.pack_into(packed, offset, token, *saved, expires)
+        offset += WORLD_PLAYER_STRUCT.size
+    return bytes(packed)
+
+class WorldSnapshots:
+    """
+    Sauvegarde périodique des salles de ce processus. Seule la capture
+    (copie des tableaux) a lieu dans la boucle ; l'encodage et l'écriture
+    atomique passent par un thread. La ville n'est écrite qu'une fois.
+    """
+    def __init__(self, directory, interval=SNAPSHOT_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.task: asyncio.Task | None = None
+        self.cities_written: set = set()
+        self.saves = 0
+        self.errors = 0
+        self.last_capture = 0.0
+        self.last_write = 0.0
+        self.last_bytes = 0
+        # L'écriture finale de stop() peut croiser une écriture périodique encore en cours
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Dernier snapshot à l'arrêt propre : un déploiement ne perd rien."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.write(self.capture())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            captured = self.capture()
+            await asyncio.to_thread(self.write, captured)
+
+    def capture(self):
+        start = time.perf_counter()
+        captured = [capture_room(room) for room in rooms.values()]
+        self.last_capture = time.perf_counter() - start
+        return captured
+
+    def write(self, captured):
+        with self.lock:
+            self._write(captured)
+
+    def _write(self, captured):
+        start = time.perf_counter()
+        written = 0
+        try:
+            for state in captured:
+                if state["city_hash"] not in self.cities_written:
+                    path = world_city_path(self.directory, state["city_hash"])
+                    if not os.path.exists(path):
+                        write_atomic(path, pack_world_city(state["layout"]))
+                    self.cities_written.add(state["city_hash"])
+                data = pack_world_room(state)
+                write_atomic(world_room_path(self.directory, state["room_id"]), data)
+                written += len(data)
+        except OSError:
+            self.errors += 1
+            logger.exception("échec du snapshot du monde dans %s", self.directory)
+            return
+        self.saves += 1
+        self.last_bytes = written
+        self.last_write = time.perf_counter() - start
+
+    def stats(self):
+        return {"saves": self.saves, "errors": self.errors, "bytes": self.last_bytes,
+                "capture_ms": self.last_capture * 1000, "write_ms": self.last_write * 1000}
+
+world_snapshots: WorldSnapshots | None = None
+
+##########################################################################
+#                 Profilage et surveillance de la boucle                 #
+##########################################################################
+# Routes /admin/* : désactivées sans jeton, qui s'envoie dans l'en-tête
+# "Authorization: Bearer <jeton>" (jamais dans l'URL, qui finit dans les journaux)
+ADMIN_TOKEN = os.environ.get("ZOMBIE_ADMIN_TOKEN")
+PROFILE_MAX_SECONDS = 60.0
+PROFILE_MAX_HZ = 1000
+# Une boucle bloquée plus longtemps que ce seuil est journalisée avec sa pile (0 : pas de surveillance)
+LAG_THRESHOLD = float(os.environ.get("ZOMBIE_LAG_THRESHOLD_MS", "100")) / 1000
+LAG_HISTORY = 20
+
+_phase_codes: dict = {}
+
+def phase_codes():
+    """
+    Code des fonctions qui délimitent chaque phase. Un échantillon prend la phase
+    de la fonction repérée la plus proche du sommet de la pile : rien n'est
+    instrumenté, le marquage ne coûte rien hors profilage.
+    """
+    if not _phase_codes:
+        phases = {
+            "collision": (CityGrid.segment_blocked, NpcCrowd._blocked),
+            "infection": (Room.apply_infection, NpcCrowd._infect),
+            "npc": (NpcCrowd.step, Navigation.update),
+            "input": (websocket_endpoint, decode_input, GameLoop.queue_input, Room.apply_input),
+            "serialisation": (SnapshotBuilder.build, ConnectionManager.broadcast_snapshot,
+                              SimulationHub.broadcast_snapshot),
+            "send": (ClientConnection._write_loop, GatewayLink.send),
+        }
+        for phase, functions in phases.items():
+            for function in functions:
+                _phase_codes[function.__code__] = phase
+    return _phase_codes
+
+def frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+def sample_stack(thread_id):
+    """
+    Pile courante d'un thread, de la racine au sommet, et sa phase. "idle" : la
+    boucle attend dans select() ; "other" : aucune fonction repérée.
+    """
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return None, ()
+    codes = phase_codes()
+    phase = None
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        if phase is None:
+            phase = codes.get(code)
+        stack.append(code)
+        frame = frame.f_back
+    if phase is None:
+        phase = "idle" if stack and stack[0].co_filename.endswith("selectors.py") else "other"
+    stack.reverse()
+    return phase, tuple(stack)
+
+class SamplingProfiler:
+    """
+    Échantillonne depuis un thread à part la pile du thread de la boucle
+    asyncio, `hz` fois par seconde. Le résultat est au format « piles
+    repliées » (une ligne "phase;racine;…;sommet n"), lisible par
+    flamegraph.pl ou speedscope.
+    """
+    def __init__(self, thread_id, hz=100):
+        self.thread_id = thread_id
+        self.interval = 1.0 / hz
+        self.stacks: dict = {}
+        self.phases: dict = {}
+        self.samples = 0
+        self.done = threading.Event()
+
+    def run(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self.done.wait(self.interval) and time.monotonic() < deadline:
+            phase, stack = sample_stack(self.thread_id)
+            if phase is None:
+                break
+            key = (phase, stack)
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.phases[phase] = self.phases.get(phase, 0) + 1
+            self.samples += 1
+        self.done.set()
+
+    def collapsed(self):
+        lines = []
+        names: dict = {}
+        for (phase, stack), count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+            frames = [names.get(code) or names.setdefault(code, frame_name(code)) for code in stack]
+            lines.append(f"phase={phase};{';'.join(frames)} {count}")
+        return "\n".join(lines) + "\n"
+
+active_profiler: SamplingProfiler | None = None
+
+class EventLoopMonitor:
+    """
+    Mesure le retard de la boucle asyncio : une tâche note l'heure à chaque
+    réveil, un thread de garde vérifie qu'elle avance. Si la boucle reste
+    bloquée au-delà du seuil, le thread relève la pile pendant le blocage,
+    c'est-à-dire celle du code fautif ; la tâche journalise l'arrêt à son réveil.
+    """
+    def __init__(self, threshold=LAG_THRESHOLD, history=LAG_HISTORY):
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self.beat = time.monotonic()
+        self.thread_id = None
+        self.captured = None
+        self.stalls: deque = deque(maxlen=history)
+        self.count = 0
+        self.max_lag = 0.0
+        self.task: asyncio.Task | None = None
+        self.watchdog: threading.Thread | None = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.task = asyncio.create_task(self._heartbeat())
+        self.watchdog = threading.Thread(target=self._watch, name="zombie-lag-watchdog", daemon=True)
+        self.watchdog.start()
+
+    async def stop(self):
+        self.stopping.set()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _heartbeat(self):
+        while True:
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self.beat - self.interval
+            EVENT_LOOP_LAG.observe(max(lag, 0.0))
+            if lag > self.threshold:
+                self._record(lag)
+            else:
+                # Pile relevée pour un retard finalement sous le seuil
+                self.captured = None
+
+    def _watch(self):
+        while not self.stopping.wait(self.interval):
+            if self.captured is None and time.monotonic() - self.beat > self.interval + self.threshold:
+                self.captured = sample_stack(self.thread_id)
+
+    def _record(self, lag):
+        phase, stack = self.captured or (None, ())
+        self.captured = None
+        self.count += 1
+        self.max_lag = max(self.max_lag, lag)
+        EVENT_LOOP_STALLS.inc()
+        frames = [frame_name(code) for code in stack]
+        self.stalls.append({"at": time.time(), "lag_ms": round(lag * 1000, 1),
+                            "phase": phase, "stack": frames})
+        if frames:
+            logger.warning("boucle bloquée %.0f ms (seuil %.0f ms), phase %s :\n  %s",
+                           lag * 1000, self.threshold * 1000, phase, "\n  ".join(frames))
+        else:
+            logger.warning("boucle bloquée %.0f ms (seuil %.0f ms), pile non relevée",
+                           lag * 1000, self.threshold * 1000)
+
+    def stats(self):
+        return {"threshold_ms": self.threshold * 1000, "stalls": self.count,
+                "max_lag_ms": round(self.max_lag * 1000, 1), "recent": list(self.stalls)}
+
+lag_monitor = EventLoopMonitor() if LAG_THRESHOLD > 0 else None
+
+def admin_denied(request):
+    """Réponse d'erreur si la requête n'est pas authentifiée comme admin, sinon None."""
+    if not ADMIN_TOKEN:
+        return PlainTextResponse("routes admin désactivées (ZOMBIE_ADMIN_TOKEN absent)\n", status_code=404)
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return PlainTextResponse("jeton admin invalide\n", status_code=403)
+    return None
+
+##########################################################################
+#                           Routes FastAPI                               #
+##########################################################################
+@app.get("/")
+async def get_index():
+    return HTMLResponse(html_content)
+
+@app.get("/join")
+async def join(request: Request, room: str | None = None):
+    # Un joueur qui revient (jeton de reprise) redemande sa salle
+    room = rooms.get(room) or pick_room()
+    version = room.city_payload.hash
+    ws = f"/ws?room={room.room_id}"
+    if simulation_hub is not None and simulation_hub.links:
+        # Les sockets des joueurs sont tenues par la passerelle la moins chargée
+        ws = f"ws://{request.url.hostname}:{simulation_hub.pick_gateway()}{ws}"
+    return JSONResponse({"room": room.room_id,
+                         "ws": ws,
+                         "city": f"/city?room={room.room_id}&v={version}",
+                         "city_bin": f"/city.bin?room={room.room_id}&v={version}",
+                         "city_hash": version,
+                         "city_size": room.city.tiles.size,
+                         "tile_size": room.city.tiles.tile_size,
+                         "tiles": f"/city/tile/{{i}}/{{j}}?room={room.room_id}&v={version}"})
+
+def city_response(request, room, kind, version, tile=None):
+    """
+    Sert une représentation pré-encodée de la ville, ou d'une de ses tuiles
+    (`tile` : (i, j, détail)). Aucun encodage n'a lieu ici : on choisit
+    seulement les octets correspondant à Accept-Encoding, ou on répond 304
+    si le client possède déjà exactement cette représentation.
+    """
+    payload = room.city_payload
+    bodies = payload.bodies[kind] if tile is None else room.city.tiles.bodies(*tile)
+    encoding = negotiate_encoding(bodies, request.headers.get("accept-encoding"))
+    etag = payload.etag(kind, encoding) if tile is None else room.city.tiles.etag(*tile, encoding)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": CITY_CACHE_IMMUTABLE if version == payload.hash else CITY_CACHE_REVALIDATE,
+        "Vary": "Accept-Encoding",
+        "X-City-Hash": payload.hash,
+        # La page peut être servie par le routeur, sur un autre port
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Expose-Headers": "ETag, X-City-Hash",
+    }
+    if payload.matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    media_type = "application/json" if kind == "json" else "application/octet-stream"
+    return Response(bodies[encoding], media_type=media_type, headers=headers)
+
+@app.get("/city")
+async def get_city(request: Request, room: str | None = None, v: str | None = None):
+    target = rooms.get(room) if room else pick_room()
+    if target is None:
+        return JSONResponse({"error": "salle inconnue"}, status_code=404)
+    return city_response(request, target, "json", v)
+
+@app.get("/city.bin")
+async def get_city_bin(request: Request, room: str | None = None, v: str | None = None):
+    target = rooms.get(room) if room else pick_room()
+    if target is None:
+        return JSONResponse({"error": "salle inconnue"}, status_code=404)
+    return city_response(request, target, "bin", v)
+
+@app.get("/city/tile/{i}/{j}")
+async def get_city_tile(request: Request, i: int, j: int, room: str | None = None,
+                        v: str | None = None, lod: int = TILE_DETAIL_FULL):
+    """Immeubles d'une tuile, au détail complet (lod=0) ou simplifié (lod=1)."""
+    target = rooms.get(room) if room else pick_room()
+    if target is None:
+        return JSONResponse({"error": "salle inconnue"}, status_code=404)
+    if not target.city.tiles.contains(i, j):
+        return JSONResponse({"error": "tuile hors de la carte"}, status_code=404)
+    if lod not in (TILE_DETAIL_FULL, TILE_DETAIL_LOW):
+        return JSONResponse({"error": "niveau de détail inconnu"}, status_code=400)
+    return city_response(request, target, "bin", v, (i, j, lod))
+
+@app.get("/city/hash")
+async def get_city_hash(room: str | None = None):
+    """Hash de référence, à comparer avec le sha256 du /city.bin en cache."""
+    target = rooms.get(room) if room else pick_room()
+    if target is None:
+        return JSONResponse({"error": "salle inconnue"}, status_code=404)
+    payload = target.city_payload
+    return JSONResponse({"room": target.room_id, "hash": payload.hash,
+                         "algorithm": "sha256", "buildings": payload.buildings,
+                         "sizes": payload.sizes()},
+                        headers={"Access-Control-Allow-Origin": "*",
+                                 "Cache-Control": "no-cache"})
+
+@app.get("/stats")
+async def get_stats():
+    return JSONResponse({room_id: room.stats() for room_id, room in rooms.items()})
+
+@app.get("/metrics")
+async def get_metrics():
+    if not metrics.enabled:
+        return PlainTextResponse("métriques désactivées (ZOMBIE_METRICS=0)\n", status_code=404)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10.0, hz: int = 100):
+    """
+    Profil échantillonné du processus pendant `seconds` secondes, en piles
+    repliées préfixées par la phase (input, collision, infection, npc,
+    serialisation, send, idle, other).
+    """
+    global active_profiler
+    denied = admin_denied(request)
+    if denied is not None:
+        return denied
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or not 0 < hz <= PROFILE_MAX_HZ:
+        return PlainTextResponse(f"seconds dans ]0, {PROFILE_MAX_SECONDS:g}], hz dans ]0, {PROFILE_MAX_HZ}]\n",
+                                 status_code=400)
+    if active_profiler is not None:
+        return PlainTextResponse("un profil est déjà en cours\n", status_code=409)
+    # Cette route s'exécute dans le thread de la boucle : c'est lui qu'on échantillonne
+    profiler = active_profiler = SamplingProfiler(threading.get_ident(), hz)
+    sampler = threading.Thread(target=profiler.run, args=(seconds,), name="zombie-profiler", daemon=True)
+    sampler.start()
+    try:
+        while not profiler.done.is_set():
+            await asyncio.sleep(min(0.1, seconds))
+    finally:
+        profiler.done.set()
+        active_profiler = None
+    phases = ",".join(f"{phase}={count}" for phase, count in sorted(profiler.phases.items()))
+    return PlainTextResponse(profiler.collapsed(),
+                             headers={"X-Profile-Samples": str(profiler.samples), "X-Profile-Phases": phases})
+
+@app.get("/admin/lag")
+async def admin_lag(request: Request):
+    denied = admin_denied(request)
+    if denied is not None:
+        return denied
+    if lag_monitor is None:
+        return JSONResponse({"error": "surveillance désactivée (ZOMBIE_LAG_THRESHOLD_MS=0)"}, status_code=404)
+    return JSONResponse(lag_monitor.stats())
+
+def decode_input(message):
+    """
+    Extrait l'entrée d'un message client, binaire ou JSON.
+    Renvoie (action, touches, séquence) ; action vaut "input", "resync" ou None.
+    """
+    data_bytes = message.get("bytes")
+    if data_bytes:
+        if data_bytes[0] == INPUT_RESYNC:
+            return "resync", 0, 0
+        if data_bytes[0] == INPUT_STATE and len(data_bytes) == INPUT_STATE_STRUCT.size:
+            _, keys, seq = INPUT_STATE_STRUCT.unpack(data_bytes)
+            return "input", keys & KEY_MASK, seq
+        return None, 0, 0
+    data_text = message.get("text")
+    if data_text is None:
+        return None, 0, 0
+    try:
+        data = json.loads(data_text)
+    except json.JSONDecodeError:
+        JSON_DECODE_ERRORS.inc()
+        return None, 0, 0
+    if not isinstance(data, dict):
+        return None, 0, 0
+    if data.get("type") == "resync":
+        return "resync", 0, 0
+    keys, seq = data.get("keys"), data.get("seq", 0)
+    if data.get("type") == "input" and isinstance(keys, int) and isinstance(seq, int):
+        return "input", keys & KEY_MASK, seq & 0xFFFFFFFF
+    return None, 0, 0
+
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    room = rooms.get(websocket.query_params.get("room")) or pick_room()
+    manager = room.manager
+    player_id = str(id(websocket))
+    binary = websocket.query_params.get("proto") == "bin"
+    conn = await manager.connect(websocket, player_id, binary)
+    # Dès la connexion enregistrée, tout échec (salle pleine, reprise) passe
+    # par le finally : sinon la tâche d'envoi et sa file resteraient
+    try:
+        slot = room.add_player(player_id, parse_token(websocket.query_params.get("resume")))
+        token = room.tokens[player_id]
+        # Cadence et vitesses : le client prédit ses propres déplacements avec les mêmes règles
+        if binary:
+            manager.send(websocket, ASSIGN_STRUCT.pack(MSG_ASSIGN, slot, room.loop.tick_rate,
+                                                       MOVE_SPEED, ROT_SPEED, token))
+        else:
+            manager.send(websocket, json.dumps({"type": "assign_id", "player_id": player_id,
+                                                "tick_rate": room.loop.tick_rate,
+                                                "move_speed": MOVE_SPEED, "rot_speed": ROT_SPEED,
+                                                "token": token.hex()}))
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            action, keys, seq = decode_input(message)
+            if action == "input":
+                INBOUND_INPUT.inc()
+                # Au-delà du débit autorisé, l'entrée remplace l'état courant sans s'y cumuler
+                room.loop.queue_input(player_id, keys, seq, merge=not conn.allow_input())
+            elif action == "resync":
+                INBOUND_RESYNC.inc()
+                # Le client a détecté un trou dans les deltas
+                manager.request_keyframe(websocket)
+            else:
+                INBOUND_INVALID.inc()
+  
+    except WebSocketDisconnect:
+        pass
+    finally:
+        manager.disconnect(websocket)
+        room.remove_player(player_id)
+
+##########################################################################
+#                    Routeur et processus de salles                      #
+##########################################################################
+# En mode multi-processus, un petit routeur sert la page et répartit les
+# nouveaux joueurs ; chaque processus de salles a son propre port et sa boucle.
+router_app = FastAPI()
+# (id de salle, port du processus qui l'héberge), indexé comme shard_loads
+shard_table: list[tuple[str, int]] = []
+# Hash et côté de la ville commune, calculés par le routeur à partir de la même graine
+shard_city_hash = None
+shard_city_size = None
+# Un joueur envoyé vers une salle y compte d'avance, jusqu'à son arrivée (compteur
+# shard_joins du processus) ou au plus JOIN_RESERVATION_TTL secondes : une rafale
+# de /join se répartit entre les salles. Propre au routeur, jamais écrasé par les
+# processus de salles. Par salle : expirations, arrivées déjà soldées.
+JOIN_RESERVATION_TTL = 10.0
+shard_reservations: list[deque] = []
+shard_seen_joins: list[int] = []
+
+def shard_reserved(slot, now):
+    """Réservations encore en attente pour une salle, arrivées et expirations soldées."""
+    reserved = shard_reservations[slot]
+    joins = shard_joins[slot]
+    arrived = joins - shard_seen_joins[slot]
+    shard_seen_joins[slot] = joins
+    for _ in range(min(arrived, len(reserved))):
+        reserved.popleft()
+    while reserved and reserved[0] <= now:
+        reserved.popleft()
+    return len(reserved)
+
+@router_app.get("/")
+async def router_index():
+    return HTMLResponse(html_content)
+
+@router_app.get("/join")
+async def router_join(request: Request, room: str | None = None):
+    now = time.monotonic()
+    slot = next((i for i, (room_id, _) in enumerate(shard_table) if room_id == room), None)
+    if slot is None:
+        slot = min(range(len(shard_table)), key=lambda i: shard_loads[i] + shard_reserved(i, now))
+    shard_reservations[slot].append(now + JOIN_RESERVATION_TTL)
+    room_id, port = shard_table[slot]
+    host = request.url.hostname
+    version = shard_city_hash
+    return JSONResponse({"room": room_id,
+                         "ws": f"ws://{host}:{port}/ws?room={room_id}",
+                         "city": f"http://{host}:{port}/city?room={room_id}&v={version}",
+                         "city_bin": f"http://{host}:{port}/city.bin?room={room_id}&v={version}",
+                         "city_hash": version,
+                         "city_size": shard_city_size,
+                         "tile_size": CITY_TILE_SIZE,
+                         "tiles": f"http://{host}:{port}/city/tile/{{i}}/{{j}}?room={room_id}&v={version}"})
+
+@router_app.get("/stats")
+async def router_stats():
+    now = time.monotonic()
+    return JSONResponse({room_id: {"port": port, "players": shard_loads[i],
+                                   "reserved": shard_reserved(i, now)}
+                         for i, (room_id, port) in enumerate(shard_table)})
+
+def run_worker(host, port, room_ids, loads, joins, city_seed, city_size):
+    """Point d'entrée d'un processus de salles."""
+    global hosted_room_ids, shard_loads, shard_joins, CITY_SEED, CITY_SIZE
+    hosted_room_ids = room_ids
+    shard_loads = loads
+    shard_joins = joins
+    # Seule la graine traverse le processus : la génération est déterministe
+    CITY_SEED = city_seed
+    CITY_SIZE = city_size
+    uvicorn.run(app, host=host, port=port)
+
+def run_sharded(host, port, workers, rooms_per_worker):
+    """
+    Lance `workers` processus hébergeant chacun `rooms_per_worker` salles sur les
+    ports port+1.., puis le routeur sur `port`.
+    """
+    global shard_loads, shard_joins, shard_city_hash, shard_city_size
+    # Les processus de salles restaurent la même ville que le routeur (voir start_rooms)
+    layout = load_world_city()
+    if layout is not None:
+        city_seed = layout["seed"]
+    else:
+        city_seed = CITY_SEED if CITY_SEED is not None else int.from_bytes(os.urandom(4), "little")
+        layout = generate_city_layout(city_seed, CITY_SIZE)
+    shard_city_hash = CityPayload(layout).hash
+    shard_city_size = layout["size"]
+    ctx = multiprocessing.get_context("spawn")
+    shard_loads = ctx.Array("i", workers * rooms_per_worker, lock=False)
+    shard_joins = ctx.Array("i", workers * rooms_per_worker, lock=False)
+    shard_reservations.extend(deque() for _ in range(workers * rooms_per_worker))
+    shard_seen_joins.extend([0] * (workers * rooms_per_worker))
+    processes = []
+    for w in range(workers):
+        worker_port = port + 1 + w
+        room_ids = [f"r{w * rooms_per_worker + k}" for k in range(rooms_per_worker)]
+        shard_table.extend((room_id, worker_port) for room_id in room_ids)
+        proc = ctx.Process(target=run_worker, args=(host, worker_port, room_ids, shard_loads, shard_joins,
+                                                       city_seed, shard_city_size),
+                           daemon=True)
+        proc.start()
+        processes.append(proc)
+    try:
+        uvicorn.run(router_app, host=host, port=port)
+    finally:
+        for proc in processes:
+            proc.terminate()
+
+##########################################################################
+#               Cœur de simulation et passerelles WebSocket              #
+##########################################################################
+# Un seul monde, plusieurs processus : le processus principal simule les salles
+# et sert le HTTP ; des passerelles (ports port+1..) tiennent les sockets des
+# joueurs et font le fan-out. Ils se parlent par une socket Unix locale.
+#
+# Trame : type u8, longueur u32, corps.
+#   HELLO    (passerelle -> cœur) JSON {"gateway": n}
+#   JOIN     (passerelle -> cœur) JSON {"conn", "room", "player_id", "binary", "resume"}
+#   ASSIGN   (cœur -> passerelle) JSON {"conn", "room", "index", "slot", "tick_rate", "token"},
+#            ou {"conn", "error"} si l'inscription est refusée (salle pleine...)
+#   LEAVE    (passerelle -> cœur) conn u32
+#   INPUT    (passerelle -> cœur) conn u32, touches u8, séquence u32, fusion u8
+#   KEYFRAME (passerelle -> cœur) salle u16 : des clients attendent une keyframe
+#   SNAPSHOT (cœur -> passerelle) salle u16, tick u32, base u32, drapeaux u8,
+#            4 blobs (longueur u32 + octets : delta binaire, keyframe binaire,
+#            delta JSON, keyframe JSON ; longueur 0 = absent),
+#            n u32 + n accusés (conn u32, séquence u32, ticks u32)
+# Le corps du snapshot est encodé une fois par tick et partagé par toutes les
+# passerelles ; seuls les accusés de leurs propres clients diffèrent. Les
+# messages envoyés ne sont pas filtrés par zone d'intérêt.
+LINK_HELLO = 0
+LINK_JOIN = 1
+LINK_ASSIGN = 2
+LINK_LEAVE = 3
+LINK_INPUT = 4
+LINK_KEYFRAME = 5
+LINK_SNAPSHOT = 6
+LINK_FLAG_KEYFRAME = 1
+
+FRAME_STRUCT = struct.Struct("<BI")
+LINK_CONN_STRUCT = struct.Struct("<I")
+LINK_INPUT_STRUCT = struct.Struct("<IBIB")
+LINK_ROOM_STRUCT = struct.Struct("<H")
+LINK_SNAPSHOT_STRUCT = struct.Struct("<HIIB")
+LINK_BLOB_STRUCT = struct.Struct("<I")
+LINK_ACK_STRUCT = struct.Struct("<III")
+# Au-delà, la passerelle ne suit plus : on saute des snapshots (ses clients
+# redemanderont une keyframe) plutôt que de laisser grossir le tampon
+LINK_BUFFER_LIMIT = int(os.environ.get("ZOMBIE_LINK_BUFFER", str(4 * 1024 * 1024)))
+# Attente maximale de l'attribution d'un joueur par le cœur (s) : au-delà, le
+# navigateur est renvoyé (1013) au lieu de rester bloqué dans la poignée de main
+LINK_JOIN_TIMEOUT = float(os.environ.get("ZOMBIE_LINK_JOIN_TIMEOUT", "5"))
+
+def link_frame(kind, body):
+    return FRAME_STRUCT.pack(kind, len(body)) + body
+
+async def read_frame(reader):
+    kind, length = FRAME_STRUCT.unpack(await reader.readexactly(FRAME_STRUCT.size))
+    return kind, await reader.readexactly(length)
+
+class GatewayLink:
+    """Une passerelle connectée, vue du cœur de simulation."""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.gateway = None
+        # conn -> (indice de salle, id joueur, binaire)
+        self.clients: dict[int, tuple[int, str, bool]] = {}
+        # indice de salle -> {conn: (id joueur, binaire)}
+        self.room_clients: dict[int, dict[int, tuple[str, bool]]] = {}
+        self.wants_keyframe: set[int] = set()
+        # Joueurs envoyés par /join qui ne se sont pas encore connectés
+        self.reserved = 0
+        self.skipped = 0
+
+    def send(self, kind, body):
+        self.writer.write(link_frame(kind, body))
+
+    def congested(self):
+        return self.writer.transport.get_write_buffer_size() > LINK_BUFFER_LIMIT
+
+class SimulationHub:
+    """
+    Côté cœur de simulation : accepte les passerelles, applique leurs entrées
+    aux salles et leur diffuse chaque snapshot encodé une seule fois.
+    """
+    def __init__(self, path, gateway_ports):
+        self.path = path
+        self.gateway_ports = gateway_ports
+        self.links: list[GatewayLink] = []
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._serve, path=self.path)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for link in self.links:
+            link.writer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def pick_gateway(self):
+        """Port de la passerelle qui tient le moins de clients."""
+        link = min((link for link in self.links if link.gateway is not None),
+                   key=lambda link: len(link.clients) + link.reserved)
+        link.reserved += 1
+        return self.gateway_ports[link.gateway]
+
+    async def _serve(self, reader, writer):
+        link = GatewayLink(reader, writer)
+        self.links.append(link)
+        try:
+            while True:
+                kind, body = await read_frame(reader)
+                try:
+                    self._handle(link, kind, body)
+                except Exception:
+                    # Une trame invalide ne coûte pas la liaison : le découpage
+                    # en trames reste sûr, seuls ses clients à elle sont concernés
+                    logger.exception("passerelle %s : trame %d ignorée", link.gateway, kind)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.links.remove(link)
+            for conn in list(link.clients):
+                self._leave(link, conn)
+            writer.close()
+            logger.info("passerelle %s déconnectée", link.gateway)
+
+    def _handle(self, link, kind, body):
+        if kind == LINK_INPUT:
+            conn, keys, seq, merge = LINK_INPUT_STRUCT.unpack(body)
+            client = link.clients.get(conn)
+            if client is not None:
+                rooms[hosted_room_ids[client[0]]].loop.queue_input(client[1], keys, seq, merge=bool(merge))
+        elif kind == LINK_KEYFRAME:
+            link.wants_keyframe.add(LINK_ROOM_STRUCT.unpack(body)[0])
+        elif kind == LINK_JOIN:
+            request = json.loads(body)
+            try:
+                self._join(link, request)
+            except (RuntimeError, LookupError, ValueError, TypeError) as exc:
+                # Refus explicite : la passerelle ferme la socket (1013) sans attendre
+                link.reserved = max(0, link.reserved - 1)
+                logger.warning("passerelle %s : inscription refusée (%s)", link.gateway, exc)
+                link.send(LINK_ASSIGN, json.dumps({"conn": request["conn"], "error": str(exc)}).encode())
+        elif kind == LINK_LEAVE:
+            self._leave(link, LINK_CONN_STRUCT.unpack(body)[0])
+        elif kind == LINK_HELLO:
+            link.gateway = json.loads(body)["gateway"]
+            logger.info("passerelle %d connectée", link.gateway)
+
+    def _join(self, link, request):
+        room = rooms.get(request.get("room")) or pick_room()
+        index = hosted_room_ids.index(room.room_id)
+        conn, player_id, binary = request["conn"], request["player_id"], bool(request.get("binary"))
+        slot = room.add_player(player_id, parse_token(request.get("resume")))
+        token = room.tokens[player_id]
+        link.reserved = max(0, link.reserved - 1)
+        link.clients[conn] = (index, player_id, binary)
+        link.room_clients.setdefault(index, {})[conn] = (player_id, binary)
+        # Le nouveau venu a besoin d'une keyframe pour démarrer
+        link.wants_keyframe.add(index)
+        link.send(LINK_ASSIGN, json.dumps({"conn": conn, "room": room.room_id, "index": index,
+                                           "slot": slot, "tick_rate": room.loop.tick_rate,
+                                           "token": token.hex()}).encode())
+
+    def _leave(self, link, conn):
+        client = link.clients.pop(conn, None)
+        if client is None:
+            return
+        index, player_id, _ = client
+        link.room_clients[index].pop(conn, None)
+        rooms[hosted_room_ids[index]].remove_player(player_id)
+
+    def broadcast_snapshot(self, room, snapshot):
+        """
+        Encode le snapshot une fois (variantes demandées par au moins une
+        passerelle) et l'envoie à chaque passerelle avec ses accusés.
+        Renvoie le nombre d'octets écrits.
+        """
+        index = hosted_room_ids.index(room.room_id)
+        targets = [link for link in self.links if link.room_clients.get(index)]
+        if not targets:
+            return 0
+        keyframe = snapshot.keyframe or any(index in link.wants_keyframe for link in targets)
+        binary = text = False
+        for link in targets:
+            for _, is_binary in link.room_clients[index].values():
+                if is_binary:
+                    binary = True
+                else:
+                    text = True
+            if binary and text:
+                break
+        blobs = [
+            snapshot.delta_bytes() if binary else b"",
+            snapshot.keyframe_bytes() if binary and keyframe else b"",
+            snapshot.delta_text().encode() if text else b"",
+            snapshot.keyframe_text().encode() if text and keyframe else b"",
+        ]
+        base = NO_TICK if snapshot.base_tick is None else snapshot.base_tick
+        parts = [LINK_SNAPSHOT_STRUCT.pack(index, snapshot.tick, base, LINK_FLAG_KEYFRAME if snapshot.keyframe else 0)]
+        for blob in blobs:
+            parts.append(LINK_BLOB_STRUCT.pack(len(blob)))
+            parts.append(blob)
+        shared = b"".join(parts)
+        store = room.players
+        written = 0
+        for link in targets:
+            if link.congested():
+                link.skipped += 1
+                continue
+            clients = link.room_clients[index]
+            acks = bytearray(LINK_BLOB_STRUCT.pack(len(clients)))
+            for conn, (player_id, _) in clients.items():
+                slot = store.slot_of.get(player_id)
+                if slot is None:
+                    acks += LINK_ACK_STRUCT.pack(conn, 0, 0)
+                else:
+                    acks += LINK_ACK_STRUCT.pack(conn, store.input_seq[slot], store.input_ticks[slot])
+            link.writer.writelines((FRAME_STRUCT.pack(LINK_SNAPSHOT, len(shared) + len(acks)), shared, acks))
+            if keyframe:
+                link.wants_keyframe.discard(index)
+            written += len(shared) + len(acks)
+        return written
+
+    def stats(self):
+        return {str(link.gateway): {"clients": len(link.clients), "skipped": link.skipped,
+                                    "buffered": link.writer.transport.get_write_buffer_size()}
+                for link in self.links}
+
+# Défini par run_gateways dans le processus de simulation
+simulation_hub: SimulationHub | None = None
+
+class RelayedSnapshot:
+    """
+    Snapshot reçu du cœur de simulation, déjà encodé. Même interface que
+    Snapshot pour ConnectionManager.broadcast_snapshot ; une keyframe absente
+    vaut None et la passerelle la redemande.
+    """
+    def __init__(self, body):
+        view = memoryview(body)
+        self.index, self.tick, base, flags = LINK_SNAPSHOT_STRUCT.unpack_from(view)
+        self.base_tick = None if base == NO_TICK else base
+        self.keyframe = bool(flags & LINK_FLAG_KEYFRAME)
+        offset = LINK_SNAPSHOT_STRUCT.size
+        blobs = []
+        for _ in range(4):
+            (length,) = LINK_BLOB_STRUCT.unpack_from(view, offset)
+            offset += LINK_BLOB_STRUCT.size
+            blobs.append(bytes(view[offset:offset + length]) if length else None)
+            offset += length
+        self._delta_bytes, self._keyframe_bytes, delta_text, keyframe_text = blobs
+        self._delta_text = delta_text.decode() if delta_text else None
+        self._keyframe_text = keyframe_text.decode() if keyframe_text else None
+        (count,) = LINK_BLOB_STRUCT.unpack_from(view, offset)
+        offset += LINK_BLOB_STRUCT.size
+        self.acks = {}
+        for _ in range(count):
+            conn, seq, ticks = LINK_ACK_STRUCT.unpack_from(view, offset)
+            offset += LINK_ACK_STRUCT.size
+            self.acks[conn] = (seq, ticks)
+        self.missing_keyframe = False
+
+    def delta_bytes(self):
+        return self._delta_bytes
+
+    def delta_text(self):
+        return self._delta_text
+
+    def keyframe_bytes(self):
+        if self._keyframe_bytes is None:
+            self.missing_keyframe = True
+        return self._keyframe_bytes
+
+    def keyframe_text(self):
+        if self._keyframe_text is None:
+            self.missing_keyframe = True
+        return self._keyframe_text
+
+    def with_ack(self, message, conn):
+        ack = self.acks.get(conn)
+        return message if ack is None else append_ack(message, *ack)
+
+class SimulationLink:
+    """Côté passerelle : la connexion au cœur de simulation."""
+    def __init__(self, gateway, path):
+        self.gateway = gateway
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self.next_conn = 0
+        self.pending_joins: dict[int, asyncio.Future] = {}
+        # indice de salle -> connexions WebSocket de cette passerelle
+        self.managers: dict[int, ConnectionManager] = {}
+        self.reader_task = None
+
+    async def connect(self, timeout=10.0):
+        # Le cœur démarre en parallèle des passerelles : on réessaie un moment
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        self.send(LINK_HELLO, json.dumps({"gateway": self.gateway}).encode())
+        self.reader_task = asyncio.create_task(self._read_loop())
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    def send(self, kind, body):
+        self.writer.write(link_frame(kind, body))
+
+    def manager(self, index):
+        manager = self.managers.get(index)
+        if manager is None:
+            manager = self.managers[index] = ConnectionManager()
+        return manager
+
+    async def join(self, room_id, binary, resume=None, timeout=LINK_JOIN_TIMEOUT):
+        """
+        Inscrit un joueur auprès du cœur ; renvoie (conn, id joueur, attribution).
+        Lève asyncio.TimeoutError si le cœur ne répond pas à temps, ConnectionError
+        si la liaison est perdue ou si le cœur refuse le joueur.
+        """
+        self.next_conn = (self.next_conn + 1) & 0xFFFFFFFF
+        conn = self.next_conn
+        player_id = f"g{self.gateway}-{conn}"
+        future = asyncio.get_running_loop().create_future()
+        self.pending_joins[conn] = future
+        self.send(LINK_JOIN, json.dumps({"conn": conn, "room": room_id, "player_id": player_id,
+                                         "binary": binary, "resume": resume}).encode())
+        try:
+            assign = await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, ConnectionError, asyncio.CancelledError):
+            self.pending_joins.pop(conn, None)
+            # Le LEAVE suit le JOIN sur la liaison : une attribution tardive
+            # ne laisse pas de joueur fantôme dans le cœur
+            self.leave(conn)
+            raise
+        return conn, player_id, assign
+
+    def leave(self, conn):
+        self.send(LINK_LEAVE, LINK_CONN_STRUCT.pack(conn))
+
+    def queue_input(self, conn, keys, seq, merge):
+        self.send(LINK_INPUT, LINK_INPUT_STRUCT.pack(conn, keys, seq, merge))
+
+    def request_keyframe(self, index):
+        self.send(LINK_KEYFRAME, LINK_ROOM_STRUCT.pack(index))
+
+    async def _read_loop(self):
+        try:
+            while True:
+                kind, body = await read_frame(self.reader)
+                if kind == LINK_SNAPSHOT:
+                    snapshot = RelayedSnapshot(body)
+                    manager = self.managers.get(snapshot.index)
+                    if manager is None:
+                        continue
+                    manager.broadcast_snapshot(snapshot)
+                    if snapshot.missing_keyframe:
+                        self.request_keyframe(snapshot.index)
+                elif kind == LINK_ASSIGN:
+                    assign = json.loads(body)
+                    future = self.pending_joins.pop(assign["conn"], None)
+                    if future is None or future.done():
+                        continue
+                    if "error" in assign:
+                        future.set_exception(ConnectionRefusedError(assign["error"]))
+                    else:
+                        future.set_result(assign)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.error("passerelle %d : connexion au cœur de simulation perdue", self.gateway)
+            for future in self.pending_joins.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("cœur de simulation perdu"))
+            self.pending_joins.clear()
+            for manager in self.managers.values():
+                for conn in list(manager.active_connections.values()):
+                    await conn.close(code=1012)
+
+# Défini par run_gateway dans chaque processus passerelle
+simulation_link: SimulationLink | None = None
+
+@asynccontextmanager
+async def gateway_lifespan(app):
+    await simulation_link.connect()
+    yield
+    await simulation_link.close()
+
+gateway_app = FastAPI(lifespan=gateway_lifespan)
+
+@gateway_app.get("/stats")
+async def gateway_stats():
+    return JSONResponse({hosted_room_ids[index]: manager.stats()
+                         for index, manager in simulation_link.managers.items()})
+
+@gateway_app.websocket("/ws")
+async def gateway_websocket(websocket: WebSocket):
+    link = simulation_link
+    binary = websocket.query_params.get("proto") == "bin"
+    try:
+        conn, player_id, assign = await link.join(websocket.query_params.get("room"), binary,
+                                                  websocket.query_params.get("resume"))
+    except (asyncio.TimeoutError, ConnectionError) as exc:
+        logger.warning("passerelle %d : inscription refusée (%s)", link.gateway,
+                       type(exc).__name__)
+        # 1013 (Try Again Later) : un code de fermeture suppose une socket acceptée
+        await websocket.accept()
+        await websocket.close(code=1013)
+        return
+    index = assign["index"]
+    manager = link.manager(index)
+    # Le joueur existe déjà dans le cœur : tout échec à partir d'ici (client
+    # parti pendant l'attente, accept() qui lève) doit passer par le LEAVE
+    try:
+        client = await manager.connect(websocket, conn, binary)
+        if binary:
+            manager.send(websocket, ASSIGN_STRUCT.pack(MSG_ASSIGN, assign["slot"], assign["tick_rate"],
+                                                       MOVE_SPEED, ROT_SPEED, bytes.fromhex(assign["token"])))
+        else:
+            manager.send(websocket, json.dumps({"type": "assign_id", "player_id": player_id,
+                                                "tick_rate": assign["tick_rate"],
+                                                "move_speed": MOVE_SPEED, "rot_speed": ROT_SPEED,
+                                                "token": assign["token"]}))
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            action, keys, seq = decode_input(message)
+            if action == "input":
+                INBOUND_INPUT.inc()
+                link.queue_input(conn, keys, seq, not client.allow_input())
+            elif action == "resync":
+                INBOUND_RESYNC.inc()
+                manager.request_keyframe(websocket)
+                link.request_keyframe(index)
+            else:
+                INBOUND_INVALID.inc()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        manager.disconnect(websocket)
+        link.leave(conn)
+
+def run_gateway(host, port, gateway, path, room_ids):
+    """Point d'entrée d'un processus passerelle."""
+    global simulation_link, hosted_room_ids
+    hosted_room_ids = room_ids
+    simulation_link = SimulationLink(gateway, path)
+    uvicorn.run(gateway_app, host=host, port=port)
+
+def run_gateways(host, port, gateways):
+    """
+    Lance `gateways` passerelles sur les ports port+1.., puis le cœur de
+    simulation (salles, HTTP, /join) sur `port` dans ce processus.
+    """
+    global simulation_hub
+    path = os.path.join(tempfile.gettempdir(), f"zombie21-{os.getpid()}.sock")
+    ports = [port + 1 + g for g in range(gateways)]
+    simulation_hub = SimulationHub(path, ports)
+    ctx = multiprocessing.get_context("spawn")
+    processes = []
+    for g, gateway_port in enumerate(ports):
+        proc = ctx.Process(target=run_gateway, args=(host, gateway_port, g, path, hosted_room_ids), daemon=True)
+        proc.start()
+        processes.append(proc)
+    try:
+        uvicorn.run(app, host=host, port=port)
+    finally:
+        for proc in processes:
+            proc.terminate()
 
 ##########################################################################
 #                             Lancement                                  #
 ##########################################################################
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    parser = argparse.ArgumentParser(description="Serveur de la ville zombie")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="processus de salles (0 : tout dans ce processus)")
+    parser.add_argument("--rooms", type=int, default=ROOMS_PER_PROCESS,
+                        help="salles par processus")
+    parser.add_argument("--gateways", type=int, default=0,
+                        help="passerelles WebSocket autour d'un seul cœur de simulation")
+    parser.add_argument("--seed", type=int, default=CITY_SEED,
+                        help="graine de la ville (aléatoire par défaut)")
+    parser.add_argument("--size", type=int, default=CITY_SIZE,
+                        help="côté de la carte, en unités")
+    parser.add_argument("--record", default=RECORD_DIR,
+                        help="répertoire où journaliser les entrées de chaque salle (voir replay.py)")
+    parser.add_argument("--snapshot", default=SNAPSHOT_DIR,
+                        help="répertoire des snapshots du monde, restaurés au démarrage")
+    args = parser.parse_args()
+    CITY_SEED = args.seed
+    CITY_SIZE = args.size
+    if args.record:
+        os.makedirs(args.record, exist_ok=True)
+        # Hérité par les processus de salles lancés en mode multi-processus
+        os.environ["ZOMBIE_RECORD"] = RECORD_DIR = args.record
+    if args.snapshot:
+        os.makedirs(args.snapshot, exist_ok=True)
+        os.environ["ZOMBIE_SNAPSHOT_DIR"] = SNAPSHOT_DIR = args.snapshot
+    if args.workers > 0:
+        run_sharded(args.host, args.port, args.workers, args.rooms)
+    elif args.gateways > 0:
+        hosted_room_ids = [f"r{i}" for i in range(args.rooms)]
+        run_gateways(args.host, args.port, args.gateways)
+    else:
+        hosted_room_ids = [f"r{i}" for i in range(args.rooms)]
+        uvicorn.run(app, host=args.host, port=args.port)